@@ -1,24 +1,54 @@
-import ta
+import numpy as np
 import pandas as pd
+import indicator
+from indicator_cache import IndicatorCache, indicator_cache
 
 
 class Alpha:
-    def __init__(self, df: pd.DataFrame):
+    def __init__(self, df: pd.DataFrame, cache: IndicatorCache = indicator_cache):
         self.df = df
+        self.cache = cache
+        self._fingerprint = None
 
     def add_indicator(self, strategy_name: str, reference_window: int, sub_window_multiplier: int):
         getattr(self, strategy_name)(strategy_name, reference_window, sub_window_multiplier)
         return self.df
 
+    def _cached(self, indicator_name: str, window: int, compute):
+        if self.cache is None:
+            return compute()
+        if self._fingerprint is None:
+            self._fingerprint = IndicatorCache.fingerprint(self.df)
+        return self.cache.get(self._fingerprint, indicator_name, window, compute).copy()
+
+    def _williams_r(self, reference_window: int):
+        return self._cached("williams_r", reference_window, lambda: indicator.williams_r(
+            high=self.df["high"], low=self.df["low"], close=self.df["close"], lbp=reference_window))
+
     def williamsR(self, strategy_name: str, reference_window: int, sub_window_multiplier: int):
-        self.df[strategy_name.lower()] = ta.momentum.WilliamsRIndicator \
-            (high=self.df["high"], low=self.df["low"], close=self.df["close"], lbp=reference_window).williams_r()
+        self.df[strategy_name.lower()] = self._williams_r(reference_window)
 
     def williamsR_MA(self, strategy_name: str, reference_window: int, sub_window_multiplier: int):
-        self.df[strategy_name.lower().split('_')[0]] = ta.momentum.WilliamsRIndicator \
-            (high=self.df["high"], low=self.df["low"], close=self.df["close"], lbp=reference_window).williams_r()
-        self.df[strategy_name.lower().split('_')[1]] = \
-            ta.trend.SMAIndicator(self.df["close"], window=reference_window*sub_window_multiplier).sma_indicator()
+        self.df[strategy_name.lower().split('_')[0]] = self._williams_r(reference_window)
+        self.df[strategy_name.lower().split('_')[1]] = self._cached(
+            "sma", reference_window * sub_window_multiplier,
+            lambda: indicator.sma(self.df["close"], window=reference_window * sub_window_multiplier))
 
     def RSI(self, strategy_name: str, reference_window: int, sub_window_multiplier: int):
-        self.df[strategy_name.lower()] = ta.momentum.RSIIndicator(close=self.df["close"], window=reference_window).rsi()
+        self.df[strategy_name.lower()] = self._cached(
+            "rsi", reference_window, lambda: indicator.rsi(self.df["close"], window=reference_window))
+
+
+class AlphaMatrix(Alpha):
+    def __init__(self, matrix_dict: dict, cache: IndicatorCache = indicator_cache, dtype=np.float64):
+        """
+        Same indicators as Alpha on (time x symbol) price matrices, every symbol's column computed at once
+        :param matrix_dict: high, low and close matrices with one column per symbol
+        :param cache:
+        :param dtype: dtype of the indicator matrices, float32 halves their memory
+        """
+        super().__init__(df=dict(matrix_dict), cache=cache)
+        self.dtype = dtype
+
+    def _cached(self, indicator_name: str, window: int, compute):
+        return super()._cached(indicator_name, window, compute).astype(self.dtype, copy=False)
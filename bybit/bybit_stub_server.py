@@ -0,0 +1,107 @@
+"""
+Local stand-in of the Bybit /public/linear/kline endpoint for testing and benchmarking
+Bybit_usdt_perpetual_kline: canned klines of the requested symbol, interval, from and limit after
+a configurable latency, with injected 5xx responses and pages that are never served
+"""
+import json
+import math
+import random
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+# minutes of the letter intervals, the way the downloader counts them
+interval_minute_dict = {'D': 24 * 60, 'W': 24 * 60 * 7, 'M': 24 * 60 * 7 * 28}
+
+
+def canned_kline_list(symbol: str, interval: str, from_timestamp: int, limit: int) -> list:
+    """
+    Deterministic klines of a query_kline page
+    :param symbol:
+    :param interval:
+    :param from_timestamp: open_time of the first kline in seconds
+    :param limit: number of klines, 200 at most
+    :return:
+    """
+    step = 60 * interval_minute_dict.get(interval, int(interval) if interval.isdigit() else 1)
+    seed = zlib.crc32(symbol.encode()) % 1000
+    kline_list = []
+    for open_time in range(from_timestamp, from_timestamp + min(limit, 200) * step, step):
+        close = 100 + seed / 10 + 10 * math.sin(open_time / 86400 / 30 + seed)
+        kline_list.append({"id": open_time // step, "symbol": symbol, "period": interval, "interval": interval,
+                           "start_at": open_time, "open_time": open_time, "volume": 1 + open_time % 7,
+                           "open": close * 1.001, "high": close * 1.01, "low": close * 0.99, "close": close,
+                           "turnover": close * (1 + open_time % 7)})
+    return kline_list
+
+
+class BybitStubHandler(BaseHTTPRequestHandler):
+    latency = 0.05
+    fail_rate = 0.0
+    # (symbol, interval, from) of the pages answered with a 503 every time
+    missing_page_set = frozenset()
+    rng = None
+    # a dict shared by the handlers of one server
+    stats = None
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path != "/public/linear/kline":
+            self.send_error(404)
+            return
+        query = {name: value_list[0] for name, value_list in parse_qs(url.query).items()}
+        if not all(name in query for name in ("symbol", "interval", "from")):
+            body = json.dumps({"ret_code": 10001, "ret_msg": "params error", "result": None}).encode()
+            self._send(200, body)
+            return
+        time.sleep(self.latency)
+        page = (query["symbol"], query["interval"], int(query["from"]))
+        with self.server.lock:
+            self.stats["request"] += 1
+            failed = page in self.missing_page_set or self.rng.random() < self.fail_rate
+            if failed:
+                self.stats["fail"] += 1
+            else:
+                self.stats["served_page_list"].append(page)
+        if failed:
+            self.send_error(503)
+            return
+        kline_list = canned_kline_list(symbol=query["symbol"], interval=query["interval"],
+                                       from_timestamp=int(query["from"]), limit=int(query.get("limit", 200)))
+        self._send(200, json.dumps({"ret_code": 0, "ret_msg": "OK", "result": kline_list}).encode())
+
+    def _send(self, status: int, body: bytes):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub_server(latency: float = 0.05, fail_rate: float = 0.0, missing_page_set: set = frozenset(),
+                      seed: int = 0, port: int = 0):
+    """
+    Serve in a daemon thread until server.shutdown()
+    :param latency: seconds every response is delayed by
+    :param fail_rate: fraction of the requests answered with a 503
+    :param missing_page_set: (symbol, interval, from) of the pages that always fail
+    :param seed: of the injected failures
+    :param port: 0 picks a free port
+    :return: the server, with its request and fail counters and the (symbol, interval, from) of every served page
+    in server.stats, and the endpoint to give Bybit_usdt_perpetual_kline
+    """
+    stats = {"request": 0, "fail": 0, "served_page_list": []}
+    handler = type("BybitStubHandler", (BybitStubHandler,),
+                   {"latency": latency, "fail_rate": fail_rate, "missing_page_set": frozenset(missing_page_set),
+                    "rng": random.Random(seed), "stats": stats})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.stats = stats
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
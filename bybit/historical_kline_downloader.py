@@ -1,19 +1,38 @@
 from pybit import usdt_perpetual
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 from time import sleep
 from typing import Union
 from pprint import pprint
-import pandas as pd
+import json
+import os
 import random
+import time
+import numpy as np
+import pandas as pd
+import requests
+from requests.adapters import HTTPAdapter
+from kline_store import KlineStore, default_store_dir, column_dtype_dict
+from rate_limiter import TokenBucket
+
 
 class Bybit_usdt_perpetual_kline:
-    def __init__(self, symbol: Union[int, list], interval: Union[int, list], start_date: str, end_date: str):
+    def __init__(self, symbol: Union[int, list], interval: Union[int, list], start_date: str, end_date: str,
+                 store_dir: str = default_store_dir, endpoint: str = "https://api.bybit.com",
+                 max_workers: int = 8, rate_limit: float = 20, max_retry: int = 5, backoff: float = 0.5):
         """
 
         :param symbol:
         :param interval:
         :param start_date:
         :param end_date:
+        :param store_dir: root directory of the kline store the klines are written to
+        :param endpoint: Bybit REST endpoint, point it to a local stub server for testing
+        :param max_workers: number of pages fetched at the same time by run_concurrent
+        :param rate_limit: requests per second allowed by run_concurrent, Bybit public endpoints allow 50 per second
+        :param max_retry: attempts per page before it is reported as failed
+        :param backoff: first retry delay in seconds, doubled after every failed attempt
         """
         self.buffer = None
         self.http_receiver = None
@@ -22,6 +41,17 @@ class Bybit_usdt_perpetual_kline:
         self.start_date = start_date
         self.end_date = end_date
         self.http_receiver = usdt_perpetual.HTTP()
+        self.kline_store = KlineStore(store_dir)
+        self.endpoint = endpoint
+        self.max_workers = max_workers
+        self.max_retry = max_retry
+        self.backoff = backoff
+        self.rate_limiter = TokenBucket(rate=rate_limit, capacity=max(1, int(rate_limit)))
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.failed_page_list = []
 
     def get_symbol_list(self):
         """
@@ -66,29 +96,45 @@ class Bybit_usdt_perpetual_kline:
 
         return start_timestamp, end_timestamp
 
-    def kLine_downloader(self, symbol: str, interval: str) -> list:
+    def page_param_generator(self, symbol: str, interval: str, start_timestamp: float = None,
+                             end_timestamp: float = None):
         """
-
+        Request parameters of every 200 klines page between start_date and end_date
         :param symbol:
         :param interval:
+        :param start_timestamp: overrides start_date
+        :param end_timestamp: overrides end_date, exclusive
         :return:
         """
-        res_list = []
-
         increment_timestamp, interval_in_minutes = self.increment_generator(interval)
-        start_timestamp, end_timestamp = self.date_string_to_timestamp()
+        if start_timestamp is None or end_timestamp is None:
+            default_start_timestamp, default_end_timestamp = self.date_string_to_timestamp()
+            start_timestamp = default_start_timestamp if start_timestamp is None else start_timestamp
+            end_timestamp = default_end_timestamp if end_timestamp is None else end_timestamp
 
         temp_from_timestamp = start_timestamp
-        while True:
+        while temp_from_timestamp <= end_timestamp:
             receiver_param = {
                 "symbol": symbol.upper(),
                 "interval": interval,
-                "from": temp_from_timestamp,
+                "from": int(temp_from_timestamp),
                 'limit': 200
             }
             if temp_from_timestamp + increment_timestamp > end_timestamp:
                 receiver_param['limit'] = round((end_timestamp - temp_from_timestamp) / (60 * interval_in_minutes))
+            if receiver_param['limit'] > 0:
+                yield receiver_param
+            temp_from_timestamp += increment_timestamp
+
+    def kLine_downloader(self, symbol: str, interval: str) -> list:
+        """
 
+        :param symbol:
+        :param interval:
+        :return:
+        """
+        res_list = []
+        for receiver_param in self.page_param_generator(symbol=symbol, interval=interval):
             try:
                 http_response = self.http_receiver.query_kline(**receiver_param)
                 # print(http_response)
@@ -99,22 +145,276 @@ class Bybit_usdt_perpetual_kline:
                         f'Fail to request symbol:{symbol}, interval:{interval} KLine with Request Parameters: {receiver_param}')
             except Exception as e:
                 print(e)
-            temp_from_timestamp += increment_timestamp
-            if temp_from_timestamp > end_timestamp:
-                return res_list
             sleep(random.uniform(0.01, 0.05))
+        return res_list
 
-    def _kLine_handler(self, symbol: str, interval: str, data_list: list = []):
+    def query_kline_page(self, receiver_param: dict) -> list:
+        """
+        Fetch one page over the pooled session under the rate limit, retrying with exponential backoff
+        :param receiver_param:
+        :return: klines of the page
+        """
+        for attempt in range(self.max_retry):
+            self.rate_limiter.acquire()
+            try:
+                http_response = self.session.get(f"{self.endpoint}/public/linear/kline", params=receiver_param,
+                                                 timeout=10)
+                http_response.raise_for_status()
+                response_json = http_response.json()
+                if response_json.get('ret_code', 0) == 0 and 'result' in response_json:
+                    return response_json['result'] or []
+                raise ValueError(f"ret_code: {response_json.get('ret_code')}, ret_msg: {response_json.get('ret_msg')}")
+            except (requests.exceptions.RequestException, ValueError) as e:
+                if attempt == self.max_retry - 1:
+                    raise ValueError(f'Fail to request KLine with Request Parameters: {receiver_param}, {e}') from e
+                sleep(self.backoff * 2 ** attempt * random.uniform(1, 1.5))
+
+    def kLine_page_generator(self, symbol: str, interval: str, start_timestamp: float = None,
+                             end_timestamp: float = None):
+        """
+        Yield the pages in time order as they arrive, with at most max_workers pages in flight,
+        failed pages are kept in self.failed_page_list, emptied at every call, and yield an empty page
+        :param symbol:
+        :param interval:
+        :param start_timestamp: overrides start_date
+        :param end_timestamp: overrides end_date
+        :return:
+        """
+        self.failed_page_list = []
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            in_flight_deque = deque()
+            for receiver_param in self.page_param_generator(symbol=symbol, interval=interval,
+                                                            start_timestamp=start_timestamp,
+                                                            end_timestamp=end_timestamp):
+                in_flight_deque.append((executor.submit(self.query_kline_page, receiver_param), receiver_param))
+                if len(in_flight_deque) >= self.max_workers:
+                    yield self._page_result(*in_flight_deque.popleft())
+            while in_flight_deque:
+                yield self._page_result(*in_flight_deque.popleft())
+
+    def _page_result(self, future, receiver_param: dict) -> list:
+        try:
+            return future.result()
+        except ValueError as e:
+            print(e)
+            self.failed_page_list.append(receiver_param)
+            return []
+
+    def _check_failed_page(self, allow_partial: bool):
+        if self.failed_page_list and not allow_partial:
+            range_list = []
+            for receiver_param in self.failed_page_list:
+                _, interval_in_minutes = self.increment_generator(receiver_param['interval'])
+                end_timestamp = receiver_param['from'] + receiver_param['limit'] * interval_in_minutes * 60
+                range_list.append(f"{receiver_param['symbol']} {receiver_param['interval']} "
+                                  f"{pd.to_datetime(receiver_param['from'], unit='s')} - "
+                                  f"{pd.to_datetime(end_timestamp, unit='s')}")
+            raise ValueError(f"{len(self.failed_page_list)} pages failed, missing ranges: {', '.join(range_list)}")
+
+    @staticmethod
+    def kLine_chunk_generator(page_iterator, chunk_size: int = 50000):
+        """
+        Convert pages of kline dicts into typed column arrays of chunk_size klines.
+        The same buffers are refilled for every chunk, consume a chunk before asking for the next one
+        :param page_iterator: iterable of kline dict lists
+        :param chunk_size:
+        :return:
+        """
+        buffer_dict = {column: np.empty(chunk_size, dtype=dtype) for column, dtype in column_dtype_dict.items()}
+        fill = 0
+        for page in page_iterator:
+            page_start = 0
+            while page_start < len(page):
+                page_part = page[page_start:page_start + chunk_size - fill]
+                for column, buffer in buffer_dict.items():
+                    buffer[fill:fill + len(page_part)] = [kline.get(column, np.nan) for kline in page_part]
+                fill += len(page_part)
+                page_start += len(page_part)
+                if fill == chunk_size:
+                    yield buffer_dict
+                    fill = 0
+        if fill:
+            yield {column: buffer[:fill] for column, buffer in buffer_dict.items()}
+
+    def stream_to_store(self, symbol: str, interval: str, chunk_size: int = 50000,
+                        allow_partial: bool = False) -> int:
+        """
+        Download start_date..end_date page by page and flush every chunk to the kline store,
+        peak memory is bounded by the chunk size and the pages in flight whatever the date range
+        :param symbol:
+        :param interval:
+        :param chunk_size:
+        :param allow_partial: do not raise when a page keeps failing, the failed pages are left in
+        self.failed_page_list. Either way the pages that arrived stay in the store
+        :return: number of klines downloaded
+        """
+        kline_count = 0
+        page_iterator = self.kLine_page_generator(symbol=symbol, interval=interval)
+        for chunk_dict in Bybit_usdt_perpetual_kline.kLine_chunk_generator(page_iterator, chunk_size=chunk_size):
+            kline_count += self.kline_store.append(symbol=symbol.upper(), interval=interval, data=chunk_dict)
+        self._check_failed_page(allow_partial)
+        return kline_count
+
+    def run_concurrent(self):
         """
+        Fetch the pages of every symbol and interval in parallel on a bounded thread pool,
+        failed pages are kept in self.failed_page_list
+        :return:
+        """
+        for interval in self.interval:
+            self._symbol_validator(interval)
+        page_dict = {(sym, interval): [] for sym in self.symbol for interval in self.interval}
+        self.failed_page_list = []
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            future_dict = {executor.submit(self.query_kline_page, receiver_param): (sym, interval, receiver_param)
+                           for sym, interval in page_dict
+                           for receiver_param in self.page_param_generator(symbol=sym, interval=interval)}
+            for future in as_completed(future_dict):
+                sym, interval, receiver_param = future_dict[future]
+                try:
+                    page_dict[(sym, interval)] += future.result()
+                except ValueError as e:
+                    print(e)
+                    self.failed_page_list.append(receiver_param)
+        for (sym, interval), kLine_list in page_dict.items():
+            if kLine_list:
+                self._kLine_handler(symbol=sym.upper(), interval=interval, data_list=kLine_list)
+            else:
+                print(f"No data was crawled for {sym} {interval}, pleaase check again with your parameters!")
+        return page_dict
+
+    def _checkpoint_path(self) -> str:
+        return os.path.join(self.kline_store.store_dir, "sync_checkpoint.json")
+
+    def _load_checkpoint(self) -> dict:
+        if not os.path.exists(self._checkpoint_path()):
+            return {}
+        with open(self._checkpoint_path()) as f:
+            return json.load(f)
+
+    def _save_checkpoint(self, checkpoint: dict):
+        os.makedirs(self.kline_store.store_dir, exist_ok=True)
+        tmp_path = f"{self._checkpoint_path()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(checkpoint, f, indent=2)
+        os.replace(tmp_path, self._checkpoint_path())
+
+    def _sync_window(self, interval: str):
+        """
+
+        :param interval:
+        :return: start, exclusive end of the klines to keep in sync and the kline step, in seconds
+        """
+        _, interval_in_minutes = self.increment_generator(interval)
+        step = interval_in_minutes * 60
+        start_timestamp, end_timestamp = self.date_string_to_timestamp()
+        # only closed klines, aligned on the kline step
+        end_timestamp = min(end_timestamp, time.time() // step * step)
+        return int(start_timestamp), int(end_timestamp), step
+
+    def missing_range_list(self, symbol: str, interval: str) -> list:
+        """
+        Ranges of the sync window not in the store: the head before the first kline,
+        every gap of missing open_time steps and the tail after the last kline
+        :param symbol:
+        :param interval:
+        :return: list of [start, exclusive end] in seconds
+        """
+        start_timestamp, end_timestamp, step = self._sync_window(interval)
+        open_time = self.kline_store.read(symbol, interval, start=start_timestamp, end=end_timestamp)['open_time']
+        if len(open_time) == 0:
+            return [[start_timestamp, end_timestamp]] if end_timestamp > start_timestamp else []
+        range_list = []
+        if open_time[0] - start_timestamp >= step:
+            range_list.append([start_timestamp, int(open_time[0])])
+        gap_index = np.flatnonzero(np.diff(open_time) > step)
+        range_list += [[int(open_time[i]) + step, int(open_time[i + 1])] for i in gap_index]
+        if end_timestamp - open_time[-1] > step:
+            range_list.append([int(open_time[-1]) + step, end_timestamp])
+        return range_list
+
+    def coverage_summary(self) -> pd.DataFrame:
+        """
+        Stored klines against the expected klines of the sync window, per symbol and interval
+        :return:
+        """
+        summary_list = []
+        for sym in self.symbol:
+            for interval in self.interval:
+                start_timestamp, end_timestamp, step = self._sync_window(interval)
+                open_time = self.kline_store.read(sym, interval, start=start_timestamp, end=end_timestamp)['open_time']
+                expected = max(0, (end_timestamp - start_timestamp + step - 1) // step)
+                summary_list.append({
+                    "symbol": sym.upper(), "interval": interval, "expected": expected, "stored": len(open_time),
+                    "coverage_pct": 100 * len(open_time) / expected if expected else 100.0,
+                    "gap_count": int(np.count_nonzero(np.diff(open_time) > step)),
+                    "first": pd.to_datetime(open_time[0], unit='s') if len(open_time) else None,
+                    "last": pd.to_datetime(open_time[-1], unit='s') if len(open_time) else None})
+        return pd.DataFrame(summary_list)
+
+    def _fetch_range(self, executor: ThreadPoolExecutor, symbol: str, interval: str, start_timestamp: int,
+                     end_timestamp: int) -> list:
+        """
+        Fetch the pages of one range concurrently, raise ValueError if any page keeps failing
+        """
+        future_list = [executor.submit(self.query_kline_page, receiver_param) for receiver_param in
+                       self.page_param_generator(symbol=symbol, interval=interval, start_timestamp=start_timestamp,
+                                                 end_timestamp=end_timestamp)]
+        kLine_list = []
+        for future in future_list:
+            kLine_list += future.result()
+        return [kline for kline in kLine_list if start_timestamp <= kline['open_time'] < end_timestamp]
+
+    def sync(self) -> pd.DataFrame:
+        """
+        Download only what the store is missing: the tail, the head and the detected gaps.
+        Every fetched range is stored and checkpointed, a crashed sync of the same window resumes from the
+        pending ranges, ranges the exchange has no kline for are remembered and not requested again
+        :return: coverage summary
+        """
+        for interval in self.interval:
+            self._symbol_validator(interval)
+        checkpoint = self._load_checkpoint()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for sym in self.symbol:
+                for interval in self.interval:
+                    key = f"{sym.upper()}_{interval}"
+                    state = checkpoint.setdefault(key, {"pending_range_list": [], "empty_range_list": []})
+                    window = list(self._sync_window(interval)[:2])
+                    # pending ranges left by a sync of another window are detected again from the store
+                    if not state["pending_range_list"] or state.get("window") != window:
+                        state["window"] = window
+                        state["pending_range_list"] = [
+                            missing_range for missing_range in self.missing_range_list(sym, interval)
+                            if not any(empty[0] <= missing_range[0] and missing_range[1] <= empty[1]
+                                       for empty in state["empty_range_list"])]
+                        self._save_checkpoint(checkpoint)
+                    print(f"{key}: {len(state['pending_range_list'])} ranges to sync")
+                    for start_timestamp, end_timestamp in list(state["pending_range_list"]):
+                        try:
+                            kLine_list = self._fetch_range(executor, sym, interval, start_timestamp, end_timestamp)
+                        except ValueError as e:
+                            print(f"{key}: keep [{start_timestamp}, {end_timestamp}) pending, {e}")
+                            continue
+                        if kLine_list:
+                            self._kLine_handler(symbol=sym.upper(), interval=interval, data_list=kLine_list)
+                        else:
+                            state["empty_range_list"].append([start_timestamp, end_timestamp])
+                        state["pending_range_list"].remove([start_timestamp, end_timestamp])
+                        self._save_checkpoint(checkpoint)
+        summary_df = self.coverage_summary()
+        print(summary_df)
+        return summary_df
 
+    def _kLine_handler(self, symbol: str, interval: str, data_list: list = []):
+        """
+        Merge the klines into the kline store, duplicated open_time are dropped by the store
         :param symbol:
         :param interval:
         :param data_list:
         :return:
         """
-        df = pd.DataFrame(data_list)
-        df.drop_duplicates(inplace=True)
-        df.to_csv(f"bybit_{symbol}_{interval}_kline.csv")
+        self.kline_store.append(symbol=symbol, interval=interval, data=data_list)
 
     def _symbol_validator(self, symbol: str):
         """
@@ -126,23 +426,80 @@ class Bybit_usdt_perpetual_kline:
         if symbol not in standard_interval_list:
             raise ValueError(f"Interval not validated, please input one or more than one of the {standard_interval_list}")
 
-    def run(self):
+    def run(self, allow_partial: bool = False):
         """
 
+        :param allow_partial: do not raise when a page keeps failing, the failed pages of every symbol and
+        interval are left in self.failed_page_list. By default they raise ValueError once all are downloaded
         :return:
         """
+        failed_page_list = []
         for sym in self.symbol:
             for interval in self.interval:
                 self._symbol_validator(interval)
                 try:
                     print(sym, interval)
-                    kLine_list = self.kLine_downloader(symbol=sym, interval=interval)
-                    if kLine_list:
-                        self._kLine_handler(symbol=sym.upper(), interval=interval, data_list=kLine_list)
-                    else:
+                    if not self.stream_to_store(symbol=sym, interval=interval, allow_partial=True):
                         raise ValueError("No data was crawled, pleaase check again with your parameters!")
                 except Exception as e:
                     print(e)
+                failed_page_list += self.failed_page_list
+        self.failed_page_list = failed_page_list
+        self._check_failed_page(allow_partial)
+
+
+def _benchmark_stream_mode(mode: str, endpoint: str, start_date: str, end_date: str, store_dir: str):
+    """
+    One download of benchmark_stream, run in its own process so its peak RSS is its own
+    :return: seconds, peak RSS in MB and number of stored klines
+    """
+    import resource
+
+    bybit = Bybit_usdt_perpetual_kline(symbol="SANDUSDT", interval="1", start_date=start_date, end_date=end_date,
+                                       store_dir=store_dir, endpoint=endpoint, rate_limit=100000)
+    start = time.perf_counter()
+    if mode == "stream":
+        bybit.stream_to_store(symbol="SANDUSDT", interval="1")
+    else:
+        # every page kept in one list and converted at once, as kLine_downloader and _kLine_handler did
+        res_list = []
+        for page in bybit.kLine_page_generator(symbol="SANDUSDT", interval="1"):
+            res_list += page
+        bybit._kLine_handler(symbol="SANDUSDT", interval="1", data_list=res_list)
+    elapsed = time.perf_counter() - start
+    # kilobytes on Linux, bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 ** 2 if os.uname().sysname == "Darwin"
+                                                                     else 1024)
+    return elapsed, peak_rss, len(bybit.kline_store.read("SANDUSDT", "1")["open_time"])
+
+
+def benchmark_stream(start_date: str = "2019-06-01", end_date: str = "2022-06-01", latency: float = 0.0):
+    """
+    Peak RSS of a synthetic 1m download from bybit_stub_server, stream_to_store against all the pages kept
+    in one list, each in a fresh process
+    :param start_date:
+    :param end_date: 3 years of 1m klines by default
+    :param latency: seconds every stub response takes
+    """
+    import multiprocessing
+    import shutil
+    import tempfile
+    from concurrent.futures import ProcessPoolExecutor
+    from bybit_stub_server import start_stub_server
+
+    server, endpoint = start_stub_server(latency=latency)
+    try:
+        for mode in ("stream", "list"):
+            store_dir = tempfile.mkdtemp()
+            try:
+                with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("fork")) as executor:
+                    elapsed, peak_rss, kline_count = executor.submit(
+                        _benchmark_stream_mode, mode, endpoint, start_date, end_date, store_dir).result()
+            finally:
+                shutil.rmtree(store_dir, ignore_errors=True)
+            print(f"{mode:>6}: {kline_count} klines stored in {elapsed:.1f}s, peak RSS {peak_rss:.0f}MB")
+    finally:
+        server.shutdown()
 
 
 if __name__ == "__main__":
@@ -152,4 +509,6 @@ if __name__ == "__main__":
     interval = "30"
     bybit = Bybit_usdt_perpetual_kline(symbol=symbol, interval=interval, start_date=start_date, end_date=end_date)
     bybit.run()
+    # bybit.run_concurrent()
+    # bybit.sync()
     # historical_data(symbol=symbol, interval=interval, start_date=start_date, end_date=end_date).get_symbol_list()
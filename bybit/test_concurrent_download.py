@@ -0,0 +1,92 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("pybit")
+from historical_kline_downloader import Bybit_usdt_perpetual_kline
+from bybit_stub_server import start_stub_server
+
+symbol_list = ["SANDUSDT", "BTCUSDT"]
+interval_list = ["1", "15"]
+
+
+def make_downloader(store_dir: str, endpoint: str) -> Bybit_usdt_perpetual_kline:
+    return Bybit_usdt_perpetual_kline(symbol=symbol_list, interval=interval_list, start_date="2022-01-01",
+                                      end_date="2022-01-08", store_dir=store_dir, endpoint=endpoint, max_workers=8,
+                                      rate_limit=1000, max_retry=8, backoff=0.01)
+
+
+def page_list(downloader: Bybit_usdt_perpetual_kline) -> list:
+    return sorted((param["symbol"], param["interval"], param["from"]) for symbol in symbol_list
+                  for interval in interval_list for param in downloader.page_param_generator(symbol, interval))
+
+
+def expected_open_time(downloader: Bybit_usdt_perpetual_kline, interval: str) -> np.ndarray:
+    start_timestamp, end_timestamp = downloader.date_string_to_timestamp()
+    return np.arange(int(start_timestamp), int(end_timestamp), 60 * int(interval), dtype=np.int64)
+
+
+def test_run_concurrent_has_no_gap_and_no_duplicate_page(tmp_path):
+    server, endpoint = start_stub_server(latency=0.01, fail_rate=0.2)
+    downloader = make_downloader(str(tmp_path), endpoint)
+    try:
+        downloader.run_concurrent()
+    finally:
+        server.shutdown()
+    assert server.stats["fail"] > 0
+    assert downloader.failed_page_list == []
+    # every page served exactly once, the retried ones included
+    assert sorted(server.stats["served_page_list"]) == page_list(downloader)
+    for symbol in symbol_list:
+        for interval in interval_list:
+            expected = expected_open_time(downloader, interval)
+            # the pages overlap, the last full one may run past end_date
+            open_time = downloader.kline_store.read(symbol, interval, end=expected[-1] + 1)["open_time"]
+            np.testing.assert_array_equal(open_time, expected)
+
+
+def test_run_concurrent_reports_missing_page(tmp_path):
+    downloader = make_downloader(str(tmp_path), "")
+    missing_param = list(downloader.page_param_generator("SANDUSDT", "1"))[3]
+    missing_page = (missing_param["symbol"], missing_param["interval"], missing_param["from"])
+    server, endpoint = start_stub_server(latency=0.0, missing_page_set={missing_page})
+    downloader = make_downloader(str(tmp_path), endpoint)
+    try:
+        downloader.run_concurrent()
+    finally:
+        server.shutdown()
+    assert downloader.failed_page_list == [missing_param]
+    assert sorted(server.stats["served_page_list"]) == [page for page in page_list(downloader) if page != missing_page]
+    open_time = downloader.kline_store.read("SANDUSDT", "1")["open_time"]
+    missing_open_time = np.setdiff1d(expected_open_time(downloader, "1"), open_time)
+    assert len(missing_open_time) > 0 and len(np.unique(open_time)) == len(open_time)
+    assert missing_param["from"] <= missing_open_time.min() and \
+        missing_open_time.max() < missing_param["from"] + 60 * missing_param["limit"]
+
+
+def test_stream_to_store_raises_on_missing_page(tmp_path):
+    downloader = make_downloader(str(tmp_path), "")
+    missing_param = list(downloader.page_param_generator("SANDUSDT", "15"))[1]
+    missing_page = (missing_param["symbol"], missing_param["interval"], missing_param["from"])
+    server, endpoint = start_stub_server(latency=0.0, missing_page_set={missing_page})
+    downloader = make_downloader(str(tmp_path), endpoint)
+    downloader.max_retry = 2
+    try:
+        with pytest.raises(ValueError, match="1 pages failed, missing ranges: SANDUSDT 15"):
+            downloader.stream_to_store("SANDUSDT", "15")
+        assert downloader.failed_page_list == [missing_param]
+        # the list is emptied by the next call
+        assert downloader.stream_to_store("BTCUSDT", "15") > 0
+        assert downloader.failed_page_list == []
+        assert downloader.stream_to_store("SANDUSDT", "15", allow_partial=True) > 0
+        assert downloader.failed_page_list == [missing_param]
+        with pytest.raises(ValueError, match="missing ranges"):
+            downloader.run()
+    finally:
+        server.shutdown()
+    # the other symbols are still downloaded, every failed page is reported
+    assert downloader.failed_page_list == [missing_param]
+    assert len(downloader.kline_store.read("BTCUSDT", "1")["open_time"]) > 0
+    open_time = downloader.kline_store.read("SANDUSDT", "15")["open_time"]
+    missing_open_time = np.setdiff1d(expected_open_time(downloader, "15"), open_time)
+    assert len(missing_open_time) > 0 and missing_param["from"] <= missing_open_time.min() and \
+        missing_open_time.max() < missing_param["from"] + 900 * missing_param["limit"]
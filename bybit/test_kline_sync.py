@@ -0,0 +1,83 @@
+import json
+import numpy as np
+import pytest
+
+pytest.importorskip("pybit")
+from historical_kline_downloader import Bybit_usdt_perpetual_kline
+from bybit_stub_server import start_stub_server, canned_kline_list
+
+
+def make_downloader(store_dir: str, endpoint: str, symbol: list = ["SANDUSDT"], start_date: str = "2022-01-01",
+                    end_date: str = "2022-01-03") -> Bybit_usdt_perpetual_kline:
+    return Bybit_usdt_perpetual_kline(symbol=symbol, interval=["15"], start_date=start_date, end_date=end_date,
+                                      store_dir=store_dir, endpoint=endpoint, max_workers=4, rate_limit=1000,
+                                      max_retry=2, backoff=0.01)
+
+
+def window_open_time(downloader: Bybit_usdt_perpetual_kline) -> np.ndarray:
+    start_timestamp, end_timestamp, step = downloader._sync_window("15")
+    return np.arange(start_timestamp, end_timestamp, step, dtype=np.int64)
+
+
+def test_sync_fills_the_gap_and_a_second_sync_makes_no_request(tmp_path):
+    server, endpoint = start_stub_server(latency=0.0)
+    downloader = make_downloader(str(tmp_path), endpoint)
+    open_time = window_open_time(downloader)
+    kline_list = canned_kline_list("SANDUSDT", "15", int(open_time[0]), len(open_time))
+    downloader.kline_store.append("SANDUSDT", "15", kline_list[:50] + kline_list[80:])
+    try:
+        assert downloader.missing_range_list("SANDUSDT", "15") == [[int(open_time[50]), int(open_time[80])]]
+        downloader.sync()
+        assert server.stats["served_page_list"] == [("SANDUSDT", "15", int(open_time[50]))]
+        summary_df = make_downloader(str(tmp_path), endpoint).sync()
+    finally:
+        server.shutdown()
+    assert server.stats["request"] == 1
+    np.testing.assert_array_equal(downloader.kline_store.read("SANDUSDT", "15")["open_time"], open_time)
+    assert summary_df["coverage_pct"].tolist() == [100.0] and summary_df["gap_count"].tolist() == [0]
+
+
+def test_sync_resumes_the_pending_ranges_of_an_interrupted_run(tmp_path):
+    downloader = make_downloader(str(tmp_path), "", symbol=["SANDUSDT", "BTCUSDT"])
+    open_time = window_open_time(downloader)
+    missing_page = ("SANDUSDT", "15", int(open_time[0]))
+    server, endpoint = start_stub_server(latency=0.0, missing_page_set={missing_page})
+    try:
+        make_downloader(str(tmp_path), endpoint, symbol=["SANDUSDT", "BTCUSDT"]).sync()
+    finally:
+        server.shutdown()
+    with open(downloader._checkpoint_path()) as f:
+        checkpoint = json.load(f)
+    assert checkpoint["SANDUSDT_15"]["pending_range_list"] == [[int(open_time[0]), int(open_time[-1]) + 900]]
+    assert checkpoint["BTCUSDT_15"]["pending_range_list"] == []
+    server, endpoint = start_stub_server(latency=0.0)
+    try:
+        make_downloader(str(tmp_path), endpoint, symbol=["SANDUSDT", "BTCUSDT"]).sync()
+    finally:
+        server.shutdown()
+    # only the pages of the pending range are requested again
+    assert {page[0] for page in server.stats["served_page_list"]} == {"SANDUSDT"}
+    for symbol in ["SANDUSDT", "BTCUSDT"]:
+        np.testing.assert_array_equal(downloader.kline_store.read(symbol, "15")["open_time"], open_time)
+
+
+def test_sync_of_another_window_ignores_the_stale_pending_ranges(tmp_path):
+    downloader = make_downloader(str(tmp_path), "")
+    missing_page = ("SANDUSDT", "15", int(window_open_time(downloader)[0]))
+    server, endpoint = start_stub_server(latency=0.0, missing_page_set={missing_page})
+    try:
+        downloader = make_downloader(str(tmp_path), endpoint)
+        downloader.sync()
+    finally:
+        server.shutdown()
+    assert downloader._load_checkpoint()["SANDUSDT_15"]["pending_range_list"]
+    server, endpoint = start_stub_server(latency=0.0)
+    downloader = make_downloader(str(tmp_path), endpoint, start_date="2022-01-02", end_date="2022-01-04")
+    try:
+        downloader.sync()
+    finally:
+        server.shutdown()
+    open_time = window_open_time(downloader)
+    assert min(page[2] for page in server.stats["served_page_list"]) == open_time[0]
+    np.testing.assert_array_equal(downloader.kline_store.read("SANDUSDT", "15")["open_time"], open_time)
+    assert downloader._load_checkpoint()["SANDUSDT_15"]["pending_range_list"] == []
@@ -0,0 +1,7 @@
+"""
+The modules import each other from the repository root, as when they are run with it on PYTHONPATH
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
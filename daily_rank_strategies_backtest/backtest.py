@@ -1,8 +1,13 @@
 import time
+import numpy as np
 import pandas as pd
-import math
 from pprint import pprint
 import matplotlib.pyplot as plt
+from kline_store import KlineStore, default_store_dir
+from vectorized_engine import drawdown_pct
+from performance import DrawdownTracker, tear_sheet, split_tear_sheet
+from reporting import decimate, get_writer, report_name
+from execution_model import ExecutionModel
 
 pd.set_option('display.max_columns', 500)
 pd.set_option('display.max_rows', 500)
@@ -27,9 +32,20 @@ class Backtest:
         self.backtest_year = para_dict["backtest_year"]
         self.start_time = para_dict["start_time"]
         self.end_time = para_dict["end_time"]
+        self.kline_store_dir = para_dict.get("kline_store_dir", default_store_dir)
         self.time_spread = self.end_time - self.start_time
         self.taker_fee = 0.0008
+        # fees, slippage and funding of run_portfolio, every order filled at the close paying taker_fee by default
+        self.execution_model = para_dict.get("execution_model") or ExecutionModel(taker_fee=self.taker_fee,
+                                                                                 maker_fee=self.taker_fee)
         self.total_equity = self.initial_capital
+        self.verbose = para_dict.get("verbose", True)
+        # keep the per bar drawdown of run in self.drawdown_tracker.underwater_list
+        self.keep_drawdown_history = para_dict.get("keep_drawdown_history", False)
+        # write the plots, metrics and res_df there in the background instead of showing them
+        self.report_dir = para_dict.get("report_dir")
+        self.report_name = report_name(para_dict)
+        self.metrics = {}
 
     def get_mongo_kline(self, interval: str):
         """
@@ -38,10 +54,12 @@ class Backtest:
         df_dict = {}
         current_timestamp = time.time()
         start_from = time.time() - 60 * 60 * 24 * 365 * self.backtest_year
+        kline_store = KlineStore(self.kline_store_dir)
         if isinstance(self.symbol, list):
             for sym in self.symbol:
-                # TODO : GET DATA FROM YOUR OWN SOURCE, AND SAVE EACH SYMBOL TO df_dict[sym] correspondingly
-                df_dict[sym] = pd.DataFrame()
+                df_dict[sym] = kline_store.read_df(symbol=sym, interval=interval, start=start_from,
+                                                   end=current_timestamp)
+                df_dict[sym]['timestamp'] = df_dict[sym]['open_time'].to_numpy(copy=True)
                 # Stupid way to convert tiestamp to local timestamp
                 df_dict[sym]['timestamp'] += 60 * 60 * 8
                 df_dict[sym]["date_time"] = pd.to_datetime(df_dict[sym]['timestamp'], unit='s')
@@ -151,7 +169,11 @@ class Backtest:
 
         :return:
         """
-        dd_pct = 0
+        # mdd_pct is the max drawdown of the whole curve. Before DrawdownTracker, run reported the larger of the
+        # drawdowns of the last two bars only, so mdd_pct and calmar_ratio differ from the reports made back then
+        self.drawdown_tracker = DrawdownTracker(keep_history=self.keep_drawdown_history)
+        for total_equity in self.total_equity_list:
+            self.drawdown_tracker.update(total_equity)
         self.initialize_dictionary()
         for i in range(30, len(self.df)):
             current_datetime = self.df.loc[i, 'date_time']
@@ -162,39 +184,339 @@ class Backtest:
             # elif current_datetime.hour >= self.start_time & current_datetime.hour < self.end_time - 2:
             self.track_trading(i=i)
             self.total_equity_list.append(sum([equity[-1] for equity in list(self.equity_dict.values())]))
-            temp_max_equity = max(self.total_equity_list)
-            mdd_pct = max(dd_pct, (temp_max_equity - self.total_equity_list[-1]) / temp_max_equity)
-
-            dd_pct = (temp_max_equity - self.total_equity_list[-1]) / temp_max_equity
+            self.drawdown_tracker.update(self.total_equity_list[-1])
         date_list = self.df.loc[29:len(self.df) - 1, 'date_time'].to_list()
-        for i in range(1, len(self.total_equity_list) - 1):
-            if date_list[i].date() != date_list[i - 1].date():
-                self.daily_equity_value_list.append(self.total_equity_list[i - 1])
-
-        equity_value_series = pd.Series(self.daily_equity_value_list)
-        strategy_return_series = equity_value_series.pct_change()
-        return_mean_pct = 100 * strategy_return_series.mean()
-        return_sd_pct = 100 * strategy_return_series.std()
-        sharpe_ratio = return_mean_pct / return_sd_pct * math.sqrt(365)
-        neg_strategy_return_series = pd.Series(filter(lambda x: x < 0, strategy_return_series))
-        neg_return_sd_pct = 100 * neg_strategy_return_series.std()
-        sortino_ratio = return_mean_pct / neg_return_sd_pct * math.sqrt(365)
-        net_profit = (self.total_equity_list[-1] - self.total_equity_list[0]) / self.total_equity_list[0] * 100
-        mdd_pct *= 100
-        calmar_ratio = net_profit / mdd_pct
-        pprint(f"{sharpe_ratio = }, {mdd_pct = } , {sortino_ratio = } , {calmar_ratio = } , {net_profit = }")
-        res_df = pd.DataFrame({'datetime': date_list, "equity": self.total_equity_list})
-        fig, axes = plt.subplots(4, 1, figsize=(30, 30), sharex=True)
+        return self._report(date_list=date_list, total_equity_list=self.total_equity_list,
+                            mdd_pct=self.drawdown_tracker.max_drawdown)
+
+    def price_matrix(self, column: str) -> np.ndarray:
+        """
+
+        :param column: close or turnover
+        :return: (time x symbol) matrix ordered as self.symbol
+        """
+        return self.df[[f"{sym}_{column}" for sym in self.symbol]].to_numpy(dtype=np.float64)
+
+    def window_turnover(self, start_index_array: np.ndarray) -> np.ndarray:
+        """
+
+        :param start_index_array: bars where a trading day starts
+        :return: (day x symbol) turnover of the ranking window, the rows of self.df.iloc[i - 24: i - (24 - self.time_spread) + 2]
+        """
+        window_start = start_index_array - 24
+        window_index = window_start[:, None] + np.arange(self.time_spread + 2)[None, :]
+        return self.price_matrix("turnover")[window_index].sum(axis=1)
+
+    def turnover_weighted_return(self, start_index_array: np.ndarray) -> np.ndarray:
+        """
+        Default ranking score, the return over the ranking window weighted by the symbol's share of the turnover
+        :param start_index_array: bars where a trading day starts
+        :return: (day x symbol) score
+        """
+        close_matrix = self.price_matrix("close")
+        window_start = start_index_array - 24
+        turnover = self.window_turnover(start_index_array)
+        pct_change = (close_matrix[window_start + self.time_spread + 1] / close_matrix[window_start] - 1) * 100 \
+            * turnover
+        return pct_change / turnover.sum(axis=1, keepdims=True)
+
+    def rank_all_days(self, start_index_array: np.ndarray):
+        """
+        Turnover weighted returns and leg symbols of every trading day in one pass over the (time x symbol) matrices
+        :param start_index_array: bars where a trading day starts
+        :return: (day x leg) symbol column index, legs ordered as self.dict_keys_list
+        """
+        pct_change = self.turnover_weighted_return(start_index_array)
+        # ascending and stable, as sorting the pct_change dict
+        order = np.argsort(pct_change, axis=1, kind="stable")
+        btc = self.symbol.index(self.long_only_symbol)
+        btc_first = order[:, 0] == btc
+        btc_in_worst_two = btc_first | (order[:, 1] == btc)
+        worst = np.where(btc_first, order[:, 1], order[:, 0])
+        second_worst = np.where(btc_in_worst_two, order[:, 2], order[:, 1])
+        second_best = np.where(order[:, -1] == btc, order[:, -2], order[:, -1])
+        best = np.full(len(order), btc)
+        return np.stack((best, second_best, worst, second_worst), axis=1)
+
+    def run_vectorized(self):
+        """
+        Same backtest as run, with the rankings of all days computed at once
+        and the leg equity curves derived with array operations, only the daily open/close events are walked
+        :return:
+        """
+        n = len(self.df)
+        close_matrix = self.price_matrix("close")
+        hour = self.df['date_time'].dt.hour.to_numpy()
+        bar_index = np.arange(n)
+        is_start = (hour == self.start_time - 1) & (bar_index >= 30)
+        is_end = (hour == self.end_time - 1) & ~is_start & (bar_index >= 30)
+        start_index_array = np.flatnonzero(is_start)
+        leg_symbol = self.rank_all_days(start_index_array)
+        open_price = close_matrix[start_index_array[:, None], leg_symbol]
+        trading_lot = self.total_equity / 4 / open_price
+        # temp_capital after every open, walking only the open/close events
+        temp_capital_at_start = np.empty_like(open_price)
+        temp_capital = np.full(len(self.dict_keys_list), self.total_equity / 4)
+        start_ordinal = 0
+        for i in np.flatnonzero(is_start | is_end):
+            if is_start[i]:
+                temp_capital = temp_capital - trading_lot[start_ordinal] * open_price[start_ordinal] * self.taker_fee
+                temp_capital_at_start[start_ordinal] = temp_capital
+                start_ordinal += 1
+            else:
+                temp_capital = np.full(len(self.dict_keys_list), self.total_equity / 4)
+        last_start = np.maximum.accumulate(np.where(is_start, bar_index, -1))
+        last_end = np.maximum.accumulate(np.where(is_end, bar_index, -1))
+        in_position = (last_start > last_end) & (bar_index >= 30)
+        position_bar = np.flatnonzero(in_position)
+        ordinal = np.cumsum(is_start)[position_bar] - 1
+        close_price = close_matrix[position_bar[:, None], leg_symbol[ordinal]]
+        is_short = np.array(["worst" in ranking_type for ranking_type in self.dict_keys_list])
+        marked_equity = np.where(is_short,
+                                 temp_capital_at_start[ordinal] + (open_price[ordinal] - close_price) * trading_lot[ordinal],
+                                 temp_capital_at_start[ordinal] + (close_price - open_price[ordinal]) * trading_lot[ordinal])
+        # equity of the flat bars carries the last marked value forward, starting from the initial allocation
+        leg_equity = np.full((n - 29, len(self.dict_keys_list)), self.initial_capital / 4)
+        leg_equity[position_bar - 29] = marked_equity
+        last_marked = np.maximum.accumulate(np.where(np.append(False, in_position[30:]), np.arange(n - 29), 0))
+        leg_equity = leg_equity[last_marked]
+        self.equity_dict = {ranking_type: leg_equity[:, k] for k, ranking_type in enumerate(self.dict_keys_list)}
+        total_equity_array = np.zeros(n - 29)
+        for k in range(len(self.dict_keys_list)):
+            total_equity_array = total_equity_array + leg_equity[:, k]
+        total_equity_array[0] = self.initial_capital
+        self.total_equity_list = total_equity_array
+        date_list = self.df.loc[29:n - 1, 'date_time'].to_list()
+        return self._report(date_list=date_list, total_equity_list=total_equity_array,
+                            mdd_pct=np.max(drawdown_pct(total_equity_array)))
+
+    def position_matrix(self, score: np.ndarray, start_index_array: np.ndarray, n_long: int, n_short: int,
+                        weighting: str = "equal", long_only_symbol: str = None,
+                        volatility_window: int = 24 * 7) -> np.ndarray:
+        """
+        Signed capital weights of every trading day, long the n_long best scores and short the n_short worst
+        :param score: (day x symbol) ranking score
+        :param start_index_array: bars where a trading day starts
+        :param n_long:
+        :param n_short:
+        :param weighting: equal, turnover or inverse_volatility, applied within each side,
+        each side gets its share of the legs of the capital
+        :param long_only_symbol: symbol always held long in one of the n_long slots and never shorted
+        :param volatility_window: bars of hourly returns for inverse_volatility
+        :return: (day x symbol) weights, the absolute weights of a day sum to 1
+        """
+        if n_long + n_short > len(self.symbol) or n_long + n_short == 0:
+            raise ValueError(f"n_long + n_short should be between 1 and the {len(self.symbol)} symbols")
+        score = np.array(score, dtype=np.float64)
+        if long_only_symbol is not None:
+            score[:, self.symbol.index(long_only_symbol)] = np.inf
+        order = np.argsort(score, axis=1, kind="stable")
+        long_index = order[:, len(self.symbol) - n_long:]
+        short_index = order[:, :n_short]
+        if weighting == "equal":
+            size = np.ones(score.shape)
+        elif weighting == "turnover":
+            size = self.window_turnover(start_index_array)
+        elif weighting == "inverse_volatility":
+            close_matrix = self.price_matrix("close")
+            hourly_return = np.vstack((np.zeros((1, len(self.symbol))), close_matrix[1:] / close_matrix[:-1] - 1))
+            cumulative_return = np.vstack((np.zeros((1, len(self.symbol))), np.cumsum(hourly_return, axis=0)))
+            cumulative_square = np.vstack((np.zeros((1, len(self.symbol))), np.cumsum(hourly_return ** 2, axis=0)))
+            window_start = np.maximum(start_index_array - volatility_window, 1)
+            count = (start_index_array - window_start)[:, None]
+            window_sum = cumulative_return[start_index_array] - cumulative_return[window_start]
+            window_square = cumulative_square[start_index_array] - cumulative_square[window_start]
+            volatility = np.sqrt(np.maximum(window_square - window_sum ** 2 / count, 0) / np.maximum(count - 1, 1))
+            size = 1 / np.where(volatility > 0, volatility, np.nan)
+            # a symbol without volatility gets the largest size of its day, a day without any is equally weighted
+            all_nan = np.isnan(size).all(axis=1, keepdims=True)
+            size = np.where(np.isnan(size), np.nanmax(np.where(all_nan, 1.0, size), axis=1, keepdims=True), size)
+        else:
+            raise ValueError(f"weighting should be one of ['equal', 'turnover', 'inverse_volatility']")
+        weight_matrix = np.zeros(score.shape)
+        for side_index, side_share, sign in ((long_index, n_long / (n_long + n_short), 1),
+                                              (short_index, n_short / (n_long + n_short), -1)):
+            if side_index.shape[1] == 0:
+                continue
+            side_size = np.take_along_axis(size, side_index, axis=1)
+            np.put_along_axis(weight_matrix, side_index,
+                              sign * side_share * side_size / side_size.sum(axis=1, keepdims=True), axis=1)
+        return weight_matrix
+
+    def run_portfolio(self, n_long: int = 2, n_short: int = 2, weighting: str = "equal", score_function=None,
+                      long_only_symbol: str = None):
+        """
+        Daily rank portfolio with any number of long/short slots, backed by a (day x symbol) position matrix,
+        the equity compounds from day to day. Fees, slippage from the turnover of the fill bars and the funding
+        paid on the held bars come from self.execution_model
+        :param n_long:
+        :param n_short:
+        :param weighting: equal, turnover or inverse_volatility
+        :param score_function: called with (self, start_index_array), returns the (day x symbol) score,
+        default to Backtest.turnover_weighted_return
+        :param long_only_symbol: symbol always held long, as BTCUSDT in run
+        :return:
+        """
+        n = len(self.df)
+        close_matrix = self.price_matrix("close")
+        hour = self.df['date_time'].dt.hour.to_numpy()
+        bar_index = np.arange(n)
+        is_start = (hour == self.start_time - 1) & (bar_index >= 30)
+        is_end = (hour == self.end_time - 1) & ~is_start & (bar_index >= 30)
+        start_index_array = np.flatnonzero(is_start)
+        score_function = score_function or Backtest.turnover_weighted_return
+        weight_matrix = self.position_matrix(score_function(self, start_index_array), start_index_array,
+                                             n_long=n_long, n_short=n_short, weighting=weighting,
+                                             long_only_symbol=long_only_symbol)
+        self.weight_matrix = weight_matrix
+        # a day is closed at its first end bar, or at the next start bar if the end bar is missing
+        end_index_array = np.flatnonzero(is_end)
+        close_index_array = end_index_array[np.minimum(np.searchsorted(end_index_array, start_index_array),
+                                                       len(end_index_array) - 1)] if len(end_index_array) else \
+            np.full(len(start_index_array), n - 1)
+        next_start_array = np.append(start_index_array[1:], n - 1)
+        close_index_array = np.where((close_index_array > start_index_array) & (close_index_array <= next_start_array),
+                                     close_index_array, next_start_array)
+        open_close = close_matrix[start_index_array]
+        relative_price_at_close = close_matrix[close_index_array] / open_close
+        day_return = np.einsum("ds,ds->d", weight_matrix, relative_price_at_close - 1)
+        exit_turnover = np.einsum("ds,ds->d", np.abs(weight_matrix), relative_price_at_close)
+        model = self.execution_model
+        slippage_matrix = model.slippage(self.price_matrix("turnover"),
+                                         order_notional=self.initial_capital / (n_long + n_short))
+        # slippage and funding as fractions of the day's capital
+        entry_slippage = np.einsum("ds,ds->d", np.abs(weight_matrix), slippage_matrix[start_index_array]) * \
+            (model.entry_order == "taker")
+        exit_slippage = np.einsum("ds,ds->d", np.abs(weight_matrix) * relative_price_at_close,
+                                  slippage_matrix[close_index_array]) * (model.exit_order == "taker")
+        # mark every held bar from the position matrix of its day
+        day_of_bar = np.searchsorted(start_index_array, bar_index, side="right") - 1
+        held = (day_of_bar >= 0)
+        held[held] = bar_index[held] < close_index_array[day_of_bar[held]]
+        # funding of a bar is paid by the positions held into it, from the previous close
+        timestamp = self.df['date_time'].to_numpy(dtype="datetime64[s]").astype(np.int64) - 60 * 60 * 8
+        funding_matrix = np.column_stack([model.funding_rate_array(timestamp, symbol=sym) for sym in self.symbol])
+        funding_bar = np.flatnonzero(funding_matrix[1:].any(axis=1) & held[:-1]) + 1
+        funding_day = day_of_bar[funding_bar - 1]
+        bar_funding = np.zeros(n)
+        bar_funding[funding_bar] = np.einsum("bs,bs->b", weight_matrix[funding_day],
+                                             close_matrix[funding_bar - 1] / open_close[funding_day] *
+                                             funding_matrix[funding_bar])
+        cumulative_funding = np.cumsum(bar_funding)
+        day_funding = cumulative_funding[close_index_array] - cumulative_funding[start_index_array]
+        # compounding only needs one step per day
+        day_capital = np.empty(len(start_index_array))
+        equity_after_close = np.empty(len(start_index_array))
+        equity = self.initial_capital
+        for day in range(len(start_index_array)):
+            day_capital[day] = equity
+            equity = equity * (1 - model.entry_fee) + equity * day_return[day] - equity * exit_turnover[day] * \
+                model.exit_fee - equity * (entry_slippage[day] + exit_slippage[day] + day_funding[day])
+            equity_after_close[day] = equity
+        held_bar = np.flatnonzero(held)
+        held_day = day_of_bar[held_bar]
+        marked_return = np.einsum("bs,bs->b", weight_matrix[held_day],
+                                  close_matrix[held_bar] / open_close[held_day] - 1)
+        marked_cost = entry_slippage[held_day] + cumulative_funding[held_bar] - \
+            cumulative_funding[start_index_array[held_day]]
+        equity_array = np.full(n, np.nan)
+        equity_array[held_bar] = day_capital[held_day] * (1 - model.entry_fee) + day_capital[held_day] * \
+            marked_return - day_capital[held_day] * marked_cost
+        # a day closed at the next start bar is marked by the next day, opened in the same bar
+        closed_alone = ~np.isin(close_index_array, start_index_array)
+        equity_array[close_index_array[closed_alone]] = equity_after_close[closed_alone]
+        equity_array[:30] = self.initial_capital
+        # flat bars carry the last value forward
+        last_valid = np.maximum.accumulate(np.where(np.isnan(equity_array), 0, bar_index))
+        total_equity_array = equity_array[last_valid][29:]
+        self.total_equity_list = total_equity_array
+        self.equity_dict = {f"{n_long}_long_{n_short}_short": total_equity_array}
+        date_list = self.df.loc[29:n - 1, 'date_time'].to_list()
+        return self._report(date_list=date_list, total_equity_list=total_equity_array,
+                            mdd_pct=np.max(drawdown_pct(total_equity_array)))
+
+    def _report(self, date_list: list, total_equity_list, mdd_pct: float):
+        """
+
+        :param date_list:
+        :param total_equity_list:
+        :param mdd_pct: max drawdown as a fraction
+        :return:
+        """
+        total_equity_list = np.asarray(total_equity_list, dtype=np.float64)
+        date_array = pd.DatetimeIndex(date_list).to_numpy()
+        self.metrics, self.daily_equity_value_list, self.rolling_sharpe_list = split_tear_sheet(tear_sheet(
+            date_time=date_array, equity_value_array=total_equity_list,
+            initial_capital=self.initial_capital, mdd=mdd_pct))
+        res_df = pd.DataFrame({'datetime': date_array, "equity": total_equity_list})
+        curve_dict = {ranking_type: (date_array, np.asarray(equity_list, dtype=np.float64))
+                      for ranking_type, equity_list in self.equity_dict.items()}
+        curve_dict["equity"] = (date_array, total_equity_list / self.initial_capital)
+        if self.report_dir:
+            # run_portfolio results are named after their legs so they do not overwrite the ranking run
+            name = self.report_name if list(self.equity_dict) == self.dict_keys_list else \
+                f"{self.report_name}_{'_'.join(self.equity_dict)}"
+            get_writer(self.report_dir).submit(name, res_df, curve_dict, metrics=self.metrics)
+        if not self.verbose or self.report_dir:
+            return res_df
+        pprint(self.metrics)
+        fig, axes = plt.subplots(len(self.equity_dict), 1, figsize=(30, 30), sharex=True, squeeze=False)
+        axes = axes[:, 0]
         fig.tight_layout()
         for index, ranking_type in enumerate(list(self.equity_dict.keys())):
-            axes[index].plot(date_list, self.equity_dict[ranking_type], label=ranking_type)
+            axes[index].plot(*decimate(*curve_dict[ranking_type]), label=ranking_type)
         plt.show()
         plt.figure(figsize=(40, 20))
-        plt.plot(date_list, [i / self.initial_capital for i in self.total_equity_list])
+        plt.plot(*decimate(*curve_dict["equity"]))
         plt.show()
         return res_df
 
 
+def compare_run_mode(para_dict: dict, df: pd.DataFrame):
+    """
+    Assert that run_vectorized reproduces the bar loop of run bar for bar
+    :param para_dict:
+    :param df: klines in the layout of get_mongo_kline, date_time and the {symbol}_close, {symbol}_turnover columns
+    :return:
+    """
+    loop_backtest = Backtest(para_dict)
+    loop_backtest.df = df.copy()
+    loop_res_df = loop_backtest.run()
+    vectorized_backtest = Backtest(para_dict)
+    vectorized_backtest.df = df.copy()
+    vectorized_res_df = vectorized_backtest.run_vectorized()
+    pd.testing.assert_frame_equal(loop_res_df, vectorized_res_df, check_exact=True)
+    # the ratios of a flat curve are nan on both sides
+    assert pd.Series(loop_backtest.metrics).equals(pd.Series(vectorized_backtest.metrics)), \
+        (loop_backtest.metrics, vectorized_backtest.metrics)
+    return loop_res_df
+
+
+def benchmark_portfolio(symbol_count: int = 100, days: int = 365, leg_count_list: tuple = (2, 10, 50)):
+    """
+    Time run_portfolio on synthetic hourly klines with a growing number of legs
+    :param symbol_count:
+    :param days:
+    :param leg_count_list: total legs, split evenly between long and short
+    """
+    rng = np.random.default_rng(0)
+    n = days * 24
+    symbol_list = ["BTCUSDT"] + [f"SYM{i}USDT" for i in range(symbol_count - 1)]
+    data_dict = {"date_time": pd.date_range("2022-01-01", periods=n, freq="h")}
+    for sym in symbol_list:
+        data_dict[f"{sym}_close"] = 100 * np.exp(np.cumsum(rng.normal(0, 0.01, n)))
+        data_dict[f"{sym}_turnover"] = rng.uniform(1e5, 1e6, n)
+    backtest = Backtest({"symbol": symbol_list, "backtest_year": 1, "start_time": 8, "end_time": 16,
+                         "verbose": False})
+    backtest.df = pd.DataFrame(data_dict)
+    for leg_count in leg_count_list:
+        for weighting in ("equal", "turnover", "inverse_volatility"):
+            start = time.perf_counter()
+            backtest.run_portfolio(n_long=leg_count // 2, n_short=leg_count - leg_count // 2, weighting=weighting)
+            print(f"{leg_count:>3} legs, {weighting:<18} over {symbol_count} symbols x {n} bars: "
+                  f"{time.perf_counter() - start:.3f}s")
+
+
 if __name__ == "__main__":
     symbol = ["BTCUSDT", "ETHUSDT", "BNBUSDT", "ADAUSDT", "SOLUSDT", "DOGEUSDT", "DOTUSDT", "TRXUSDT", "AVAXUSDT",
               "XRPUSDT"]
@@ -203,4 +525,6 @@ if __name__ == "__main__":
     backtest = Backtest(para_dict)
     backtest.get_mongo_kline(interval=interval)
     save_csv = backtest.run()
+    # save_csv = backtest.run_portfolio(n_long=5, n_short=5, weighting="inverse_volatility")
+    # benchmark_portfolio()
 
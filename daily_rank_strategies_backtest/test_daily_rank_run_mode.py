@@ -0,0 +1,27 @@
+import numpy as np
+import pandas as pd
+import pytest
+from daily_rank_strategies_backtest.backtest import compare_run_mode
+
+symbol_list = ["BTCUSDT", "ETHUSDT", "BNBUSDT", "ADAUSDT", "SOLUSDT"]
+
+
+def synthetic_df(days: int = 40, missing_bar_list: tuple = ()) -> pd.DataFrame:
+    rng = np.random.default_rng(0)
+    n = days * 24
+    data_dict = {"date_time": pd.date_range("2022-01-01", periods=n, freq="h")}
+    for sym in symbol_list:
+        data_dict[f"{sym}_close"] = 100 * np.exp(np.cumsum(rng.normal(0, 0.01, n)))
+        data_dict[f"{sym}_turnover"] = rng.uniform(1e5, 1e6, n)
+    return pd.DataFrame(data_dict).drop(index=list(missing_bar_list)).reset_index(drop=True)
+
+
+@pytest.mark.parametrize("start_time, end_time, missing_bar_list", [
+    (8, 16, ()), (7, 23, ()), (12, 13, ()),
+    # a day without its end bar and a day without its start bar
+    (8, 16, (24 * 5 + 15, 24 * 9 + 7))])
+def test_run_vectorized_matches_run(start_time, end_time, missing_bar_list):
+    para_dict = {"strategy_name": "daily_rank", "start_time": start_time, "end_time": end_time,
+                 "backtest_year": 1, "symbol": symbol_list, "verbose": False}
+    res_df = compare_run_mode(para_dict=para_dict, df=synthetic_df(missing_bar_list=missing_bar_list))
+    assert res_df["equity"].nunique() > 1
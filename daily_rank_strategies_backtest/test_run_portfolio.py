@@ -0,0 +1,92 @@
+import warnings
+import numpy as np
+import pandas as pd
+import pytest
+from daily_rank_strategies_backtest.backtest import Backtest
+from execution_model import ExecutionModel
+
+symbol_list = ["BTCUSDT", "ETHUSDT", "BNBUSDT", "ADAUSDT", "SOLUSDT"]
+# start_time 8 and end_time 16 open at the bar of hour 7 and close at the bar of hour 15
+start_bar_list = [31, 55, 79]
+score = np.array([[5.0, 1.0, 4.0, 2.0, 3.0], [1.0, 2.0, 3.0, 4.0, 5.0], [3.0, 5.0, 1.0, 4.0, 2.0]])
+
+
+def make_backtest(days: int = 4, flat_bar_count: int = 0, missing_bar_list: tuple = (),
+                  execution_model: ExecutionModel = None) -> Backtest:
+    rng = np.random.default_rng(1)
+    n = days * 24
+    data_dict = {"date_time": pd.date_range("2022-01-01", periods=n, freq="h")}
+    for k, sym in enumerate(symbol_list):
+        hourly_return = rng.normal(0, 0.01 * (k + 1), n)
+        hourly_return[:flat_bar_count] = 0
+        data_dict[f"{sym}_close"] = 100 * np.exp(np.cumsum(hourly_return))
+        data_dict[f"{sym}_turnover"] = np.full(n, 1000.0 * (k + 1))
+    backtest = Backtest({"symbol": symbol_list, "backtest_year": 1, "start_time": 8, "end_time": 16,
+                         "verbose": False, "execution_model": execution_model})
+    backtest.df = pd.DataFrame(data_dict).drop(index=list(missing_bar_list)).reset_index(drop=True)
+    return backtest
+
+
+def fixed_score(backtest: Backtest, start_index_array: np.ndarray) -> np.ndarray:
+    return score[:len(start_index_array)]
+
+
+@pytest.mark.parametrize("n_long, n_short", [(2, 1), (1, 3), (3, 0), (0, 2)])
+def test_long_the_best_and_short_the_worst(n_long, n_short):
+    backtest = make_backtest()
+    backtest.run_portfolio(n_long=n_long, n_short=n_short, score_function=fixed_score)
+    order = np.argsort(score, axis=1)
+    for day, weight in enumerate(backtest.weight_matrix):
+        np.testing.assert_allclose(weight[order[day][len(symbol_list) - n_long:]], 1 / (n_long + n_short))
+        np.testing.assert_allclose(weight[order[day][:n_short]], -1 / (n_long + n_short))
+        assert np.count_nonzero(weight) == n_long + n_short
+
+
+def test_long_only_symbol_is_always_held_long():
+    backtest = make_backtest()
+    backtest.run_portfolio(n_long=2, n_short=2, score_function=fixed_score, long_only_symbol="BTCUSDT")
+    # BTCUSDT has the worst score of the second day
+    np.testing.assert_allclose(backtest.weight_matrix[:, 0], 0.25)
+    np.testing.assert_allclose(backtest.weight_matrix[1], [0.25, -0.25, -0.25, 0.0, 0.25])
+
+
+def test_turnover_weighting():
+    backtest = make_backtest()
+    backtest.run_portfolio(n_long=2, n_short=2, weighting="turnover", score_function=fixed_score)
+    # the turnover of a symbol is proportional to its position in symbol_list
+    np.testing.assert_allclose(backtest.weight_matrix[0], [0.5 * 1 / 4, -0.5 * 2 / 6, 0.5 * 3 / 4, -0.5 * 4 / 6, 0.0])
+
+
+def test_inverse_volatility_weighting():
+    backtest = make_backtest(flat_bar_count=start_bar_list[0] + 1)
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        backtest.run_portfolio(n_long=2, n_short=2, weighting="inverse_volatility", score_function=fixed_score)
+    # no volatility before the first day, equal weights
+    np.testing.assert_allclose(backtest.weight_matrix[0], [0.25, -0.25, 0.25, -0.25, 0.0])
+    close_matrix = backtest.price_matrix("close")
+    hourly_return = close_matrix[1:] / close_matrix[:-1] - 1
+    for day in (1, 2):
+        start = start_bar_list[day]
+        inverse_volatility = 1 / np.std(hourly_return[:start - 1], axis=0, ddof=1)
+        weight = backtest.weight_matrix[day]
+        for side in (weight > 0, weight < 0):
+            np.testing.assert_allclose(weight[side], np.sign(weight[side]) * 0.5 * inverse_volatility[side] /
+                                       inverse_volatility[side].sum())
+
+
+def test_missing_end_bar_closes_at_the_next_start():
+    fee = 0.001
+    end_bar = start_bar_list[0] + 8
+    backtest = make_backtest(missing_bar_list=(end_bar,),
+                             execution_model=ExecutionModel(taker_fee=fee, maker_fee=fee))
+    res_df = backtest.run_portfolio(n_long=1, n_short=0, score_function=lambda self, start: score[:len(start)])
+    close = backtest.df["BTCUSDT_close"].to_numpy()
+    # the first day is held until the next start bar, one row earlier once the end bar is dropped
+    next_start = start_bar_list[1] - 1
+    day_return = close[next_start] / close[start_bar_list[0]] - 1
+    equity_after_close = 10000 * (1 - fee) + 10000 * day_return - 10000 * (1 + day_return) * fee
+    # the bar closes the first day and opens the second, it shows the second day after its entry fee
+    assert res_df["equity"].iloc[next_start - 29] == pytest.approx(equity_after_close * (1 - fee))
+    assert res_df["equity"].iloc[next_start - 30] == pytest.approx(10000 * (1 - fee) + 10000 * (
+        close[next_start - 1] / close[start_bar_list[0]] - 1))
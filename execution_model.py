@@ -0,0 +1,199 @@
+"""
+Fill and fee model of the backtests, turned into per bar arrays once so the state machines only look them up:
+maker/taker fees, slippage growing with the order size relative to the bar turnover,
+funding paid every 8 hours on the open positions of a perpetual, and stop losses filled inside the bar
+"""
+import numpy as np
+import pandas as pd
+
+# (maker fee, taker fee) per fee tier of USDT perpetuals, keep in line with the exchange fee schedule
+fee_tier_dict = {"VIP0": (0.0002, 0.00055), "VIP1": (0.00018, 0.0004), "VIP2": (0.00016, 0.000375),
+                 "VIP3": (0.00014, 0.00035), "VIP4": (0.00012, 0.00032), "VIP5": (0.0001, 0.00032)}
+
+funding_interval = 8 * 60 * 60
+
+
+class ExecutionModel:
+    def __init__(self, taker_fee: float = 0.00055, maker_fee: float = 0.0002, entry_order: str = "taker",
+                 exit_order: str = "taker", spread: float = 0.0, impact_coefficient: float = 0.0,
+                 max_slippage: float = 0.01, funding_rate=None, intrabar_stop: bool = False):
+        """
+
+        :param taker_fee:
+        :param maker_fee: negative for a rebate
+        :param entry_order: "taker" or "maker", fee paid to open a position
+        :param exit_order: "taker" or "maker", fee paid to close a position on a signal, stop losses are always taker
+        :param spread: bid-ask spread as a fraction of the price, half of it is paid on every taker fill
+        :param impact_coefficient: slippage of an order worth the whole bar turnover, grows with the square root
+        of the order size over the bar turnover
+        :param max_slippage: cap of the slippage of one fill
+        :param funding_rate: None, a constant rate paid every 8 hours, a Series of rates indexed by funding time,
+        or a dict of symbol to either
+        :param intrabar_stop: fill stop losses at the stop price when the bar high/low crosses it,
+        instead of at the close of the bar
+        """
+        for order in (entry_order, exit_order):
+            if order not in ("taker", "maker"):
+                raise ValueError(f"order type should be taker or maker, got {order}")
+        self.taker_fee = taker_fee
+        self.maker_fee = maker_fee
+        self.entry_order = entry_order
+        self.exit_order = exit_order
+        self.spread = spread
+        self.impact_coefficient = impact_coefficient
+        self.max_slippage = max_slippage
+        self.funding_rate = funding_rate
+        self.intrabar_stop = intrabar_stop
+
+    @classmethod
+    def from_tier(cls, tier: str, **kwargs):
+        """
+
+        :param tier: key of fee_tier_dict
+        :param kwargs: other ExecutionModel arguments
+        :return:
+        """
+        maker_fee, taker_fee = fee_tier_dict[tier]
+        return cls(taker_fee=taker_fee, maker_fee=maker_fee, **kwargs)
+
+    @property
+    def entry_fee(self) -> float:
+        return self.taker_fee if self.entry_order == "taker" else self.maker_fee
+
+    @property
+    def exit_fee(self) -> float:
+        return self.taker_fee if self.exit_order == "taker" else self.maker_fee
+
+    def slippage(self, turnover, order_notional: float) -> np.ndarray:
+        """
+        Fraction of the price lost on a taker fill of every bar, half the spread plus a square root market impact
+        :param turnover: traded value of every bar, NaN or 0 when unknown only costs the spread
+        :param order_notional: typical order value
+        :return:
+        """
+        turnover = np.asarray(turnover, dtype=np.float64)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            impact = self.impact_coefficient * np.sqrt(order_notional / turnover)
+        impact = np.where(np.isfinite(impact), impact, 0.0)
+        return np.minimum(self.spread / 2 + impact, self.max_slippage)
+
+    def funding_rate_array(self, timestamp, symbol: str = None) -> np.ndarray:
+        """
+        Funding rate charged at every bar, on the first bar opening at or after each funding time
+        :param timestamp: bar open time in seconds
+        :param symbol: picks the rate when funding_rate is a dict of symbol to rates
+        :return: zero on the bars without funding
+        """
+        timestamp = np.asarray(timestamp, dtype=np.int64)
+        res = np.zeros(len(timestamp))
+        funding_rate = self.funding_rate.get(symbol) if isinstance(self.funding_rate, dict) else self.funding_rate
+        if funding_rate is None or len(timestamp) == 0:
+            return res
+        if isinstance(funding_rate, pd.Series):
+            funding_time = funding_rate.index
+            if isinstance(funding_time, pd.DatetimeIndex):
+                funding_time = funding_time.as_unit("s").asi8
+            funding_time = np.asarray(funding_time, dtype=np.int64)
+            rate = funding_rate.to_numpy(dtype=np.float64)
+        else:
+            first_funding_time = -(-int(timestamp[0]) // funding_interval) * funding_interval
+            funding_time = np.arange(first_funding_time, int(timestamp[-1]) + 1, funding_interval, dtype=np.int64)
+            rate = np.full(len(funding_time), float(funding_rate))
+        in_range = (funding_time >= timestamp[0]) & (funding_time <= timestamp[-1])
+        np.add.at(res, np.searchsorted(timestamp, funding_time[in_range], side="left"), rate[in_range])
+        return res
+
+    def bar_arrays(self, timestamp, open_price, high, low, close, turnover=None, order_notional: float = 0.0,
+                   symbol: str = None) -> dict:
+        """
+        Everything the state machines need from the model
+        :param timestamp: bar open time in seconds
+        :param open_price: open price of every bar, or (time x symbol) open price matrix, as are the other prices
+        :param high:
+        :param low:
+        :param close:
+        :param turnover: traded value of every bar, None when unknown
+        :param order_notional: typical order value for the market impact
+        :param symbol: symbol of the funding rate, one symbol per column for (time x symbol) prices
+        :return:
+        """
+        close = np.asarray(close, dtype=np.float64)
+        taker_slippage = self.slippage(np.full(close.shape, np.nan) if turnover is None else turnover,
+                                       order_notional)
+        if close.ndim == 2:
+            funding_rate = np.column_stack([self.funding_rate_array(timestamp, symbol=column_symbol)
+                                            for column_symbol in symbol])
+        else:
+            funding_rate = self.funding_rate_array(timestamp, symbol=symbol)
+        return {"bar_open": np.asarray(open_price, dtype=np.float64), "high": np.asarray(high, dtype=np.float64),
+                "low": np.asarray(low, dtype=np.float64), "slippage": taker_slippage,
+                "funding_rate": funding_rate, "entry_fee": self.entry_fee,
+                "exit_fee": self.exit_fee, "stop_fee": self.taker_fee, "intrabar_stop": self.intrabar_stop,
+                # maker orders rest in the book and do not pay the spread
+                "entry_slippage_scale": 1.0 if self.entry_order == "taker" else 0.0,
+                "exit_slippage_scale": 1.0 if self.exit_order == "taker" else 0.0}
+
+    def kline_arrays(self, df, order_notional: float = 0.0, utc_offset: int = 0, symbol: str = None) -> dict:
+        """
+        bar_arrays of a Backtest kline DataFrame
+        :param df: kline with date_time, open, high, low, close and optionally turnover columns
+        :param order_notional: typical order value for the market impact
+        :param utc_offset: seconds date_time is ahead of UTC, funding times are in UTC
+        :param symbol: symbol of the funding rate
+        :return:
+        """
+        timestamp = df["date_time"].to_numpy(dtype="datetime64[s]").astype(np.int64) - utc_offset
+        return self.bar_arrays(timestamp, df["open"], df["high"], df["low"], df["close"],
+                               turnover=df["turnover"] if "turnover" in df else None,
+                               order_notional=order_notional, symbol=symbol)
+
+
+def close_fill_arrays(close, fee: float) -> dict:
+    """
+    Bar arrays of the original fill model, every fill at the close with one flat fee and no funding
+    :param close:
+    :param fee:
+    :return:
+    """
+    close = np.asarray(close, dtype=np.float64)
+    return {"bar_open": close, "high": close, "low": close, "slippage": np.zeros(close.shape),
+            "funding_rate": np.zeros(close.shape), "entry_fee": fee, "exit_fee": fee, "stop_fee": fee,
+            "intrabar_stop": False, "entry_slippage_scale": 1.0, "exit_slippage_scale": 1.0}
+
+
+def benchmark(n: int = 35040, repeat: int = 5):
+    """
+    Time the position state machine with the original close fills against a full execution model,
+    on random signals over 1 year of 15m klines
+    :param n:
+    :param repeat:
+    """
+    import time
+    from vectorized_engine import run_position_state_machine
+
+    rng = np.random.default_rng(0)
+    close = 100 * np.exp(np.cumsum(rng.normal(0, 0.003, n)))
+    open_price = np.append(close[0], close[:-1])
+    spread = close * rng.uniform(0, 0.004, n)
+    timestamp = 1640995200 + 900 * np.arange(n, dtype=np.int64)
+    signal_list = [rng.random(n) < 0.02 for _ in range(4)]
+    model = ExecutionModel.from_tier("VIP0", spread=0.0004, impact_coefficient=0.005, funding_rate=0.0001,
+                                     intrabar_stop=True)
+    for label, make_execution in (("close fills", lambda: None),
+                                  ("execution model", lambda: model.bar_arrays(
+                                      timestamp, open_price, np.maximum(open_price, close) + spread,
+                                      np.minimum(open_price, close) - spread, close,
+                                      turnover=rng.uniform(1e5, 1e6, n), order_notional=10000))):
+        best = float("inf")
+        for _ in range(repeat):
+            start = time.perf_counter()
+            equity_value_array, _, win_count, lose_count = run_position_state_machine(
+                close, *signal_list, hold_previous=np.zeros(n, dtype=bool), initial_capital=10000.0, stop_loss=1,
+                invest_percentage=100, taker_fee=0.00055, execution=make_execution())
+            best = min(best, time.perf_counter() - start)
+        print(f"{label:<16} {n} bars in {best * 1000:.1f}ms, {win_count + lose_count} trades, "
+              f"final equity {equity_value_array[-1]:.2f}")
+
+
+if __name__ == "__main__":
+    benchmark()
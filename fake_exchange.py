@@ -0,0 +1,174 @@
+"""
+Local stand-in of the Bybit USDT perpetual API for the live runtime: a random walk kline stream,
+a top of book stream around the last price, market orders filled at the last close with take profit and stop loss triggers, and pybit shaped responses,
+every call delayed by a configurable latency, and a private stream of the order, execution and position messages
+"""
+import asyncio
+import random
+import time
+
+
+class FakeExchange:
+    def __init__(self, symbol: str = "BTCUSDT", kline_count: int = 1000, kline_interval: float = 0.0,
+                 latency: float = 0.05, latency_jitter: float = 0.0, slow_call_rate: float = 0.0,
+                 slow_call_latency: float = 1.0, start_price: float = 100.0, volatility: float = 0.003,
+                 orderbook_interval: float = 0.01, spread: float = 0.0002, event_latency: float = 0.002,
+                 drop_event_rate: float = 0.0, seed: int = 0):
+        """
+
+        :param symbol:
+        :param kline_count: number of klines streamed before kline_stream ends
+        :param kline_interval: seconds between two klines
+        :param latency: seconds every request takes
+        :param latency_jitter: uniform random seconds added to the latency
+        :param slow_call_rate: probability of a request taking slow_call_latency instead, to exercise the timeouts
+        :param slow_call_latency:
+        :param start_price:
+        :param volatility: standard deviation of the kline returns
+        :param orderbook_interval: seconds between two orderbook messages
+        :param spread: bid-ask spread as a fraction of the last price
+        :param event_latency: seconds a private message takes after its fill
+        :param drop_event_rate: probability of a private message being lost, to exercise the reconciliation
+        :param seed:
+        """
+        self.symbol = symbol
+        self.kline_count = kline_count
+        self.kline_interval = kline_interval
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.slow_call_rate = slow_call_rate
+        self.slow_call_latency = slow_call_latency
+        self.volatility = volatility
+        self.orderbook_interval = orderbook_interval
+        self.spread = spread
+        self.event_latency = event_latency
+        self.drop_event_rate = drop_event_rate
+        self.random = random.Random(seed)
+        self.last_price = start_price
+        # one-way mode position, positive for long and negative for short
+        self.position_size = 0.0
+        self.take_profit = None
+        self.stop_loss = None
+        self.order_list = []
+        self.call_count_dict = {"place_active_order": 0, "my_position": 0}
+        self.event_queue = asyncio.Queue()
+
+    async def _delay(self):
+        if self.slow_call_rate and self.random.random() < self.slow_call_rate:
+            await asyncio.sleep(self.slow_call_latency)
+        else:
+            await asyncio.sleep(self.latency + self.random.uniform(0, self.latency_jitter))
+
+    async def kline_stream(self):
+        """
+        Random walk klines, the take profit and stop loss of the position are triggered by the kline high/low
+        :return: async iterator of kline dicts with open_time, open, high, low and close
+        """
+        open_time = int(time.time()) // 60 * 60
+        for i in range(self.kline_count):
+            if i:
+                await asyncio.sleep(self.kline_interval)
+            open_price = self.last_price
+            close = open_price * (1 + self.random.gauss(0, self.volatility))
+            high = max(open_price, close) * (1 + abs(self.random.gauss(0, self.volatility / 2)))
+            low = min(open_price, close) * (1 - abs(self.random.gauss(0, self.volatility / 2)))
+            self.last_price = close
+            self._trigger(high=high, low=low)
+            yield {"symbol": self.symbol, "open_time": open_time + 60 * i, "open": open_price, "high": high,
+                   "low": low, "close": close}
+
+    async def orderbook_stream(self):
+        """
+        Best bid and ask around the last price, in the message layout of the orderbook feed, until cancelled
+        :return: async iterator of [{"bid": [[price, size]], "ask": [[price, size]]}]
+        """
+        while True:
+            half_spread = self.last_price * self.spread / 2
+            yield [{"bid": [[self.last_price - half_spread, 1.0]], "ask": [[self.last_price + half_spread, 1.0]]}]
+            await asyncio.sleep(self.orderbook_interval)
+
+    async def private_stream(self):
+        """
+        Order, execution and position messages of every fill, in the layout of the private websocket topics,
+        until cancelled
+        :return: async iterator of {"topic": ..., "data": [...]}
+        """
+        while True:
+            message = await self.event_queue.get()
+            await asyncio.sleep(self.event_latency)
+            yield message
+
+    def _push_fill(self, order: dict):
+        side = "Buy" if self.position_size > 0 else "Sell" if self.position_size < 0 else "None"
+        for message in ({"topic": "order", "data": [{"order_id": order["order_id"], "symbol": self.symbol,
+                                                     "side": order["side"], "order_status": "Filled",
+                                                     "qty": order["qty"], "cum_exec_qty": order["qty"]}]},
+                        {"topic": "execution", "data": [{"order_id": order["order_id"], "symbol": self.symbol,
+                                                         "side": order["side"], "exec_qty": order["qty"],
+                                                         "price": order["price"]}]},
+                        {"topic": "position", "data": [{"symbol": self.symbol, "side": side,
+                                                        "size": abs(self.position_size)}]}):
+            if not (self.drop_event_rate and self.random.random() < self.drop_event_rate):
+                self.event_queue.put_nowait(message)
+
+    def _trigger(self, high: float, low: float):
+        if self.position_size > 0:
+            stop_hit = self.stop_loss is not None and low <= self.stop_loss
+            take_profit_hit = self.take_profit is not None and high >= self.take_profit
+        elif self.position_size < 0:
+            stop_hit = self.stop_loss is not None and high >= self.stop_loss
+            take_profit_hit = self.take_profit is not None and low <= self.take_profit
+        else:
+            return
+        # the stop is assumed to trigger first when the kline crosses both
+        if stop_hit or take_profit_hit:
+            order = {"order_id": f"fake-{len(self.order_list)}", "side": "Sell" if self.position_size > 0 else "Buy",
+                     "qty": abs(self.position_size), "price": self.stop_loss if stop_hit else self.take_profit,
+                     "trigger": True}
+            self.order_list.append(order)
+            self._set_position(0.0)
+            self._push_fill(order)
+
+    def _set_position(self, size: float):
+        self.position_size = size
+        if size == 0:
+            self.take_profit = None
+            self.stop_loss = None
+
+    async def place_active_order(self, symbol: str, side: str, order_type: str, qty: float,
+                                 reduce_only: bool = False, take_profit: float = None, stop_loss: float = None,
+                                 **kwargs) -> dict:
+        """
+        Market order filled at the last close, same arguments and response layout as pybit
+        :return:
+        """
+        self.call_count_dict["place_active_order"] += 1
+        await self._delay()
+        signed_qty = qty if side == "Buy" else -qty
+        if reduce_only:
+            if self.position_size == 0 or (self.position_size > 0) == (signed_qty > 0):
+                return {"ret_code": 130125, "ret_msg": "current position is zero, cannot fix reduce-only order qty",
+                        "result": None}
+            if abs(signed_qty) > abs(self.position_size):
+                signed_qty = -self.position_size
+        self._set_position(self.position_size + signed_qty)
+        if not reduce_only and self.position_size != 0:
+            self.take_profit = take_profit
+            self.stop_loss = stop_loss
+        order = {"order_id": f"fake-{len(self.order_list)}", "symbol": symbol, "side": side,
+                 "order_type": order_type, "qty": abs(signed_qty), "price": self.last_price,
+                 "order_link_id": kwargs.get("order_link_id"), "trigger": False}
+        self.order_list.append(order)
+        self._push_fill(order)
+        return {"ret_code": 0, "ret_msg": "OK", "result": order}
+
+    async def my_position(self, symbol: str) -> dict:
+        """
+        Both sides of the one-way mode position, as pybit returns them
+        :return:
+        """
+        self.call_count_dict["my_position"] += 1
+        await self._delay()
+        return {"ret_code": 0, "ret_msg": "OK",
+                "result": [{"symbol": symbol, "side": "Buy", "size": max(self.position_size, 0.0)},
+                           {"symbol": symbol, "side": "Sell", "size": max(-self.position_size, 0.0)}]}
@@ -1,46 +1,140 @@
 import requests
 import pandas as pd
 import json
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import time
 import random
-from requests.exceptions import HTTPError
+from requests.adapters import HTTPAdapter
+from glassnode_cache import GlassnodeCache, default_cache_dir
+from glassnode_metric import metric_registry, validate_metric, decode_point_list, decode_raw, metric_frame, \
+    parse_json, supported_asset_list, supported_interval_list
+from rate_limiter import TokenBucket
 
 class glassnodeConsumer:
-    def __init__(self):
-        self.base_url = 'https://api.glassnode.com/'
+    def __init__(self, cache_dir: str = default_cache_dir, tail_ttl: float = 3600,
+                 base_url: str = 'https://api.glassnode.com/', max_workers: int = 8, rate_limit: float = 10,
+                 max_retry: int = 5, backoff: float = 0.5):
+        """
+
+        :param cache_dir: directory of the persistent response cache, None to always request the API
+        :param tail_ttl: seconds the cached still-open recent bars are served before being requested again
+        :param base_url: Glassnode API url, point it to glassnode_stub_server for testing
+        :param max_workers: number of requests in flight in get_bulk
+        :param rate_limit: requests per second, the limit of the Glassnode API plan
+        :param max_retry: attempts per request on connection errors, 429 and 5xx responses
+        :param backoff: first retry delay in seconds, doubled after every failed attempt
+        """
+        self.base_url = base_url
         # TODO : Please input your own Glassnode api key
         self.api_key = ''
+        self.cache = GlassnodeCache(cache_dir=cache_dir, tail_ttl=tail_ttl) if cache_dir else None
+        self.max_workers = max_workers
+        self.max_retry = max_retry
+        self.backoff = backoff
+        self.rate_limiter = TokenBucket(rate=rate_limit, capacity=max(1, int(rate_limit)))
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.failed_request_list = []
 
-    def get_api_request(self, from_date: str, to_date: str, symbol:str, category: str, interval: str, topic: str) -> pd.DataFrame:
+    def request_metric(self, from_date, to_date, symbol: str, category: str, interval: str, topic: str) -> bytes:
+        """
+        One API request over the pooled session under the rate limit, the raw JSON body of the points
+        between from_date and to_date
+        """
+        params = {'a':symbol,'api_key':self.api_key,'s':from_date, 'u':to_date,'i':interval, 'f':'JSON'}
+        for attempt in range(self.max_retry):
+            self.rate_limiter.acquire()
+            try:
+                x = self.session.get(url=f'{self.base_url}v1/metrics/{category}/{topic}', params=params, timeout=30)
+            except requests.exceptions.RequestException as err:
+                print(f'Request error occurred: {err}')
+            else:
+                if x.status_code == 400:
+                    raise RuntimeError(f'status code: 400, error occurred')
+                elif x.status_code == 404:
+                    raise ValueError(f'status code: 404, error occurred')
+                elif x.status_code != 429 and x.status_code < 500:
+                    return x.content
+                print(f'status code: {x.status_code}, retrying')
+            if attempt < self.max_retry - 1:
+                time.sleep(self.backoff * 2 ** attempt * random.uniform(1, 1.5))
+        raise RuntimeError(f'Fail to request {category}/{topic} of {symbol} after {self.max_retry} attempts')
+
+    @staticmethod
+    def request_range(from_date: str, to_date: str):
+        """
+        Unix timestamps of the YYYY-MM-DD dates, each converted on its own, an empty date is None
+        and left out of the request
+        """
+        timestamp_list = []
+        for date_string in (from_date, to_date):
+            try:
+                timestamp_list.append(glassnodeConsumer.string_to_unix_timestamp(date_string) if date_string else None)
+            except ValueError as err:
+                raise ValueError(f'The format of the date string should follow YYYY-MM-DD : {err}') from err
+        return tuple(timestamp_list)
+
+    def get_point_list(self, from_date: str, to_date: str, symbol: str, category: str, interval: str,
+                       topic: str) -> list:
+        """
+        Points of a metric from the cache or the API, every response body parsed once
+        """
         if not symbol:
             raise Exception('symbol can not be empty')
-        try:
-            from_date = glassnodeConsumer.string_to_unix_timestamp(from_date)
-            to_date   = glassnodeConsumer.string_to_unix_timestamp(to_date)
-        except ValueError as err:
-            if from_date == '' or to_date == '':
-                pass
-            else:
-                print(f'The format of the date string should follow YYYY-MM-DD : {err}')
-        try:
-            x = requests.get(url=f'{self.base_url}v1/metrics/{category}/{topic}', params={'a':symbol,'api_key':self.api_key,'s':from_date, 'u':to_date,'i':interval, 'f':'JSON'})
-        except HTTPError as http_err:
-            print(f'HTTP error occurred: {http_err}')
-        except Exception as err:
-            print(f'Other error occurred: {err}')
-        if x.status_code == 400:
-            raise RuntimeError(f'status code: 400, error occurred')
-        elif x.status_code == 404:
-            raise ValueError(f'status code: 404, error occurred')
-        raw_text = x.text
-        print(raw_text)
-        if not json.loads(raw_text) :
+        from_date, to_date = glassnodeConsumer.request_range(from_date, to_date)
+        if self.cache is None:
+            point_list = parse_json(self.request_metric(from_date=from_date, to_date=to_date, symbol=symbol,
+                                                        category=category, interval=interval, topic=topic))
+        else:
+            # an empty date is the whole history, up to now
+            point_list = self.cache.get(category=category, topic=topic, asset=symbol, interval=interval,
+                                        start=from_date if from_date is not None else 0,
+                                        end=to_date if to_date is not None else int(time.time()),
+                                        fetch=lambda start, end: parse_json(self.request_metric(
+                                            from_date=start, to_date=end, symbol=symbol, category=category,
+                                            interval=interval, topic=topic)))
+        if not point_list:
             raise TypeError('getting a empty list, something went wrong, please check your input arguments!')
-        time.sleep(random.random())
-        return raw_text
+        return point_list
+
+    def get_api_request(self, from_date: str, to_date: str, symbol:str, category: str, interval: str, topic: str) -> str:
+        """
+        JSON text of the points, get_metric decodes the responses without going through it
+        """
+        return json.dumps(self.get_point_list(from_date=from_date, to_date=to_date, symbol=symbol, category=category,
+                                              interval=interval, topic=topic))
 
-    def get_close_price(self, symbol:str = '', from_date: str = '', to_date: str = '', interval: str = '') -> pd.DataFrame:
+    def get_metric(self, metric: str, symbol: str = '', from_date: str = '', to_date: str = '',
+                   interval: str = '') -> pd.DataFrame:
+        """
+        Describe: Any metric of metric_registry, validated and decoded from its registry entry.
+        Without the cache, the response body is decoded straight into the column arrays by decode_raw
+        :param metric: key of metric_registry
+        :param symbol: crypto symbol
+        :param from date: start date
+        :param to date: end date
+        :param interval: timeframe
+        :return: pd.DataFrame of datetime and the columns of the metric
+        """
+        entry = validate_metric(metric=metric, symbol=symbol, interval=interval)
+        if self.cache is None:
+            from_date, to_date = glassnodeConsumer.request_range(from_date, to_date)
+            column_array_dict = decode_raw(self.request_metric(from_date=from_date, to_date=to_date, symbol=symbol,
+                                                               category=entry['category'], interval=interval,
+                                                               topic=entry['topic']), entry['column'])
+            if len(column_array_dict['t']) == 0:
+                raise TypeError('getting a empty list, something went wrong, please check your input arguments!')
+        else:
+            column_array_dict = decode_point_list(self.get_point_list(
+                from_date=from_date, to_date=to_date, symbol=symbol, category=entry['category'], interval=interval,
+                topic=entry['topic']), entry['column'])
+        return metric_frame(column_array_dict)
+
+    def get_close_price(self, symbol: str = '', from_date: str = '', to_date: str = '',
+                        interval: str = '') -> pd.DataFrame:
         """
         Describe: The asset's closing price in USD.
         :param symbol: crypto symbol
@@ -49,18 +143,10 @@ class glassnodeConsumer:
         :param interval: timeframe
         :return: pd.DataFrame
         """
-        if symbol not in glassnodeConsumer.supported_type():
-            raise ValueError(f'symbol is wrong, symbol should be one of {glassnodeConsumer.supported_type()}')
-        if interval not in glassnodeConsumer.suppoerted_interval():
-            raise ValueError(
-                f'interval is wrong, symbol should be one of {glassnodeConsumer.suppoerted_interval()[1:]}')
-        json_object = self.get_api_request(from_date = from_date, to_date = to_date, symbol= symbol, category= 'market', interval = interval, topic= 'price_usd_close')
-        df = pd.DataFrame(json.loads(json_object))
-        df['t'] = pd.to_datetime(df['t'], unit='s')
-        df.columns = ['datetime', 'close_price']
-        return df
+        return self.get_metric('close_price', symbol=symbol, from_date=from_date, to_date=to_date, interval=interval)
 
-    def get_ohlc(self, symbol:str = '', from_date: str = '', to_date: str = '', interval: str = '') -> pd.DataFrame:
+    def get_ohlc(self, symbol: str = '', from_date: str = '', to_date: str = '',
+                 interval: str = '') -> pd.DataFrame:
         """
         Describe: OHLC candlestick chart of the asset's price in USD.
         :param symbol: crypto symbol
@@ -69,20 +155,10 @@ class glassnodeConsumer:
         :param interval: timeframe
         :return: pd.DataFrame
         """
-        if symbol not in glassnodeConsumer.supported_type():
-            raise ValueError(f'symbol is wrong, symbol should be one of {glassnodeConsumer.supported_type()}')
-        if interval not in glassnodeConsumer.suppoerted_interval()[:3]:
-            raise ValueError(
-                f'interval is wrong, symbol should be one of {glassnodeConsumer.suppoerted_interval()[:3]}')
-        json_object = self.get_api_request(from_date = from_date, to_date = to_date, symbol= symbol, category= 'market', interval = interval, topic= 'price_usd_ohlc')
-        df = pd.DataFrame([{'t':object['t']}|object['o'] for object in json.loads(json_object)])
-        df['t'] = pd.to_datetime(df['t'], unit='s')
-        df.columns = ['datetime', 'close', 'high', 'low', 'open']
-        df = df[['datetime', 'open', 'high', 'low', 'close']]
-        return df
+        return self.get_metric('ohlc', symbol=symbol, from_date=from_date, to_date=to_date, interval=interval)
 
     def get_issuance(self, symbol: str = '', from_date: str = '', to_date: str = '',
-                        interval: str = '') -> pd.DataFrame:
+                     interval: str = '') -> pd.DataFrame:
         """
         Describe: The total amount of new coins added to the current supply, i.e. minted coins or new coins released to the network.
         :param symbol: crypto symbol
@@ -91,21 +167,10 @@ class glassnodeConsumer:
         :param interval: timeframe
         :return: pd.DataFrame
         """
-        symbol_constrain_list = ['BTC', 'ETH']
-        if symbol not in symbol_constrain_list:
-            raise ValueError(f'symbol is wrong, symbol should be one of {symbol_constrain_list}')
-        if interval not in glassnodeConsumer.suppoerted_interval()[:3]:
-            raise ValueError(
-                f'interval is wrong, symbol should be one of {glassnodeConsumer.suppoerted_interval()[1:3]}')
-        json_object = self.get_api_request(from_date=from_date, to_date=to_date, symbol=symbol, category='supply',
-                                           interval=interval, topic='issued')
-        df = pd.DataFrame(json.loads(json_object))
-        df['t'] = pd.to_datetime(df['t'], unit='s')
-        df.columns = ['datetime', 'issued']
-        return df
+        return self.get_metric('issuance', symbol=symbol, from_date=from_date, to_date=to_date, interval=interval)
 
     def get_inflation_rate(self, symbol: str = '', from_date: str = '', to_date: str = '',
-                        interval: str = '') -> pd.DataFrame:
+                           interval: str = '') -> pd.DataFrame:
         """
         Describe: The yearly inflation rate, i.e. the percentage of new coins issued, divided by the current supply (annualized).
         :param symbol: crypto symbol
@@ -114,21 +179,10 @@ class glassnodeConsumer:
         :param interval: timeframe
         :return: pd.DataFrame
         """
-        symbol_constrain_list = ['BTC', 'ETH']
-        if symbol not in symbol_constrain_list:
-            raise ValueError(f'symbol is wrong, symbol should be one of {symbol_constrain_list}')
-        if interval not in glassnodeConsumer.suppoerted_interval()[:3]:
-            raise ValueError(
-                f'interval is wrong, symbol should be one of {glassnodeConsumer.suppoerted_interval()[1:3]}')
-        json_object = self.get_api_request(from_date=from_date, to_date=to_date, symbol=symbol, category='supply',
-                                           interval=interval, topic='inflation_rate')
-        df = pd.DataFrame(json.loads(json_object))
-        df['t'] = pd.to_datetime(df['t'], unit='s')
-        df.columns = ['datetime', 'inflation_rate']
-        return df
+        return self.get_metric('inflation_rate', symbol=symbol, from_date=from_date, to_date=to_date, interval=interval)
 
     def get_puell_multiple(self, symbol: str = '', from_date: str = '', to_date: str = '',
-                        interval: str = '') -> pd.DataFrame:
+                           interval: str = '') -> pd.DataFrame:
         """
         Describe: The Puell Multiple is calculated by dividing the daily issuance value of bitcoins (in USD) by the 365-day moving average of daily issuance value.
         This metric was created by David Puell.
@@ -139,21 +193,10 @@ class glassnodeConsumer:
         :param interval: timeframe
         :return: pd.DataFrame
         """
-        symbol_constrain_list = ['BTC', 'LTC']
-        if symbol not in symbol_constrain_list:
-            raise ValueError(f'symbol is wrong, symbol should be one of {symbol_constrain_list}')
-        if interval not in glassnodeConsumer.suppoerted_interval()[:2]:
-            raise ValueError(
-                f'interval is wrong, symbol should be one of {glassnodeConsumer.suppoerted_interval()[1:2]}')
-        json_object = self.get_api_request(from_date=from_date, to_date=to_date, symbol=symbol, category='indicators',
-                                           interval=interval, topic='puell_multiple')
-        df = pd.DataFrame(json.loads(json_object))
-        df['t'] = pd.to_datetime(df['t'], unit='s')
-        df.columns = ['datetime', 'puell_multiple']
-        return df
+        return self.get_metric('puell_multiple', symbol=symbol, from_date=from_date, to_date=to_date, interval=interval)
 
     def get_total_fees(self, symbol: str = '', from_date: str = '', to_date: str = '',
-                        interval: str = '') -> pd.DataFrame:
+                       interval: str = '') -> pd.DataFrame:
         """
         Describe: The total amount of fees paid to miners. Issued (minted) coins are not included.
         :param symbol: crypto symbol
@@ -162,18 +205,40 @@ class glassnodeConsumer:
         :param interval: timeframe
         :return: pd.DataFrame
         """
-        symbol_constrain_list = ['BTC','ETH', 'LTC']
-        if symbol not in symbol_constrain_list:
-            raise ValueError(f'symbol is wrong, symbol should be one of {symbol_constrain_list}')
-        if interval not in glassnodeConsumer.suppoerted_interval():
-            raise ValueError(
-                f'interval is wrong, symbol should be one of {glassnodeConsumer.suppoerted_interval()}')
-        json_object = self.get_api_request(from_date=from_date, to_date=to_date, symbol=symbol, category='fees',
-                                           interval=interval, topic='volume_sum')
-        df = pd.DataFrame(json.loads(json_object))
-        df['t'] = pd.to_datetime(df['t'], unit='s')
-        df.columns = ['datetime', 'total_fees']
-        return df
+        return self.get_metric('total_fees', symbol=symbol, from_date=from_date, to_date=to_date, interval=interval)
+
+    def get_bulk(self, request_list: list) -> pd.DataFrame:
+        """
+        Fetch many metrics concurrently, max_workers requests in flight under the rate limit,
+        a failed request is printed, kept in self.failed_request_list, emptied at every call, and left out
+        :param request_list: (symbol, metric, interval, from_date, to_date) tuples, metric is a key of
+        metric_registry such as 'close_price' or 'total_fees', the dates are YYYY-MM-DD or empty
+        :return: one row per datetime of any metric, one {symbol}_{column}_{interval} column per metric column,
+        the ranges of the same metric merged, NaN where a metric has no point
+        """
+        for symbol, metric, interval, from_date, to_date in request_list:
+            if metric not in metric_registry:
+                raise ValueError(f'metric {metric} is not supported, metric should be one of {list(metric_registry)}')
+        self.failed_request_list = []
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            future_list = [(executor.submit(self.get_metric, metric, symbol=symbol, from_date=from_date,
+                                            to_date=to_date, interval=interval), (symbol, metric, interval))
+                           for symbol, metric, interval, from_date, to_date in request_list]
+            series_dict = {}
+            for future, (symbol, metric, interval) in future_list:
+                try:
+                    df = future.result().set_index('datetime')
+                except (RuntimeError, ValueError, TypeError) as err:
+                    print(f'Fail to request {metric} of {symbol}, {err}')
+                    self.failed_request_list.append((symbol, metric, interval))
+                    continue
+                for column in df.columns:
+                    name = f'{symbol}_{column}_{interval or "24h"}'
+                    series_dict[name] = df[column] if name not in series_dict else \
+                        series_dict[name].combine_first(df[column])
+        if not series_dict:
+            return pd.DataFrame(columns=['datetime'])
+        return pd.concat(series_dict, axis=1, sort=True).rename_axis('datetime').reset_index()
 
     @staticmethod
     def string_to_unix_timestamp(date_string: str) -> float:
@@ -183,24 +248,40 @@ class glassnodeConsumer:
 
     @staticmethod
     def supported_type():
-        supported_list = ["BTC", "ETH", "LTC", "AAVE", "ABT", "AMPL", "ANT", "ARMOR", "BADGER", "BAL",
-                          "BAND", "BAT", "BIX", "BNT", "BOND", "BRD", "BUSD", "BZRX", "CELR", "CHSB",
-                          "CND", "COMP", "CREAM", "CRO", "CRV", "CVC", "CVP", "DAI", "DDX", "DENT", "DGX",
-                          "DHT", "DMG", "DODO", "DOUGH", "DRGN", "ELF", "ENG", "ENJ", "EURS", "FET", "FTT",
-                          "FUN", "GNO", "GUSD", "HEGIC", "HOT", "HPT", "HT", "HUSD", "INDEX", "KCS", "LAMB",
-                          "LBA", "LDO", "LEO", "LINK", "LOOM", "LRC", "MANA", "MATIC", "MCB", "MCO", "MFT",
-                          "MIR", "MKR", "MLN", "MTA", "MTL", "MX", "NDX", "NEXO", "NFTX", "NMR", "Nsure",
-                          "OCEAN", "OKB", "OMG", "PAY", "PERP", "PICKLE", "PNK", "PNT", "POLY", "POWR", "PPT",
-                          "QASH", "QKC", "QNT", "RDN", "REN", "REP", "RLC", "ROOK", "RPL", "RSR", "SAI", "SAN",
-                          "SNT", "SNX", "STAKE", "STORJ", "sUSD", "SUSHI", "TEL", "TOP", "UBT", "UMA", "UNI",
-                          "USDC", "USDK", "USDP", "USDT", "UTK", "VERI", "WaBi", "WAX", "WBTC", "WETH", "wNXM",
-                          "WTC", "YAM", "YFI", "ZRX"]
-        return supported_list
+        return supported_asset_list
 
     @staticmethod
     def suppoerted_interval():
-        supported_list = ['','24h', '1h', '10m', '1w', '1month']
-        return supported_list
+        return supported_interval_list
+
+def benchmark_bulk(request_count: int = 160, latency: float = 0.1, rate_limit: float = 40,
+                   worker_list: tuple = (1, 2, 4, 8, 16)):
+    """
+    get_bulk against glassnode_stub_server, the speedup over one worker grows with the workers
+    until the rate limit caps the request rate
+    :param request_count:
+    :param latency: seconds every stub response takes
+    :param rate_limit: requests per second
+    :param worker_list:
+    """
+    from glassnode_stub_server import start_stub_server
+
+    server, base_url = start_stub_server(latency=latency)
+    metric_list = ['close_price', 'issuance', 'inflation_rate', 'total_fees']
+    request_list = [('BTC', metric_list[i % len(metric_list)], '24h', f'{2010 + i // len(metric_list)}-01-01',
+                     f'{2011 + i // len(metric_list)}-01-01') for i in range(request_count)]
+    single_worker_time = None
+    for max_workers in worker_list:
+        consumer = glassnodeConsumer(cache_dir=None, base_url=base_url, max_workers=max_workers,
+                                     rate_limit=rate_limit)
+        start = time.perf_counter()
+        df = consumer.get_bulk(request_list)
+        elapsed = time.perf_counter() - start
+        single_worker_time = single_worker_time or elapsed
+        print(f'{max_workers:>2} workers: {request_count} requests in {elapsed:.2f}s, '
+              f'speedup {single_worker_time / elapsed:.1f}x, {request_count / elapsed:.1f} requests/s '
+              f'for a limit of {rate_limit:.0f}/s, {df.shape[0]} rows x {df.shape[1] - 1} columns')
+    server.shutdown()
 
 if __name__ == "__main__":
     # df_dict = {}
@@ -0,0 +1,181 @@
+"""
+Persistent cache of the Glassnode metric responses, one JSON file per (category, topic, asset, interval).
+Every file keeps the fetched points with the time ranges they cover, so an overlapping request only fetches
+the uncovered sub-ranges. Bars older than the last few are immutable and never fetched again,
+the still-open tail is only trusted for tail_ttl seconds
+"""
+import json
+import os
+import threading
+import time
+
+default_cache_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), "glassnode_cache")
+
+# seconds of every Glassnode interval, '' is the default 24h
+interval_second_dict = {'': 86400, '24h': 86400, '1h': 3600, '10m': 600, '1w': 604800, '1month': 31 * 86400}
+
+
+def subtract_range(range_list: list, start: int, end: int) -> list:
+    """
+    Parts of [start, end] not covered by range_list
+    :param range_list: sorted disjoint [start, end] ranges of integer seconds, both ends included
+    :param start:
+    :param end:
+    :return: sorted [start, end] ranges
+    """
+    res = []
+    for range_start, range_end in range_list:
+        if range_end < start:
+            continue
+        if range_start > end:
+            break
+        if range_start > start:
+            res.append([start, range_start - 1])
+        start = max(start, range_end + 1)
+    if start <= end:
+        res.append([start, end])
+    return res
+
+
+def merge_range(range_list: list, start: int, end: int) -> list:
+    """
+    Union of range_list and [start, end], adjacent ranges are joined
+    :param range_list: sorted disjoint [start, end] ranges
+    :param start:
+    :param end:
+    :return: sorted disjoint [start, end] ranges
+    """
+    res = []
+    for range_start, range_end in sorted(range_list + [[start, end]]):
+        if res and range_start <= res[-1][1] + 1:
+            res[-1][1] = max(res[-1][1], range_end)
+        else:
+            res.append([range_start, range_end])
+    return res
+
+
+class GlassnodeCache:
+    def __init__(self, cache_dir: str = default_cache_dir, tail_ttl: float = 3600, tail_bar_count: int = 2):
+        """
+
+        :param cache_dir: directory of the cache files
+        :param tail_ttl: seconds the points of the still-open tail are served before being fetched again
+        :param tail_bar_count: number of bars before the fetch time that can still change
+        """
+        self.cache_dir = cache_dir
+        self.tail_ttl = tail_ttl
+        self.tail_bar_count = tail_bar_count
+        self.entry_dict = {}
+        # one lock per key, requests of different metrics are fetched concurrently
+        self.lock = threading.Lock()
+        self.key_lock_dict = {}
+        self.request_count = 0
+        self.hit_count = 0
+        self.partial_hit_count = 0
+        self.fetch_count = 0
+        self.fetch_time = 0.0
+        self.saved_time = 0.0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _file_path(self, key: tuple) -> str:
+        return os.path.join(self.cache_dir, "_".join(str(part) or "default" for part in key) + ".json")
+
+    def _load(self, key: tuple) -> dict:
+        if key not in self.entry_dict:
+            entry = {"range_list": [], "tail": None, "fetch_time": 0.0, "fetch_count": 0, "data": {}}
+            if os.path.exists(self._file_path(key)):
+                with open(self._file_path(key)) as f:
+                    saved = json.load(f)
+                entry = saved | {"data": {point["t"]: point for point in saved["data"]}}
+            self.entry_dict[key] = entry
+        return self.entry_dict[key]
+
+    def _save(self, key: tuple, entry: dict):
+        """
+        Write a temporary file and swap it in, so an interrupted write never corrupts the cache
+        """
+        tmp_path = f"{self._file_path(key)}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(entry | {"data": [entry["data"][t] for t in sorted(entry["data"])]}, f)
+        os.replace(tmp_path, self._file_path(key))
+
+    def get(self, category: str, topic: str, asset: str, interval: str, start: int, end: int, fetch) -> list:
+        """
+        Points of [start, end], fetching only the sub-ranges the cache does not cover
+        :param category:
+        :param topic:
+        :param asset:
+        :param interval: Glassnode interval, '' for the default
+        :param start: unix timestamp in seconds
+        :param end: unix timestamp in seconds, clipped to now
+        :param fetch: called with the start and end of a missing sub-range, returns its list of points
+        with t in seconds
+        :return: points sorted by t
+        """
+        key = (category, topic, asset, interval)
+        with self.lock:
+            key_lock = self.key_lock_dict.setdefault(key, threading.Lock())
+        with key_lock:
+            return self._get(key, int(start), int(end), fetch)
+
+    def _get(self, key: tuple, start: int, end: int, fetch) -> list:
+        interval = key[3]
+        entry = self._load(key)
+        now = time.time()
+        end = min(end, int(now))
+        covered_list = entry["range_list"]
+        tail = entry["tail"]
+        if tail is not None and now - tail[2] < self.tail_ttl:
+            covered_list = merge_range(covered_list, tail[0], tail[1])
+        else:
+            tail = None
+        missing_list = subtract_range(covered_list, start, end)
+        with self.lock:
+            self.request_count += 1
+            if not missing_list:
+                self.hit_count += 1
+                # the fetch times are kept with the points, a later session still knows what a hit saves
+                self.saved_time += entry["fetch_time"] / entry["fetch_count"] if entry["fetch_count"] else 0.0
+            elif missing_list != [[start, end]]:
+                self.partial_hit_count += 1
+        # later bars may still be revised, only the bars before them are final
+        immutable_end = int(now) - self.tail_bar_count * interval_second_dict.get(interval, 86400)
+        for missing_start, missing_end in missing_list:
+            fetch_start = time.perf_counter()
+            point_list = fetch(missing_start, missing_end)
+            fetch_time = time.perf_counter() - fetch_start
+            with self.lock:
+                self.fetch_time += fetch_time
+                self.fetch_count += 1
+            entry["fetch_time"] += fetch_time
+            entry["fetch_count"] += 1
+            for point in point_list:
+                entry["data"][int(point["t"])] = point
+            if missing_start <= immutable_end:
+                entry["range_list"] = merge_range(entry["range_list"], missing_start, min(missing_end, immutable_end))
+            if missing_end > immutable_end:
+                tail_start = max(missing_start, immutable_end + 1)
+                if tail is not None and tail_start <= tail[1] + 1:
+                    tail_start = min(tail_start, tail[0])
+                tail = [tail_start, missing_end, now]
+        if missing_list:
+            entry["tail"] = tail
+            self._save(key, entry)
+        return [entry["data"][t] for t in sorted(entry["data"]) if start <= t <= end]
+
+    def stats(self) -> dict:
+        """
+
+        :return: request counters, hit rate, and the request time saved by the full hits,
+        each at the mean fetch time of its metric
+        """
+        return {"request": self.request_count, "hit": self.hit_count, "partial_hit": self.partial_hit_count,
+                "miss": self.request_count - self.hit_count - self.partial_hit_count, "fetch": self.fetch_count,
+                "hit_rate": self.hit_count / self.request_count if self.request_count else 0.0,
+                "fetch_time": self.fetch_time, "saved_time": self.saved_time}
+
+    def report(self):
+        stats = self.stats()
+        print(f"Glassnode cache: {stats['request']} requests, hit rate {stats['hit_rate']:.1%}, "
+              f"{stats['partial_hit']} partial hits, {stats['fetch']} fetches in {stats['fetch_time']:.2f}s, "
+              f"about {stats['saved_time']:.2f}s of requests saved")
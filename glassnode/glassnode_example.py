@@ -32,4 +32,12 @@ print(df)
 
 # get total fees data
 df = glassnode_consumer.get_total_fees(symbol='BTC', from_date='2020-01-01', to_date='2021-01-01', interval='24h')
-print(df)
\ No newline at end of file
+print(df)
+
+# get many metrics at once, fetched concurrently under the rate limit and aligned on datetime
+df = glassnode_consumer.get_bulk([(symbol, metric, '24h', '2020-01-01', '2021-01-01') for symbol in ['BTC', 'ETH']
+                                  for metric in ['close_price', 'issuance', 'inflation_rate', 'total_fees']])
+print(df)
+
+# requests answered from the local cache, rerun this script to see the hit rate go up
+glassnode_consumer.cache.report()
@@ -0,0 +1,276 @@
+"""
+Registry of the Glassnode metrics served by glassnodeConsumer. A metric is one entry: its endpoint, the assets
+and intervals it accepts, and the path of every column in the points of its response,
+decoded by one generic decoder straight into typed NumPy arrays
+"""
+import json
+import time
+import warnings
+from operator import itemgetter
+import numpy as np
+import pandas as pd
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+supported_asset_list = ["BTC", "ETH", "LTC", "AAVE", "ABT", "AMPL", "ANT", "ARMOR", "BADGER", "BAL",
+                        "BAND", "BAT", "BIX", "BNT", "BOND", "BRD", "BUSD", "BZRX", "CELR", "CHSB",
+                        "CND", "COMP", "CREAM", "CRO", "CRV", "CVC", "CVP", "DAI", "DDX", "DENT", "DGX",
+                        "DHT", "DMG", "DODO", "DOUGH", "DRGN", "ELF", "ENG", "ENJ", "EURS", "FET", "FTT",
+                        "FUN", "GNO", "GUSD", "HEGIC", "HOT", "HPT", "HT", "HUSD", "INDEX", "KCS", "LAMB",
+                        "LBA", "LDO", "LEO", "LINK", "LOOM", "LRC", "MANA", "MATIC", "MCB", "MCO", "MFT",
+                        "MIR", "MKR", "MLN", "MTA", "MTL", "MX", "NDX", "NEXO", "NFTX", "NMR", "Nsure",
+                        "OCEAN", "OKB", "OMG", "PAY", "PERP", "PICKLE", "PNK", "PNT", "POLY", "POWR", "PPT",
+                        "QASH", "QKC", "QNT", "RDN", "REN", "REP", "RLC", "ROOK", "RPL", "RSR", "SAI", "SAN",
+                        "SNT", "SNX", "STAKE", "STORJ", "sUSD", "SUSHI", "TEL", "TOP", "UBT", "UMA", "UNI",
+                        "USDC", "USDK", "USDP", "USDT", "UTK", "VERI", "WaBi", "WAX", "WBTC", "WETH", "wNXM",
+                        "WTC", "YAM", "YFI", "ZRX"]
+
+# '' is the default interval of the API, 24h
+supported_interval_list = ['', '24h', '1h', '10m', '1w', '1month']
+
+all_asset = frozenset(supported_asset_list)
+all_interval = frozenset(supported_interval_list)
+daily_hourly_interval = frozenset(supported_interval_list[:3])
+
+number_byte = b"0123456789.-+eE"
+# every byte that is not part of a JSON number becomes a space
+number_table = bytes(byte if byte in number_byte else 32 for byte in range(256))
+
+# column name to the key path of its value in a point, {"t": ..., "v": ...} unless nested
+value_column = ("v",)
+
+metric_registry = {
+    "close_price": {"category": "market", "topic": "price_usd_close", "asset": all_asset,
+                    "interval": all_interval, "column": {"close_price": value_column}},
+    "ohlc": {"category": "market", "topic": "price_usd_ohlc", "asset": all_asset,
+             "interval": daily_hourly_interval,
+             "column": {"open": ("o", "o"), "high": ("o", "h"), "low": ("o", "l"), "close": ("o", "c")}},
+    "issuance": {"category": "supply", "topic": "issued", "asset": frozenset({"BTC", "ETH"}),
+                 "interval": daily_hourly_interval, "column": {"issued": value_column}},
+    "inflation_rate": {"category": "supply", "topic": "inflation_rate", "asset": frozenset({"BTC", "ETH"}),
+                       "interval": daily_hourly_interval, "column": {"inflation_rate": value_column}},
+    "puell_multiple": {"category": "indicators", "topic": "puell_multiple", "asset": frozenset({"BTC", "LTC"}),
+                       "interval": frozenset(supported_interval_list[:2]),
+                       "column": {"puell_multiple": value_column}},
+    "total_fees": {"category": "fees", "topic": "volume_sum", "asset": frozenset({"BTC", "ETH", "LTC"}),
+                   "interval": all_interval, "column": {"total_fees": value_column}},
+}
+
+
+def validate_metric(metric: str, symbol: str, interval: str) -> dict:
+    """
+
+    :param metric: key of metric_registry
+    :param symbol:
+    :param interval:
+    :return: the registry entry of the metric
+    """
+    if metric not in metric_registry:
+        raise ValueError(f'metric {metric} is not supported, metric should be one of {list(metric_registry)}')
+    entry = metric_registry[metric]
+    if symbol not in entry["asset"]:
+        raise ValueError(f'symbol is wrong, symbol should be one of {sorted(entry["asset"])}')
+    if interval not in entry["interval"]:
+        raise ValueError(f'interval is wrong, interval should be one of '
+                         f'{[interval for interval in supported_interval_list if interval in entry["interval"]]}')
+    return entry
+
+
+def decode_point_list(point_list: list, column_dict: dict) -> dict:
+    """
+    Typed column arrays of the points, a null value is NaN
+    :param point_list: points of a response, each with t in seconds
+    :param column_dict: column name to key path, as in metric_registry
+    :return: t as int64 and every column as float64
+    """
+    res = {"t": np.fromiter(map(itemgetter("t"), point_list), dtype=np.int64, count=len(point_list))}
+    # the nested objects are looked up once for all the columns under them
+    nested_dict = {}
+    for column, path in column_dict.items():
+        if len(path) == 1:
+            value_list = list(map(itemgetter(path[0]), point_list))
+        else:
+            if path[0] not in nested_dict:
+                nested_dict[path[0]] = list(map(itemgetter(path[0]), point_list))
+            value_list = list(map(itemgetter(path[1]), nested_dict[path[0]]))
+        # np.array turns null values into NaN, np.fromiter would raise
+        res[column] = np.array(value_list, dtype=np.float64)
+    return res
+
+
+def parse_json(raw):
+    """
+    orjson when it is installed, a few times faster than json on large responses
+    """
+    return orjson.loads(raw) if orjson is not None else json.loads(raw)
+
+
+def _first_point_layout(raw: bytes, column_dict: dict):
+    """
+    Key paths of the numbers of the first point in the order they are written, and the point without its
+    numbers and whitespace, None when the points can not be decoded from their numbers alone
+    """
+    start = raw.find(b"{")
+    try:
+        point, end = json.JSONDecoder().raw_decode(raw[start:start + 4096].decode("ascii"))
+    except ValueError:
+        return None
+    leaf_path_list = []
+    for key, value in point.items():
+        for path, leaf in ([((key, inner_key), inner_value) for inner_key, inner_value in value.items()]
+                           if isinstance(value, dict) else [((key,), value)]):
+            if isinstance(leaf, bool) or not isinstance(leaf, (int, float)) or \
+                    any(chr(byte) != " " for byte in "".join(path).encode().translate(number_table)):
+                return None
+            leaf_path_list.append(path)
+    if set(leaf_path_list) != {("t",)} | set(column_dict.values()):
+        return None
+    return leaf_path_list, raw[start:start + end].translate(None, number_byte + b" \t\r\n")
+
+
+def _number_array(raw: bytes):
+    """
+    Every number of the body in order, None when a token is not a number
+    """
+    try:
+        with warnings.catch_warnings():
+            # numpy only warns when it stops at a token that is not a number
+            warnings.simplefilter("error")
+            return np.fromstring(raw.translate(number_table), dtype=np.float64, sep=" ")
+    except (ValueError, DeprecationWarning):
+        return None
+
+
+def decode_raw(raw, column_dict: dict) -> dict:
+    """
+    Typed column arrays of a response body in one pass over its numbers, without building the points.
+    Every point must have the layout of the first one, the API writes the keys sorted;
+    any other layout, a null or a missing value falls back to parse_json and decode_point_list
+    :param raw: response body, str or bytes
+    :param column_dict: column name to key path, as in metric_registry
+    :return: as decode_point_list
+    """
+    raw = raw.encode() if isinstance(raw, str) else raw
+    if raw.find(b"{") < 0:
+        return decode_point_list(parse_json(raw), column_dict)
+    layout = _first_point_layout(raw, column_dict)
+    if layout is not None:
+        leaf_path_list, skeleton = layout
+        # without their numbers and whitespace, the points all match the first one or the layout changed
+        body = raw.translate(None, number_byte + b" \t\r\n")
+        point_count = (len(body) - 1) // (len(skeleton) + 1)
+        number_array = _number_array(raw) if body == b"[" + b",".join([skeleton] * point_count) + b"]" else None
+        if number_array is not None and number_array.size == point_count * len(leaf_path_list):
+            number_matrix = number_array.reshape(point_count, len(leaf_path_list))
+            t = number_matrix[:, leaf_path_list.index(("t",))]
+            if np.array_equal(t, np.floor(t)):
+                return {"t": t.astype(np.int64)} | {
+                    column: np.ascontiguousarray(number_matrix[:, leaf_path_list.index(path)])
+                    for column, path in column_dict.items()}
+    return decode_point_list(parse_json(raw), column_dict)
+
+
+def metric_frame(column_array_dict: dict) -> pd.DataFrame:
+    """
+
+    :param column_array_dict: t and the column arrays from decode_point_list or decode_raw
+    :return: DataFrame of datetime and the columns
+    """
+    column_array_dict = dict(column_array_dict)
+    return pd.DataFrame({"datetime": pd.to_datetime(column_array_dict.pop("t"), unit='s')} | column_array_dict)
+
+
+def benchmark_decode(years: int = 5, repeat: int = 3):
+    """
+    Decode a multi-year 10m response through the registry decoder and the previous per-row DataFrame path,
+    both from the same parsed points, the JSON parsing itself is timed apart
+    :param years:
+    :param repeat:
+    """
+    from glassnode_stub_server import synthetic_point_list
+
+    end = int(time.time()) // 600 * 600
+    for metric in ("close_price", "ohlc"):
+        entry = metric_registry[metric]
+        raw_text = json.dumps(synthetic_point_list(topic=entry["topic"], asset="BTC", interval="10m",
+                                                   start=end - years * 365 * 86400, end=end))
+        parse_start = time.perf_counter()
+        point_list = json.loads(raw_text)
+        parse_time = time.perf_counter() - parse_start
+        if metric == "ohlc":
+            def previous_decode():
+                df = pd.DataFrame([{'t': point['t']} | point['o'] for point in point_list])
+                df['t'] = pd.to_datetime(df['t'], unit='s')
+                df.columns = ['datetime', 'close', 'high', 'low', 'open']
+                return df[['datetime', 'open', 'high', 'low', 'close']]
+        else:
+            def previous_decode():
+                df = pd.DataFrame(point_list)
+                df['t'] = pd.to_datetime(df['t'], unit='s')
+                df.columns = ['datetime', 'close_price']
+                return df
+        time_dict = {}
+        for label, decode in (("previous", previous_decode),
+                              ("registry", lambda: metric_frame(decode_point_list(point_list, entry["column"])))):
+            best = float("inf")
+            for _ in range(repeat):
+                start = time.perf_counter()
+                df = decode()
+                best = min(best, time.perf_counter() - start)
+            time_dict[label] = (best, df)
+        assert time_dict["previous"][1].equals(time_dict["registry"][1])
+        print(f"{metric}: {len(point_list)} points of {len(raw_text) / 1e6:.0f}MB parsed in {parse_time * 1000:.0f}ms, "
+              f"decoded by the previous path in {time_dict['previous'][0] * 1000:.0f}ms, "
+              f"by the registry in {time_dict['registry'][0] * 1000:.0f}ms, "
+              f"{time_dict['previous'][0] / time_dict['registry'][0]:.1f}x")
+
+
+def benchmark_ohlc_response(years: int = 10, repeat: int = 3):
+    """
+    Time and peak traced memory of a 10 years 1h OHLC response body to its DataFrame: the previous get_ohlc path
+    parsing the body twice, parse_json with the registry decoder as the cached path does, and decode_raw
+    :param years:
+    :param repeat:
+    """
+    import tracemalloc
+    from glassnode_stub_server import synthetic_point_list
+
+    end = int(time.time()) // 3600 * 3600
+    column_dict = metric_registry["ohlc"]["column"]
+    raw_text = json.dumps(synthetic_point_list(topic="price_usd_ohlc", asset="BTC", interval="1h",
+                                               start=end - years * 365 * 86400, end=end),
+                          separators=(",", ":")).encode()
+
+    def previous_path():
+        if not json.loads(raw_text):
+            raise TypeError('getting a empty list')
+        df = pd.DataFrame([{'t': point['t']} | point['o'] for point in json.loads(raw_text)])
+        df['t'] = pd.to_datetime(df['t'], unit='s')
+        df.columns = ['datetime', 'close', 'high', 'low', 'open']
+        return df[['datetime', 'open', 'high', 'low', 'close']]
+
+    res_df = None
+    for label, decode in (("previous", previous_path),
+                          (f"{'orjson' if orjson is not None else 'json'} + registry",
+                           lambda: metric_frame(decode_point_list(parse_json(raw_text), column_dict))),
+                          ("decode_raw", lambda: metric_frame(decode_raw(raw_text, column_dict)))):
+        best = float("inf")
+        for _ in range(repeat):
+            start = time.perf_counter()
+            df = decode()
+            best = min(best, time.perf_counter() - start)
+        tracemalloc.start()
+        decode()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        res_df = df if res_df is None else res_df
+        assert res_df.equals(df)
+        print(f"{label:<18} {len(df)} points of {len(raw_text) / 1e6:.1f}MB in {best * 1000:.0f}ms, "
+              f"peak memory {peak / 1e6:.0f}MB")
+
+
+if __name__ == "__main__":
+    benchmark_decode()
+    benchmark_ohlc_response()
@@ -0,0 +1,97 @@
+"""
+Local stand-in of the Glassnode metrics endpoint for testing and benchmarking glassnodeConsumer:
+/v1/metrics/{category}/{topic} answers synthetic points of the requested asset, interval and range
+after a configurable latency, price_usd_ohlc with the nested o object as the real API does
+"""
+import json
+import math
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from glassnode_cache import interval_second_dict
+
+
+def synthetic_point_list(topic: str, asset: str, interval: str, start: int, end: int) -> list:
+    """
+    Deterministic points of a metric, one per interval between start and end
+    :param topic:
+    :param asset:
+    :param interval:
+    :param start: unix timestamp in seconds
+    :param end: unix timestamp in seconds
+    :return:
+    """
+    interval_second = interval_second_dict.get(interval, 86400)
+    seed = zlib.crc32(f"{topic}{asset}".encode()) % 1000
+    first = -(-start // interval_second) * interval_second
+    point_list = []
+    for t in range(first, end + 1, interval_second):
+        value = 100 + seed / 10 + 10 * math.sin(t / 86400 / 30 + seed)
+        if topic == "price_usd_ohlc":
+            point_list.append({"t": t, "o": {"c": value, "h": value * 1.01, "l": value * 0.99, "o": value * 1.001}})
+        else:
+            point_list.append({"t": t, "v": value})
+    return point_list
+
+
+class GlassnodeStubHandler(BaseHTTPRequestHandler):
+    latency = 0.05
+    default_bar_count = 1000
+    # assets answered with a 503 every time
+    missing_asset_set = frozenset()
+    # a dict shared by the handlers of one server
+    stats = None
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        path_part_list = url.path.strip("/").split("/")
+        if len(path_part_list) != 4 or path_part_list[:2] != ["v1", "metrics"]:
+            self.send_error(404)
+            return
+        query = {name: value_list[0] for name, value_list in parse_qs(url.query, keep_blank_values=True).items()}
+        if not query.get("a"):
+            self.send_error(400)
+            return
+        interval = query.get("i", "")
+        end = int(query["u"]) if query.get("u") else int(time.time())
+        start = int(query["s"]) if query.get("s") else \
+            end - self.default_bar_count * interval_second_dict.get(interval, 86400)
+        time.sleep(self.latency)
+        with self.server.lock:
+            self.stats["request"] += 1
+            self.stats["request_list"].append((path_part_list[3], query["a"], interval, start, end))
+        if query["a"] in self.missing_asset_set:
+            self.send_error(503)
+            return
+        body = json.dumps(synthetic_point_list(topic=path_part_list[3], asset=query["a"], interval=interval,
+                                               start=start, end=end)).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub_server(latency: float = 0.05, missing_asset_set: set = frozenset(), port: int = 0):
+    """
+    Serve in a daemon thread until server.shutdown()
+    :param latency: seconds every response is delayed by
+    :param missing_asset_set: assets whose requests always fail
+    :param port: 0 picks a free port
+    :return: the server, with its request counter and the (topic, asset, interval, start, end) of every request
+    in server.stats, and the base_url to give glassnodeConsumer
+    """
+    stats = {"request": 0, "request_list": []}
+    handler = type("GlassnodeStubHandler", (GlassnodeStubHandler,),
+                   {"latency": latency, "missing_asset_set": frozenset(missing_asset_set), "stats": stats})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.stats = stats
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/"
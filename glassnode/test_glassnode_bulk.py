@@ -0,0 +1,38 @@
+import numpy as np
+import pandas as pd
+from glassnode_stub_server import start_stub_server, synthetic_point_list
+from glassnodeUtil import glassnodeConsumer
+
+
+def test_get_bulk_aligns_the_metrics_and_reports_the_failed_request():
+    server, base_url = start_stub_server(latency=0.0, missing_asset_set={'ETH'})
+    consumer = glassnodeConsumer(cache_dir=None, base_url=base_url, max_workers=4, max_retry=2, backoff=0.01)
+    try:
+        df = consumer.get_bulk([('BTC', 'close_price', '24h', '2020-01-01', '2020-01-10'),
+                                ('BTC', 'issuance', '24h', '2020-01-05', '2020-01-15'),
+                                # a second range of the same metric is merged into its column
+                                ('BTC', 'close_price', '24h', '2020-01-08', '2020-01-12'),
+                                ('BTC', 'ohlc', '1h', '2020-01-03', '2020-01-04'),
+                                ('ETH', 'total_fees', '24h', '2020-01-01', '2020-01-10')])
+        assert consumer.failed_request_list == [('ETH', 'total_fees', '24h')]
+        # the list only holds the failures of the last call
+        consumer.get_bulk([('BTC', 'close_price', '24h', '2020-01-01', '2020-01-02')])
+        assert consumer.failed_request_list == []
+    finally:
+        server.shutdown()
+    assert list(df.columns) == ['datetime', 'BTC_close_price_24h', 'BTC_issued_24h', 'BTC_open_1h', 'BTC_high_1h',
+                                'BTC_low_1h', 'BTC_close_1h']
+    assert df['datetime'].is_monotonic_increasing and not df['datetime'].duplicated().any()
+    start, _ = glassnodeConsumer.request_range('2020-01-01', '')
+    _, end = glassnodeConsumer.request_range('', '2020-01-12')
+    close_point_list = synthetic_point_list('price_usd_close', 'BTC', '24h', start, end)
+    close_df = df.dropna(subset=['BTC_close_price_24h'])
+    np.testing.assert_array_equal(close_df['datetime'], pd.to_datetime([point['t'] for point in close_point_list],
+                                                                       unit='s'))
+    np.testing.assert_allclose(close_df['BTC_close_price_24h'], [point['v'] for point in close_point_list])
+    # every metric is NaN on the rows of the others
+    issued = df.set_index('datetime')['BTC_issued_24h']
+    assert issued[:'2020-01-04'].isna().all() and issued['2020-01-05':'2020-01-15'].notna().all()
+    hourly_row = df['BTC_close_1h'].notna()
+    assert hourly_row.sum() > 24 and df.loc[hourly_row & (df['datetime'].dt.hour != 0),
+                                            ['BTC_close_price_24h', 'BTC_issued_24h']].isna().all(axis=None)
@@ -0,0 +1,66 @@
+import time
+from datetime import date, timedelta
+import pandas as pd
+import pytest
+from glassnode_cache import subtract_range, merge_range
+from glassnode_stub_server import start_stub_server
+from glassnodeUtil import glassnodeConsumer
+
+
+def test_subtract_range():
+    range_list = [[10, 19], [30, 39]]
+    assert subtract_range(range_list, 0, 50) == [[0, 9], [20, 29], [40, 50]]
+    assert subtract_range(range_list, 12, 35) == [[20, 29]]
+    assert subtract_range(range_list, 10, 19) == []
+    assert subtract_range(range_list, 20, 29) == [[20, 29]]
+    assert subtract_range(range_list, 40, 45) == [[40, 45]]
+    assert subtract_range([], 5, 6) == [[5, 6]]
+    assert subtract_range(range_list, 15, 34) == [[20, 29]]
+
+
+def test_merge_range():
+    assert merge_range([], 5, 6) == [[5, 6]]
+    # overlapping and adjacent ranges are joined, disjoint ones kept apart
+    assert merge_range([[10, 19], [30, 39]], 15, 25) == [[10, 25], [30, 39]]
+    assert merge_range([[10, 19], [30, 39]], 20, 29) == [[10, 39]]
+    assert merge_range([[10, 19], [30, 39]], 0, 8) == [[0, 8], [10, 19], [30, 39]]
+    assert merge_range([[10, 19]], 0, 100) == [[0, 100]]
+
+
+@pytest.fixture
+def stub():
+    server, base_url = start_stub_server(latency=0.0)
+    yield server, base_url
+    server.shutdown()
+
+
+def test_overlapping_request_fetches_the_uncovered_range(stub, tmp_path):
+    server, base_url = stub
+    consumer = glassnodeConsumer(cache_dir=str(tmp_path), base_url=base_url)
+    consumer.get_close_price(symbol='BTC', from_date='2020-01-01', to_date='2020-03-01', interval='24h')
+    df = consumer.get_close_price(symbol='BTC', from_date='2020-02-01', to_date='2020-04-01', interval='24h')
+    first_end = glassnodeConsumer.string_to_unix_timestamp('2020-03-01')
+    end = glassnodeConsumer.string_to_unix_timestamp('2020-04-01')
+    assert [request[3:] for request in server.stats["request_list"]] == [
+        (glassnodeConsumer.string_to_unix_timestamp('2020-01-01'), first_end), (first_end + 1, end)]
+    # the whole range is cached now
+    consumer.get_close_price(symbol='BTC', from_date='2020-01-15', to_date='2020-03-15', interval='24h')
+    assert server.stats["request"] == 2 and consumer.cache.stats()["hit"] == 1
+    # the cached and the fetched parts add up to the response of the whole range
+    uncached_df = glassnodeConsumer(cache_dir=None, base_url=base_url).get_close_price(
+        symbol='BTC', from_date='2020-02-01', to_date='2020-04-01', interval='24h')
+    pd.testing.assert_frame_equal(df, uncached_df)
+
+def test_expired_tail_is_fetched_again(stub, tmp_path):
+    server, base_url = stub
+    consumer = glassnodeConsumer(cache_dir=str(tmp_path), tail_ttl=0.5, base_url=base_url)
+    from_date = (date.today() - timedelta(days=5)).isoformat()
+    consumer.get_close_price(symbol='BTC', from_date=from_date, interval='1h')
+    consumer.get_close_price(symbol='BTC', from_date=from_date, interval='1h')
+    assert server.stats["request"] == 1
+    time.sleep(0.6)
+    df = consumer.get_close_price(symbol='BTC', from_date=from_date, interval='1h')
+    # only the last two hourly bars of the first fetch could still change
+    first_end = server.stats["request_list"][0][4]
+    assert server.stats["request"] == 2 and server.stats["request_list"][1][3] == first_end - 2 * 3600 + 1
+    assert not df["datetime"].duplicated().any()
@@ -0,0 +1,58 @@
+import json
+import numpy as np
+import pytest
+import glassnode_metric
+from glassnode_metric import decode_raw, decode_point_list, metric_registry
+
+close_column = metric_registry["close_price"]["column"]
+ohlc_column = metric_registry["ohlc"]["column"]
+point_list = [{"t": 1577836800 + 86400 * i, "v": 7200.5 + i} for i in range(5)]
+ohlc_point_list = [{"t": 1577836800 + 3600 * i, "o": {"c": 7200.5 + i, "h": 7300.0, "l": 7100.25, "o": 7150.0 - i}}
+                   for i in range(4)]
+
+# body, column paths, whether decode_raw reads the numbers without parsing the points
+case_dict = {
+    "compact": (json.dumps(point_list, separators=(",", ":")), close_column, True),
+    "spaced": (json.dumps(point_list), close_column, True),
+    "indented": (json.dumps(point_list, indent=2), close_column, True),
+    "crlf": (json.dumps(point_list, indent=1).replace("\n", "\r\n\t"), close_column, True),
+    "nested": (json.dumps(ohlc_point_list), ohlc_column, True),
+    "nested_indented": (json.dumps(ohlc_point_list, indent=4), ohlc_column, True),
+    "reordered_keys": (json.dumps([{"v": point["v"], "t": point["t"]} for point in point_list]), close_column, True),
+    "reordered_nested_keys": (json.dumps([{"o": dict(reversed(point["o"].items())), "t": point["t"]}
+                                          for point in ohlc_point_list]), ohlc_column, True),
+    "exponent_and_negative": (json.dumps([{"t": 1577836800, "v": -1.5e-07}, {"t": 1577923200, "v": 2.5E+20},
+                                          {"t": 1577923300, "v": -0.0}, {"t": 1578009600, "v": -12}]),
+                              close_column, True),
+    "null": (json.dumps([{"t": 1577836800, "v": 1.0}, {"t": 1577923200, "v": None}]), close_column, False),
+    "null_first": (json.dumps([{"t": 1577836800, "v": None}, {"t": 1577923200, "v": 1.0}]), close_column, False),
+    "nested_null": (json.dumps([ohlc_point_list[0], {"t": 1577840400, "o": {"c": None, "h": 1, "l": 1, "o": 1}}]),
+                    ohlc_column, False),
+    "mixed_key_order": (json.dumps([{"t": 1577836800, "v": 1.0}, {"v": 2.0, "t": 1577923200}]), close_column, False),
+    "empty": ("[]", close_column, False),
+}
+
+
+@pytest.fixture
+def fallback_list(monkeypatch):
+    fallback_list = []
+
+    def spy(point_list, column_dict):
+        fallback_list.append(len(point_list))
+        return decode_point_list(point_list, column_dict)
+
+    monkeypatch.setattr(glassnode_metric, "decode_point_list", spy)
+    return fallback_list
+
+
+@pytest.mark.parametrize("case", list(case_dict))
+@pytest.mark.parametrize("as_bytes", [False, True])
+def test_decode_raw_matches_decode_point_list(case, as_bytes, fallback_list):
+    raw, column_dict, fast = case_dict[case]
+    expected = decode_point_list(json.loads(raw), column_dict)
+    res = decode_raw(raw.encode() if as_bytes else raw, column_dict)
+    assert (fallback_list == []) == fast
+    assert list(res) == list(expected)
+    for column, array in expected.items():
+        assert res[column].dtype == array.dtype
+        np.testing.assert_array_equal(res[column], array)
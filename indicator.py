@@ -0,0 +1,281 @@
+"""
+Rolling window indicator kernels on contiguous float64 NumPy arrays, matching the ta library outputs.
+The windows run along the first axis, so a (time x symbol) matrix gets every symbol's column at once
+"""
+import time
+from collections import deque
+import numpy as np
+
+
+def _as_float_array(values) -> np.ndarray:
+    return np.ascontiguousarray(values, dtype=np.float64)
+
+
+def _rolling_extreme(values, window: int, accumulate, combine, fill: float) -> np.ndarray:
+    """
+    van Herk/Gil-Werman rolling extreme, O(n) whatever the window:
+    the window ending at i is covered by the suffix of its first block and the prefix of its last block
+    :param values:
+    :param window:
+    :param accumulate: np.maximum.accumulate or np.minimum.accumulate
+    :param combine: np.maximum or np.minimum
+    :param fill: neutral element used to pad the last block
+    :return: NaN until the window is full, like pandas rolling(window).max()/min()
+    """
+    values = _as_float_array(values)
+    n = len(values)
+    column_shape = values.shape[1:]
+    res = np.full(values.shape, np.nan)
+    if window < 1 or window > n:
+        return res
+    blocks = np.concatenate((values, np.full(((-n) % window,) + column_shape, fill))).reshape(
+        (-1, window) + column_shape)
+    prefix = accumulate(blocks, axis=1).reshape((-1,) + column_shape)
+    suffix = accumulate(blocks[:, ::-1], axis=1)[:, ::-1].reshape((-1,) + column_shape)
+    res[window - 1:] = combine(suffix[:n - window + 1], prefix[window - 1:n])
+    return res
+
+
+def rolling_max(values, window: int) -> np.ndarray:
+    return _rolling_extreme(values, window, np.maximum.accumulate, np.maximum, -np.inf)
+
+
+def rolling_min(values, window: int) -> np.ndarray:
+    return _rolling_extreme(values, window, np.minimum.accumulate, np.minimum, np.inf)
+
+
+def sma(close, window: int) -> np.ndarray:
+    """
+    Simple moving average from a running sum, same as ta.trend.SMAIndicator(close, window).sma_indicator()
+    :param close:
+    :param window:
+    :return:
+    """
+    close = _as_float_array(close)
+    n = len(close)
+    res = np.full(close.shape, np.nan)
+    if window < 1 or window > n:
+        return res
+    running_sum = np.cumsum(close, axis=0)
+    res[window - 1] = running_sum[window - 1]
+    res[window:] = running_sum[window:] - running_sum[:-window]
+    res[window - 1:] /= window
+    return res
+
+
+def wilder_smoothing(values, window: int) -> np.ndarray:
+    """
+    ewm(alpha=1 / window, adjust=False).mean() without a per element python loop:
+    each block is solved in closed form with a scaled cumulative sum and only the block end states are chained
+    :param values: non negative values, as the up/down moves fed to the RSI
+    :param window:
+    :return: NaN until window values are seen, like min_periods=window
+    """
+    values = _as_float_array(values)
+    n = len(values)
+    column_shape = values.shape[1:]
+    res = np.full(values.shape, np.nan)
+    if n == 0 or window > n:
+        return res
+    alpha = 1 / window
+    decay = 1 - alpha
+    if decay == 0:
+        smoothed = values.copy()
+    else:
+        # keep decay ** -block_size far from overflow so the scaled cumulative sum stays accurate
+        block_size = max(1, min(n, int(np.log(1e12) / -np.log(decay))))
+        pad = (-n) % block_size
+        blocks = np.concatenate((values, np.zeros((pad,) + column_shape))).reshape((-1, block_size) + column_shape)
+        power = (decay ** np.arange(1, block_size + 1)).reshape((-1,) + (1,) * len(column_shape))
+        # state of every block started from zero: y_k = alpha * sum_j decay ** (k - j) * x_j
+        local = alpha * np.cumsum(blocks / power * decay, axis=1) * power / decay
+        carry = np.empty((len(blocks),) + column_shape)
+        # adjust=False starts the recursion at the first value, i.e. from a previous state equal to it
+        previous_state = values[0]
+        block_decay = power[-1]
+        local_end = local[:, -1]
+        for block_index in range(len(blocks)):
+            carry[block_index] = previous_state
+            previous_state = local_end[block_index] + block_decay * previous_state
+        smoothed = (local + carry[:, None] * power[None]).reshape((-1,) + column_shape)[:n]
+    res[window - 1:] = smoothed[window - 1:]
+    return res
+
+
+def rsi(close, window: int = 14) -> np.ndarray:
+    """
+    Wilder RSI, same as ta.momentum.RSIIndicator(close, window).rsi()
+    :param close:
+    :param window:
+    :return:
+    """
+    close = _as_float_array(close)
+    diff = np.empty_like(close)
+    diff[:1] = 0.0
+    diff[1:] = close[1:] - close[:-1]
+    ema_up = wilder_smoothing(np.where(diff > 0, diff, 0.0), window)
+    ema_down = wilder_smoothing(np.where(diff < 0, -diff, 0.0), window)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        relative_strength = ema_up / ema_down
+        return np.where(ema_down == 0, 100, 100 - (100 / (1 + relative_strength)))
+
+
+def williams_r(high, low, close, lbp: int = 14) -> np.ndarray:
+    """
+    Williams %R, same as ta.momentum.WilliamsRIndicator(high, low, close, lbp).williams_r()
+    :param high:
+    :param low:
+    :param close:
+    :param lbp: look back period
+    :return:
+    """
+    highest_high = rolling_max(high, lbp)
+    lowest_low = rolling_min(low, lbp)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return -100 * (highest_high - _as_float_array(close)) / (highest_high - lowest_low)
+
+
+class StreamingWilliamsRMA:
+    def __init__(self, reference_window: int, ma_window: int):
+        """
+        Williams %R and moving average updated in constant time per kline.
+        Monotonic deques give the rolling high/low and a ring buffer of cumulative close sums gives the MA,
+        so the outputs are the same floating point operations as williams_r and sma on the same klines
+        :param reference_window: Williams %R look back period
+        :param ma_window: moving average window
+        """
+        self.reference_window = reference_window
+        self.ma_window = ma_window
+        self.count = 0
+        self.close = np.nan
+        self.high_deque = deque()
+        self.low_deque = deque()
+        self.cumulative_close = 0.0
+        self.cumulative_close_ring = np.zeros(ma_window + 1)
+
+    @property
+    def ready(self) -> bool:
+        return self.count >= max(self.reference_window, self.ma_window)
+
+    def update(self, high: float, low: float, close: float):
+        """
+
+        :param high:
+        :param low:
+        :param close:
+        :return: Williams %R and moving average after this kline, NaN while the windows are not full
+        """
+        index = self.count
+        self.count += 1
+        self.close = close
+        high_deque = self.high_deque
+        while high_deque and high_deque[-1][1] <= high:
+            high_deque.pop()
+        high_deque.append((index, high))
+        if high_deque[0][0] <= index - self.reference_window:
+            high_deque.popleft()
+        low_deque = self.low_deque
+        while low_deque and low_deque[-1][1] >= low:
+            low_deque.pop()
+        low_deque.append((index, low))
+        if low_deque[0][0] <= index - self.reference_window:
+            low_deque.popleft()
+        self.cumulative_close += close
+        self.cumulative_close_ring[index % (self.ma_window + 1)] = self.cumulative_close
+        return self.williams_r, self.ma
+
+    @property
+    def williams_r(self) -> float:
+        if self.count < self.reference_window:
+            return np.nan
+        highest_high = self.high_deque[0][1]
+        lowest_low = self.low_deque[0][1]
+        if highest_high == lowest_low:
+            return np.nan
+        return -100 * (highest_high - self.close) / (highest_high - lowest_low)
+
+    @property
+    def ma(self) -> float:
+        if self.count < self.ma_window:
+            return np.nan
+        if self.count == self.ma_window:
+            return self.cumulative_close / self.ma_window
+        return (self.cumulative_close -
+                self.cumulative_close_ring[(self.count - 1 - self.ma_window) % (self.ma_window + 1)]) / self.ma_window
+
+
+def stream_williams_r_ma(high, low, close, reference_window: int, ma_window: int):
+    """
+    Replay klines through StreamingWilliamsRMA, the way the live trader sees them
+    :return: Williams %R array, moving average array
+    """
+    state = StreamingWilliamsRMA(reference_window=reference_window, ma_window=ma_window)
+    n = len(close)
+    williams_r_array = np.empty(n)
+    ma_array = np.empty(n)
+    for i, (high_price, low_price, close_price) in enumerate(zip(_as_float_array(high).tolist(),
+                                                                 _as_float_array(low).tolist(),
+                                                                 _as_float_array(close).tolist())):
+        williams_r_array[i], ma_array[i] = state.update(high_price, low_price, close_price)
+    return williams_r_array, ma_array
+
+
+def benchmark(n: int = 1_000_000, window: int = 16, repeat: int = 3):
+    """
+    Compare the kernels against the ta implementations on a random walk of n rows
+    :param n:
+    :param window:
+    :param repeat:
+    """
+    import pandas as pd
+    import ta
+
+    rng = np.random.default_rng(0)
+    close = pd.Series(100 + np.cumsum(rng.normal(0, 0.1, n)))
+    high = close + rng.uniform(0, 0.2, n)
+    low = close - rng.uniform(0, 0.2, n)
+    case_dict = {
+        "williams_r": (lambda: ta.momentum.WilliamsRIndicator(high=high, low=low, close=close,
+                                                              lbp=window).williams_r(),
+                       lambda: williams_r(high, low, close, window)),
+        "sma": (lambda: ta.trend.SMAIndicator(close, window=window * 7).sma_indicator(),
+                lambda: sma(close, window * 7)),
+        "rsi": (lambda: ta.momentum.RSIIndicator(close=close, window=window).rsi(),
+                lambda: rsi(close, window)),
+    }
+    for name, (ta_function, native_function) in case_dict.items():
+        timing_list = []
+        for function in (ta_function, native_function):
+            start = time.perf_counter()
+            for _ in range(repeat):
+                values = np.asarray(function(), dtype=np.float64)
+            timing_list.append((time.perf_counter() - start) / repeat)
+        max_abs_diff = np.nanmax(np.abs(np.asarray(ta_function(), dtype=np.float64) - values))
+        print(f"{name:<12} ta: {timing_list[0] * 1000:8.2f}ms  native: {timing_list[1] * 1000:8.2f}ms  "
+              f"speedup: {timing_list[0] / timing_list[1]:5.2f}x  max abs diff: {max_abs_diff:.3e}")
+
+
+def benchmark_streaming(n: int = 200_000, reference_window: int = 16, ma_window: int = 112):
+    """
+    Measure the per update latency of StreamingWilliamsRMA, test_indicator checks it reproduces the batch kernels
+    :param n:
+    :param reference_window:
+    :param ma_window:
+    """
+    rng = np.random.default_rng(0)
+    close = 100 + np.cumsum(rng.normal(0, 0.1, n))
+    high = close + rng.uniform(0, 0.2, n)
+    low = close - rng.uniform(0, 0.2, n)
+    state = StreamingWilliamsRMA(reference_window=reference_window, ma_window=ma_window)
+    latency_array = np.empty(n)
+    for i, (high_price, low_price, close_price) in enumerate(zip(high.tolist(), low.tolist(), close.tolist())):
+        start = time.perf_counter_ns()
+        state.update(high_price, low_price, close_price)
+        latency_array[i] = time.perf_counter_ns() - start
+    print(f"streaming update latency over {n} klines, mean: {latency_array.mean() / 1000:.2f}us  "
+          f"p50: {np.percentile(latency_array, 50) / 1000:.2f}us  p99: {np.percentile(latency_array, 99) / 1000:.2f}us")
+
+
+if __name__ == "__main__":
+    benchmark()
+    benchmark_streaming()
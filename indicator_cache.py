@@ -0,0 +1,105 @@
+import hashlib
+import os
+from collections import OrderedDict
+import numpy as np
+
+
+class IndicatorCache:
+    def __init__(self, max_size: int = 256, cache_dir: str = None, max_bytes: int = 512 * 1024 ** 2):
+        """
+        Memoize indicator columns keyed by (data fingerprint, indicator name, window)
+        :param max_size: number of indicator columns kept in memory, least recently used are evicted first
+        :param cache_dir: if given, every computed column is also saved there as a .npy file and reloaded on a miss
+        :param max_bytes: memory held by the columns kept in memory, evicted the same way,
+        a column larger than it is returned without being kept
+        """
+        self.max_bytes = max_bytes
+        self.max_size = max_size
+        self.nbytes = 0
+        self.cache_dir = cache_dir
+        self.memory_cache = OrderedDict()
+        self.hit_count = 0
+        self.disk_hit_count = 0
+        self.miss_count = 0
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def fingerprint(df, column_list: tuple = ("high", "low", "close")) -> str:
+        """
+        Hash of the price columns, identical klines share the same fingerprint whatever DataFrame holds them
+        :param df: kline DataFrame, or dict of (time x symbol) price matrices
+        :param column_list:
+        :return:
+        """
+        hasher = hashlib.blake2b(digest_size=16)
+        for column in column_list:
+            if column in df:
+                values = np.ascontiguousarray(np.asarray(df[column], dtype=np.float64))
+                hasher.update(str(values.shape).encode())
+                hasher.update(values.tobytes())
+        return hasher.hexdigest()
+
+    def _file_path(self, key: tuple) -> str:
+        return os.path.join(self.cache_dir, "_".join(str(part) for part in key) + ".npy")
+
+    def _save(self, key: tuple, values: np.ndarray):
+        """
+        Write a temporary file and swap it in, the optimizer and walk-forward workers share cache_dir and
+        must never load a half written column
+        """
+        tmp_path = f"{self._file_path(key)}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, values)
+        os.replace(tmp_path, self._file_path(key))
+
+    def get(self, fingerprint: str, indicator: str, window: int, compute):
+        """
+
+        :param fingerprint: from IndicatorCache.fingerprint
+        :param indicator: indicator name
+        :param window:
+        :param compute: called without argument on a miss, returns the indicator values
+        :return: read-only float64 array of the indicator values
+        """
+        key = (fingerprint, indicator, window)
+        if key in self.memory_cache:
+            self.hit_count += 1
+            self.memory_cache.move_to_end(key)
+            return self.memory_cache[key]
+        if self.cache_dir and os.path.exists(self._file_path(key)):
+            self.disk_hit_count += 1
+            values = np.load(self._file_path(key))
+        else:
+            self.miss_count += 1
+            values = np.asarray(compute(), dtype=np.float64)
+            if self.cache_dir:
+                self._save(key, values)
+        values.flags.writeable = False
+        if values.nbytes > self.max_bytes:
+            return values
+        self.memory_cache[key] = values
+        self.nbytes += values.nbytes
+        # a (time x symbol) matrix of years of 1m klines alone can weigh gigabytes, the entry count is not enough
+        while self.memory_cache and (self.nbytes > self.max_bytes or len(self.memory_cache) > self.max_size):
+            self.nbytes -= self.memory_cache.popitem(last=False)[1].nbytes
+        return values
+
+    def clear(self):
+        self.memory_cache.clear()
+        self.nbytes = 0
+        self.hit_count = self.disk_hit_count = self.miss_count = 0
+
+    def stats(self) -> dict:
+        """
+
+        :return: hit/miss counters and the hit rate, memory and disk hits together
+        """
+        total = self.hit_count + self.disk_hit_count + self.miss_count
+        return {"hit": self.hit_count, "disk_hit": self.disk_hit_count, "miss": self.miss_count,
+                "size": len(self.memory_cache), "bytes": self.nbytes,
+                "hit_rate": (self.hit_count + self.disk_hit_count) / total if total else 0.0}
+
+
+# Shared by every Alpha in the process, so a parameter sweep reuses the columns of previous backtests
+indicator_cache = IndicatorCache()
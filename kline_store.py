@@ -0,0 +1,243 @@
+"""
+Columnar on-disk kline store, partitioned by symbol/interval/month.
+Every partition holds one .npy file per column, typed int64 open_time in seconds and float64 OHLCV,
+read back through memory maps so a range read inside one month is a zero-copy view.
+A month directory keeps its columns in versioned v{n} directories and a CURRENT file naming the live one,
+a write builds the next version and then replaces CURRENT, so readers always see one complete version.
+"""
+import os
+import re
+import shutil
+import time
+import numpy as np
+import pandas as pd
+
+default_store_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), "kline_store")
+
+column_dtype_dict = {"open_time": np.int64, "open": np.float64, "high": np.float64, "low": np.float64,
+                     "close": np.float64, "volume": np.float64, "turnover": np.float64}
+
+# Bybit interval codes to the interval names used by the backtests
+interval_map_dict = {'1': '1m', '3': '3m', '5': '5m', '15': '15m', '30': '30m', '60': '1h', '120': '2h',
+                     '240': '4h', '360': '6h', '720': '12h', 'D': '1d', 'W': '1w', 'M': '1M'}
+
+
+month_pattern = re.compile(r"^\d{4}-\d{2}$")
+
+
+def normalize_interval(interval: str) -> str:
+    return interval_map_dict.get(str(interval), str(interval))
+
+
+class KlineStore:
+    def __init__(self, store_dir: str = default_store_dir):
+        """
+
+        :param store_dir: root directory of the store
+        """
+        self.store_dir = store_dir
+
+    def _interval_dir(self, symbol: str, interval: str) -> str:
+        return os.path.join(self.store_dir, symbol.upper(), normalize_interval(interval))
+
+    def month_list(self, symbol: str, interval: str) -> list:
+        """
+
+        :param symbol:
+        :param interval:
+        :return: sorted YYYY-MM partitions of the symbol/interval
+        """
+        interval_dir = self._interval_dir(symbol, interval)
+        if not os.path.isdir(interval_dir):
+            return []
+        return sorted(month for month in os.listdir(interval_dir) if month_pattern.match(month) and
+                      os.path.exists(os.path.join(interval_dir, month, "CURRENT")))
+
+    @staticmethod
+    def _current_version(month_dir: str):
+        """
+
+        :param month_dir:
+        :return: name of the live version directory, None before the first write of the month completes
+        """
+        try:
+            with open(os.path.join(month_dir, "CURRENT")) as f:
+                return f.read().strip()
+        except FileNotFoundError:
+            return None
+
+    def _load_partition(self, symbol: str, interval: str, month: str, mmap_mode: str = "r") -> dict:
+        month_dir = os.path.join(self._interval_dir(symbol, interval), month)
+        for attempt in range(3):
+            partition_dir = os.path.join(month_dir, KlineStore._current_version(month_dir))
+            try:
+                return {column: np.load(os.path.join(partition_dir, f"{column}.npy"), mmap_mode=mmap_mode)
+                        for column in column_dtype_dict}
+            except FileNotFoundError:
+                # a write replaced the version while it was being opened, read the new one
+                if attempt == 2:
+                    raise
+
+    def _write_partition(self, symbol: str, interval: str, month: str, column_dict: dict):
+        """
+        Write the next version of the partition and point CURRENT to it, readers never see half written columns.
+        The replaced version is kept for the readers still opening it, the older ones are deleted
+        """
+        month_dir = os.path.join(self._interval_dir(symbol, interval), month)
+        os.makedirs(month_dir, exist_ok=True)
+        current = KlineStore._current_version(month_dir)
+        version_list = [name for name in os.listdir(month_dir) if re.match(r"^v\d+$", name)]
+        version = f"v{max([int(name[1:]) for name in version_list], default=0) + 1}"
+        version_dir = os.path.join(month_dir, version)
+        os.makedirs(version_dir)
+        for column, values in column_dict.items():
+            np.save(os.path.join(version_dir, f"{column}.npy"), values)
+        tmp_path = os.path.join(month_dir, "CURRENT.tmp")
+        with open(tmp_path, "w") as f:
+            f.write(version)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, os.path.join(month_dir, "CURRENT"))
+        # older versions and the versions a crash left unreferenced
+        for name in version_list:
+            if name != current:
+                shutil.rmtree(os.path.join(month_dir, name), ignore_errors=True)
+
+    @staticmethod
+    def to_column_dict(data) -> dict:
+        """
+        Typed column arrays from a DataFrame, a dict of arrays or a list of kline dicts, missing columns are NaN
+        :param data:
+        :return:
+        """
+        if isinstance(data, list):
+            data = pd.DataFrame(data)
+        length = len(data["open_time"])
+        column_dict = {}
+        for column, dtype in column_dtype_dict.items():
+            if column in data:
+                column_dict[column] = np.asarray(data[column], dtype=dtype)
+            else:
+                column_dict[column] = np.full(length, np.nan, dtype=dtype)
+        return column_dict
+
+    def append(self, symbol: str, interval: str, data) -> int:
+        """
+        Merge klines into the store, a kline already stored at the same open_time is replaced by the new one
+        :param symbol:
+        :param interval:
+        :param data: DataFrame, dict of arrays or list of kline dicts with an open_time column in seconds
+        :return: number of klines written
+        """
+        column_dict = KlineStore.to_column_dict(data)
+        if len(column_dict["open_time"]) == 0:
+            return 0
+        month_array = column_dict["open_time"].astype("datetime64[s]").astype("datetime64[M]")
+        existing_month_set = set(self.month_list(symbol, interval))
+        for month_value in np.unique(month_array):
+            month = str(month_value)
+            mask = month_array == month_value
+            new_dict = {column: values[mask] for column, values in column_dict.items()}
+            if month in existing_month_set:
+                existing_dict = self._load_partition(symbol, interval, month, mmap_mode=None)
+                new_dict = {column: np.concatenate((existing_dict[column], new_dict[column]))
+                            for column in column_dtype_dict}
+            # stable sort keeps the new kline after the stored one, the last of every open_time run is kept
+            order = np.argsort(new_dict["open_time"], kind="stable")
+            sorted_open_time = new_dict["open_time"][order]
+            keep = np.append(sorted_open_time[1:] != sorted_open_time[:-1], True)
+            self._write_partition(symbol, interval, month,
+                                  {column: values[order][keep] for column, values in new_dict.items()})
+        return len(column_dict["open_time"])
+
+    def read(self, symbol: str, interval: str, start: float = None, end: float = None) -> dict:
+        """
+        Klines with start <= open_time < end, as memory mapped views when the range sits in one partition
+        :param symbol:
+        :param interval:
+        :param start: unix timestamp in seconds, None for the beginning of the store
+        :param end: unix timestamp in seconds, None for the end of the store
+        :return: dict of column arrays
+        """
+        start_month = None if start is None else str(np.datetime64(int(start), "s").astype("datetime64[M]"))
+        end_month = None if end is None else str(np.datetime64(int(end), "s").astype("datetime64[M]"))
+        slice_list = []
+        for month in self.month_list(symbol, interval):
+            if (start_month is not None and month < start_month) or (end_month is not None and month > end_month):
+                continue
+            partition = self._load_partition(symbol, interval, month)
+            open_time = partition["open_time"]
+            left = 0 if start is None else np.searchsorted(open_time, start, side="left")
+            right = len(open_time) if end is None else np.searchsorted(open_time, end, side="left")
+            if right > left:
+                slice_list.append({column: values[left:right] for column, values in partition.items()})
+        if not slice_list:
+            return {column: np.empty(0, dtype=dtype) for column, dtype in column_dtype_dict.items()}
+        if len(slice_list) == 1:
+            return slice_list[0]
+        return {column: np.concatenate([column_slice[column] for column_slice in slice_list])
+                for column in column_dtype_dict}
+
+    def read_df(self, symbol: str, interval: str, start: float = None, end: float = None) -> pd.DataFrame:
+        """
+        Same as read, wrapped in a DataFrame without copying the columns
+        """
+        return pd.DataFrame(self.read(symbol, interval, start=start, end=end), copy=False)
+
+    def last_open_time(self, symbol: str, interval: str):
+        """
+
+        :param symbol:
+        :param interval:
+        :return: open_time of the latest stored kline, None when nothing is stored
+        """
+        month_list = self.month_list(symbol, interval)
+        if not month_list:
+            return None
+        return int(self._load_partition(symbol, interval, month_list[-1])["open_time"][-1])
+
+    def import_csv(self, csv_path: str, symbol: str, interval: str) -> int:
+        """
+        Import a csv written by the former bybit downloader
+        :param csv_path:
+        :param symbol:
+        :param interval:
+        :return:
+        """
+        return self.append(symbol, interval, pd.read_csv(csv_path, index_col=0))
+
+
+def benchmark(store_dir: str, symbol_count: int = 10, days: int = 365):
+    """
+    Write a year of synthetic 1m klines for several symbols, then time reading them all back
+    :param store_dir: scratch directory, it is removed afterwards
+    :param symbol_count:
+    :param days:
+    """
+    store = KlineStore(store_dir)
+    rng = np.random.default_rng(0)
+    n = days * 24 * 60
+    open_time = 1640995200 + 60 * np.arange(n, dtype=np.int64)
+    symbol_list = [f"SYM{i}USDT" for i in range(symbol_count)]
+    try:
+        for symbol in symbol_list:
+            close = 100 + np.cumsum(rng.normal(0, 0.1, n))
+            store.append(symbol, "1", {"open_time": open_time, "open": close, "high": close + 0.1,
+                                       "low": close - 0.1, "close": close, "volume": np.ones(n),
+                                       "turnover": close})
+        start = time.perf_counter()
+        row_count = sum(len(store.read(symbol, "1m")["close"]) for symbol in symbol_list)
+        print(f"Read {row_count} klines of {symbol_count} symbols in {time.perf_counter() - start:.3f}s")
+        start = time.perf_counter()
+        month_read = store.read(symbol_list[0], "1m", start=int(open_time[0]), end=int(open_time[0]) + 86400 * 28)
+        print(f"Read {len(month_read['close'])} klines inside one partition in "
+              f"{(time.perf_counter() - start) * 1000:.3f}ms, memory mapped: "
+              f"{isinstance(month_read['close'].base, np.memmap) or isinstance(month_read['close'], np.memmap)}")
+    finally:
+        shutil.rmtree(store_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    import tempfile
+
+    benchmark(store_dir=os.path.join(tempfile.gettempdir(), "kline_store_benchmark"))
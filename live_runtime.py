@@ -0,0 +1,462 @@
+"""
+asyncio runtime of the live traders: kline ingestion, signal computation, order submission and position
+reconciliation run as separate tasks connected by bounded queues, and every exchange call has a timeout,
+so a slow response only delays the orders while the next klines keep being processed
+"""
+import asyncio
+import bisect
+import math
+import threading
+import time
+from collections import deque
+import numpy as np
+from indicator import StreamingWilliamsRMA
+from position_manager import PositionManager
+
+
+class TopOfBook:
+    def __init__(self, max_age: float = 2.0):
+        """
+        Best bid and ask kept up to date from a streaming orderbook feed, read in O(1) by the pricing functions
+        :param max_age: seconds after the last update before the quote is refused as stale
+        """
+        self.max_age = max_age
+        # one tuple assigned at once, so a reader never sees the bid of one update with the ask of another
+        self._quote = (math.nan, math.nan, -math.inf)
+        self.update_count = 0
+
+    def update(self, best_bid: float, best_ask: float):
+        self._quote = (float(best_bid), float(best_ask), time.monotonic())
+        self.update_count += 1
+
+    def update_from_message(self, message):
+        """
+
+        :param message: orderbook message of the feed, a list whose first item has the bid and ask
+        [price, size] levels, best first
+        """
+        data = message[0]
+        self.update(best_bid=data['bid'][0][0], best_ask=data['ask'][0][0])
+
+    @property
+    def age(self) -> float:
+        return time.monotonic() - self._quote[2]
+
+    def quote(self):
+        """
+
+        :return: best bid, best ask
+        """
+        best_bid, best_ask, update_time = self._quote
+        if not self.update_count:
+            raise ValueError("No orderbook message received yet")
+        if time.monotonic() - update_time > self.max_age:
+            raise ValueError(f"Orderbook is stale, last update {time.monotonic() - update_time:.2f}s ago")
+        return best_bid, best_ask
+
+    def follow(self, orderbook_iterator) -> threading.Thread:
+        """
+        Consume a blocking orderbook iterator in a daemon thread, for the synchronous trading loop
+        :param orderbook_iterator:
+        :return: the thread
+        """
+        def consume():
+            for message in orderbook_iterator:
+                if message:
+                    self.update_from_message(message)
+
+        thread = threading.Thread(target=consume, daemon=True)
+        thread.start()
+        return thread
+
+
+def bracket_price(top_of_book: TopOfBook, order_side: str, take_profit: float, stop_loss: float):
+    """
+    Take profit and stop loss prices of an opening order from the cached best bid/ask, as Alpha priced them
+    from a fresh orderbook message
+    :param top_of_book:
+    :param order_side: Buy or Sell
+    :param take_profit: percentage, 0 for no take profit
+    :param stop_loss: percentage, 0 for no stop loss
+    :return: take profit price, stop loss price
+    """
+    best_bid, best_ask = top_of_book.quote()
+    if order_side == "Buy":
+        take_profit_price = int(best_ask * (1 + take_profit / 100))
+        stop_loss_price = int(best_ask * (1 - stop_loss / 100))
+    else:
+        take_profit_price = int(best_bid * (1 - take_profit / 100))
+        stop_loss_price = int(best_bid * (1 + stop_loss / 100))
+    return take_profit_price if take_profit != 0 else None, stop_loss_price if stop_loss != 0 else None
+
+
+class LatencyHistogram:
+    def __init__(self, low: float = 1e-5, high: float = 10.0, bucket_per_decade: int = 4):
+        """
+        Log spaced histogram of latencies, recorded in O(log bucket count) without keeping the samples
+        :param low: upper edge of the first bucket in seconds
+        :param high: lower edge of the overflow bucket in seconds
+        :param bucket_per_decade:
+        """
+        decade_count = round(math.log10(high / low))
+        self.edge_list = [low * 10 ** (k / bucket_per_decade) for k in range(decade_count * bucket_per_decade + 1)]
+        self.count_list = [0] * (len(self.edge_list) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, latency: float):
+        self.count_list[bisect.bisect_left(self.edge_list, latency)] += 1
+        self.count += 1
+        self.total += latency
+        self.max = max(self.max, latency)
+
+    def percentile(self, q: float) -> float:
+        """
+
+        :param q: between 0 and 100
+        :return: upper edge of the bucket holding the percentile, capped by the largest latency
+        """
+        rank = q / 100 * self.count
+        cumulative = 0
+        for k, count in enumerate(self.count_list):
+            cumulative += count
+            if count and cumulative >= rank:
+                return min(self.edge_list[k], self.max) if k < len(self.edge_list) else self.max
+        return math.nan
+
+    def report(self, label: str):
+        """
+        Print the percentiles and the non-empty buckets
+        :param label:
+        """
+        if not self.count:
+            return
+        print(f"{label} over {self.count} samples, mean: {self.total / self.count * 1000:.3f}ms, "
+              f"p50 <= {self.percentile(50) * 1000:.3f}ms, p99 <= {self.percentile(99) * 1000:.3f}ms, "
+              f"max: {self.max * 1000:.3f}ms")
+        largest = max(self.count_list)
+        for k, count in enumerate(self.count_list):
+            if count:
+                edge = f"<= {self.edge_list[k] * 1000:9.3f}ms" if k < len(self.edge_list) else \
+                    f" > {self.edge_list[-1] * 1000:9.3f}ms"
+                print(f"  {edge} {count:>7} {'#' * max(1, round(40 * count / largest))}")
+
+
+class AsyncBybitExchange:
+    def __init__(self, session_auth, kline_iterator, orderbook_iterator=None):
+        """
+        Non-blocking adapter of a pybit HTTP session, each request runs in a worker thread
+        :param session_auth: pybit usdt_perpetual.HTTP session
+        :param kline_iterator: blocking iterator of kline dicts, as the redis consumer generators yield them
+        :param orderbook_iterator: blocking iterator of orderbook messages, consumed for the whole session
+        """
+        self.session_auth = session_auth
+        self.kline_iterator = kline_iterator
+        self.orderbook_iterator = orderbook_iterator
+
+    @staticmethod
+    async def _iterate_in_thread(iterator):
+        while True:
+            item = await asyncio.to_thread(next, iterator, None)
+            if item is None:
+                return
+            yield item
+
+    def kline_stream(self):
+        return self._iterate_in_thread(self.kline_iterator)
+
+    def orderbook_stream(self):
+        return self._iterate_in_thread(self.orderbook_iterator)
+
+    async def place_active_order(self, **order_dict) -> dict:
+        return await asyncio.to_thread(self.session_auth.place_active_order, **order_dict)
+
+    async def my_position(self, symbol: str) -> dict:
+        return await asyncio.to_thread(self.session_auth.my_position, symbol=symbol)
+
+
+class WilliamsRMAStrategy:
+    def __init__(self, reference_window: int, sub_window_multiplier: int, first_window: float = -85,
+                 second_window: float = -15):
+        """
+        Williams %R and MA signals of the live trader, updated in constant time per kline
+        :param reference_window:
+        :param sub_window_multiplier:
+        :param first_window: oversold level, open long below and close short below
+        :param second_window: overbought level, open short above and close long above
+        """
+        self.indicator_state = StreamingWilliamsRMA(reference_window=reference_window,
+                                                    ma_window=sub_window_multiplier * reference_window)
+        self.first_window = first_window
+        self.second_window = second_window
+
+    def on_kline(self, kline: dict):
+        """
+
+        :param kline: dict with high, low and close
+        :return: open_long, close_long, open_short, close_short signals, None until the indicators are ready
+        """
+        self.indicator_state.update(high=float(kline['high']), low=float(kline['low']), close=float(kline['close']))
+        if not self.indicator_state.ready:
+            return None
+        percentage_r = self.indicator_state.williams_r
+        percentage_r = -50 if np.isnan(percentage_r) else percentage_r
+        is_up = self.indicator_state.close > self.indicator_state.ma
+        return (percentage_r < self.first_window and is_up, percentage_r > self.second_window,
+                percentage_r > self.second_window and not is_up, percentage_r < self.first_window)
+
+
+class LiveRuntime:
+    def __init__(self, exchange, strategy, symbol: str, qty: float, kline_queue_size: int = 100,
+                 order_queue_size: int = 4, request_timeout: float = 5.0, reconcile_interval: float = 60.0,
+                 bracket_price_function=None, order_link_id_function=None, top_of_book: TopOfBook = None,
+                 latency_report_every: int = 100, position_manager: PositionManager = None):
+        """
+
+        :param exchange: FakeExchange, AsyncBybitExchange or any object with the same coroutines
+        :param strategy: object whose on_kline(kline) returns the open_long, close_long, open_short and
+        close_short signals, or None
+        :param symbol:
+        :param qty: order quantity
+        :param kline_queue_size: klines waiting for the signal task, the oldest is dropped when it is full
+        :param order_queue_size: orders waiting for the order task
+        :param request_timeout: seconds before an exchange request is given up
+        :param reconcile_interval: seconds between two position queries of the default position manager
+        :param bracket_price_function: called with the order side, returns the take profit and stop loss prices
+        of an opening order, None for no bracket. It runs on the event loop and should only read cached prices,
+        as bracket_price does from top_of_book
+        :param order_link_id_function: called without arguments, returns the order_link_id of an order
+        :param top_of_book: updated from the exchange's orderbook_stream by its own task
+        :param latency_report_every: print the signal to request latency histogram every that many orders
+        :param position_manager: local position state. When it is event driven, it is updated from the exchange's
+        private_stream by its own task, or by the caller's private websocket callbacks if the exchange has none.
+        By default the accepted orders are assumed filled and the position is queried every reconcile_interval
+        """
+        self.exchange = exchange
+        self.strategy = strategy
+        self.symbol = symbol
+        self.qty = qty
+        self.kline_queue = asyncio.Queue(maxsize=kline_queue_size)
+        self.order_queue = asyncio.Queue(maxsize=order_queue_size)
+        self.request_timeout = request_timeout
+        self.bracket_price_function = bracket_price_function
+        self.order_link_id_function = order_link_id_function
+        self.top_of_book = top_of_book
+        self.latency_report_every = latency_report_every
+        # time from the kline of a signal being received to its order request being sent
+        self.order_latency_histogram = LatencyHistogram()
+        self.position_manager = position_manager or PositionManager(symbol, event_driven=False,
+                                                                    reconcile_interval=reconcile_interval)
+        # an order is in flight, no new order is sent until its response or the next reconciliation
+        self.order_in_flight = False
+        self.reconcile_event = asyncio.Event()
+        self.stop_event = asyncio.Event()
+        self.signal_latency_list = deque(maxlen=1000)
+        self.stats = {"kline": 0, "dropped_kline": 0, "order": 0, "failed_order": 0, "timeout": 0}
+
+    @property
+    def holding_type(self):
+        return self.position_manager.holding_type
+
+    async def run(self):
+        """
+        Run until the kline stream ends or stop is called
+        :return: self.stats with the position manager's
+        """
+        # outside the task group, the orderbook and private feeds usually never end by themselves
+        feed_task_list = []
+        if self.top_of_book is not None:
+            feed_task_list.append(asyncio.create_task(self._ingest_orderbook()))
+        if self.position_manager.event_driven and hasattr(self.exchange, "private_stream"):
+            feed_task_list.append(asyncio.create_task(self._ingest_private()))
+        try:
+            async with asyncio.TaskGroup() as task_group:
+                task_group.create_task(self._ingest_kline())
+                task_group.create_task(self._compute_signal())
+                task_group.create_task(self._submit_order())
+                task_group.create_task(self._reconcile_position())
+        finally:
+            for feed_task in feed_task_list:
+                feed_task.cancel()
+        self.order_latency_histogram.report("Signal to order request latency")
+        return self.stats | self.position_manager.stats
+
+    def stop(self):
+        self.stop_event.set()
+        self.reconcile_event.set()
+
+    async def _request(self, coroutine):
+        """
+        Await an exchange request with the timeout
+        :return: the response, None on timeout or error
+        """
+        try:
+            return await asyncio.wait_for(coroutine, timeout=self.request_timeout)
+        except TimeoutError:
+            self.stats["timeout"] += 1
+            print(f"Exchange request timed out after {self.request_timeout}s")
+        except Exception as err:
+            print(f"Exchange request failed, {err=}, {type(err)=}")
+        return None
+
+    async def _ingest_kline(self):
+        try:
+            async for kline in self.exchange.kline_stream():
+                if self.stop_event.is_set():
+                    break
+                if self.kline_queue.full():
+                    # the signal task is behind, a stale kline is worth less than the latest one
+                    self.kline_queue.get_nowait()
+                    self.stats["dropped_kline"] += 1
+                self.kline_queue.put_nowait((time.perf_counter(), kline))
+        finally:
+            if self.kline_queue.full():
+                self.kline_queue.get_nowait()
+                self.stats["dropped_kline"] += 1
+            self.kline_queue.put_nowait(None)
+
+    async def _ingest_orderbook(self):
+        async for message in self.exchange.orderbook_stream():
+            if message:
+                self.top_of_book.update_from_message(message)
+
+    async def _ingest_private(self):
+        async for message in self.exchange.private_stream():
+            self.position_manager.on_message(message)
+
+    async def _compute_signal(self):
+        while (item := await self.kline_queue.get()) is not None:
+            received_time, kline = item
+            self.stats["kline"] += 1
+            signal = self.strategy.on_kline(kline)
+            if signal is not None and not self.order_in_flight and not self.position_manager.order_pending:
+                self._queue_order(received_time, *signal)
+            self.signal_latency_list.append(time.perf_counter() - received_time)
+        self.stop()
+        await self.order_queue.put(None)
+
+    def _queue_order(self, received_time: float, open_long_signal: bool, close_long_signal: bool,
+                     open_short_signal: bool, close_short_signal: bool):
+        holding_type = self.position_manager.holding_type
+        if holding_type == 'LONG' and close_long_signal:
+            action = "close_long"
+        elif holding_type == 'SHORT' and close_short_signal:
+            action = "close_short"
+        elif holding_type is None and open_long_signal:
+            action = "open_long"
+        elif holding_type is None and open_short_signal:
+            action = "open_short"
+        else:
+            return
+        self.order_in_flight = True
+        self.order_queue.put_nowait((received_time, action))
+
+    def _order_dict(self, action: str) -> dict:
+        side = "Buy" if action in ("open_long", "close_short") else "Sell"
+        order_dict = {"symbol": self.symbol, "side": side, "order_type": "Market", "qty": self.qty,
+                      "time_in_force": "GoodTillCancel", "reduce_only": action.startswith("close"),
+                      "close_on_trigger": False}
+        if self.order_link_id_function is not None:
+            order_dict["order_link_id"] = self.order_link_id_function()
+        return order_dict
+
+    async def _submit_order(self):
+        while (item := await self.order_queue.get()) is not None:
+            received_time, action = item
+            order_dict = self._order_dict(action)
+            if action.startswith("open") and self.bracket_price_function is not None:
+                try:
+                    take_profit_price, stop_loss_price = self.bracket_price_function(order_dict["side"])
+                except ValueError as err:
+                    print(f"Skip {action}, {err}")
+                    self.stats["failed_order"] += 1
+                    self.order_in_flight = False
+                    continue
+                order_dict |= {"take_profit": take_profit_price, "stop_loss": stop_loss_price}
+            self.stats["order"] += 1
+            self.order_latency_histogram.record(time.perf_counter() - received_time)
+            if self.order_latency_histogram.count % self.latency_report_every == 0:
+                self.order_latency_histogram.report("Signal to order request latency")
+            response = await self._request(self.exchange.place_active_order(**order_dict))
+            if response is not None and response.get("ret_msg") == "OK":
+                self.position_manager.on_order_response(order_dict["side"], order_dict["qty"], response)
+                self.order_in_flight = False
+            else:
+                self.stats["failed_order"] += 1
+                # the order may still have been filled, only the exchange knows
+                self.position_manager.mark_discrepancy()
+                self.reconcile_event.set()
+
+    async def _reconcile_position(self):
+        # the position manager only decides when to query, its checks cost no request
+        check_interval = min(self.position_manager.reconcile_interval, self.position_manager.mismatch_grace)
+        while not self.stop_event.is_set():
+            try:
+                await asyncio.wait_for(self.reconcile_event.wait(), timeout=check_interval)
+            except TimeoutError:
+                pass
+            self.reconcile_event.clear()
+            if self.stop_event.is_set():
+                break
+            if self.position_manager.needs_reconcile():
+                await self.reconcile()
+
+    async def reconcile(self):
+        """
+        Replace the local position with the exchange's, when the position manager can not be trusted
+        or has not been checked for reconcile_interval
+        """
+        response = await self._request(self.exchange.my_position(symbol=self.symbol))
+        if self.position_manager.apply_rest_position(response):
+            self.order_in_flight = False
+
+    def report_signal_latency(self):
+        """
+        Print the time from a kline being received to its signal being computed
+        """
+        latency_array = np.array(self.signal_latency_list) * 1e6
+        print(f"Signal latency over {len(latency_array)} klines, mean: {latency_array.mean():.2f}us, "
+              f"p50: {np.percentile(latency_array, 50):.2f}us, p99: {np.percentile(latency_array, 99):.2f}us")
+
+
+async def simulate(kline_count: int = 2000, kline_interval: float = 0.001, latency: float = 0.05,
+                   slow_call_rate: float = 0.05, request_timeout: float = 0.5, event_driven: bool = True,
+                   drop_event_rate: float = 0.01):
+    """
+    Run the Williams %R and MA strategy against the fake exchange, with slow responses hitting the timeout
+    :param kline_count:
+    :param kline_interval: seconds between two klines, far shorter than the request latency
+    :param latency: seconds every request takes
+    :param slow_call_rate: share of the requests slower than request_timeout
+    :param request_timeout:
+    :param event_driven: position from the private stream, otherwise from position queries every 10 latencies
+    :param drop_event_rate: share of the private messages lost, caught by the reconciliation
+    """
+    from fake_exchange import FakeExchange
+
+    exchange = FakeExchange(kline_count=kline_count, kline_interval=kline_interval, latency=latency,
+                            slow_call_rate=slow_call_rate, slow_call_latency=request_timeout * 4,
+                            drop_event_rate=drop_event_rate)
+    strategy = WilliamsRMAStrategy(reference_window=16, sub_window_multiplier=7)
+    top_of_book = TopOfBook(max_age=0.1)
+    position_manager = PositionManager(exchange.symbol, event_driven=event_driven,
+                                       reconcile_interval=60.0 if event_driven else latency * 10,
+                                       pending_timeout=request_timeout, mismatch_grace=latency * 2)
+    runtime = LiveRuntime(exchange=exchange, strategy=strategy, symbol=exchange.symbol, qty=1.0,
+                          request_timeout=request_timeout,
+                          bracket_price_function=lambda order_side: bracket_price(top_of_book, order_side,
+                                                                                  take_profit=2, stop_loss=1),
+                          top_of_book=top_of_book, position_manager=position_manager)
+    start = time.perf_counter()
+    stats = await runtime.run()
+    print(f"{kline_count} klines in {time.perf_counter() - start:.2f}s with {latency * 1000:.0f}ms requests, "
+          f"{stats}, exchange calls {exchange.call_count_dict}, "
+          f"position queries per kline {exchange.call_count_dict['my_position'] / kline_count:.3f}, "
+          f"final position local {position_manager.expected_size} exchange {exchange.position_size}")
+    runtime.report_signal_latency()
+    return runtime
+
+
+if __name__ == "__main__":
+    asyncio.run(simulate())
@@ -1,15 +1,23 @@
 import time
+import numpy as np
 import pandas as pd
-import math
 from pprint import pprint
 import matplotlib.pyplot as plt
 from alpha import Alpha
+from kline_store import KlineStore, default_store_dir
+from vectorized_engine import run_position_state_machine, drawdown_pct
+from performance import DrawdownTracker, tear_sheet, split_tear_sheet
+from reporting import decimate, get_writer, report_name
+from execution_model import ExecutionModel
 
 pd.set_option('display.max_columns', 500)
 pd.set_option('display.max_rows', 500)
 
 
 class Backtest:
+    # run charges the exit fee on the open price of the trade
+    exit_fee_on_close = False
+
     def __init__(self, para_dict: dict):
         """
 
@@ -22,13 +30,29 @@ class Backtest:
         self.first_window = para_dict["first_window"]
         self.second_window = para_dict["second_window"]
         self.sub_window_multiplier = para_dict["sub_window_multiplier"]
+        # first bar with every indicator defined
+        self.start_index = self.reference_window * self.sub_window_multiplier
         self.symbol = para_dict["symbol"]
         self.stop_loss = para_dict["stop_loss"]
         self.backtest_year = para_dict["backtest_year"]
         self.start_time = para_dict["start_time"]
         self.end_time = para_dict["end_time"]
+        self.invest_percentage = para_dict["invest_percentage"]
+        self.kline_store_dir = para_dict.get("kline_store_dir", default_store_dir)
+        self.verbose = para_dict.get("verbose", True)
+        # keep the per bar drawdown of run in self.drawdown_tracker.underwater_list
+        self.keep_drawdown_history = para_dict.get("keep_drawdown_history", False)
+        # write the plots, metrics and res_df there in the background instead of showing them
+        self.report_dir = para_dict.get("report_dir")
+        self.report_name = report_name(para_dict)
         self.taker_fee = 0.000
+        # fills, fees and funding of run_vectorized, every order filled at the close paying taker_fee by default.
+        # run only has the default fills and refuses another model
+        self.custom_execution = para_dict.get("execution_model") is not None
+        self.execution_model = para_dict.get("execution_model") or ExecutionModel(taker_fee=self.taker_fee,
+                                                                                 maker_fee=self.taker_fee)
         self.total_equity = self.initial_capital
+        self.metrics = {}
 
     def get_mongo_kline(self, interval: str):
         """
@@ -36,12 +60,32 @@ class Backtest:
         """
         current_timestamp = time.time()
         start_from = time.time() - 60 * 60 * 24 * 365 * self.backtest_year
-        # TODO : GET DATA FROM YOUR OWN SOURCE, AND SAVE EACH SYMBOL TO df_dict[sym] correspondingly
-        df = pd.DataFrame()
+        df = KlineStore(self.kline_store_dir).read_df(symbol=self.symbol, interval=interval, start=start_from,
+                                                      end=current_timestamp)
+        df['timestamp'] = df['open_time'].to_numpy(copy=True)
+        self.set_kline(df)
+
+    def get_csv_kline(self, csv_path: str):
+        """
+        Load the kline csv written by bybit/historical_kline_downloader.py
+        :param csv_path:
+        """
+        df = pd.read_csv(csv_path, index_col=0)
+        df = df.drop_duplicates(subset=['open_time']).sort_values('open_time').reset_index(drop=True)
+        df['timestamp'] = df['open_time']
+        self.set_kline(df)
+
+    def set_kline(self, df: pd.DataFrame):
+        """
+
+        :param df: kline with timestamp in seconds, open, high, low and close columns,
+        volume and turnover are kept when present for the execution model
+        """
         # Stupid way to convert timestamp to local timestamp
         df['timestamp'] += 60 * 60 * 8
         df["date_time"] = pd.to_datetime(df['timestamp'], unit='s')
-        df = df[["date_time", "open", "high", "low", "close"]]
+        df = df[["date_time", "open", "high", "low", "close"] +
+                [column for column in ("volume", "turnover") if column in df]]
         df.sort_index(inplace=True)
         self.df = Alpha(df).add_indicator(strategy_name=self.strategy_name, reference_window=self.reference_window,
                                           sub_window_multiplier=self.sub_window_multiplier)
@@ -117,17 +161,20 @@ class Backtest:
 
         :return:
         """
+        if self.custom_execution:
+            raise ValueError("run fills every order at the close paying taker_fee, use run_vectorized for an "
+                             "execution_model")
         open_price = 0
         num_of_lot = 0
         holding_position = None
         pos_opened = False
-        daily_equity_value_list = [self.initial_capital]
         equity_value_list = []
-        dd_pct_list = []
+        position_list = []
+        self.drawdown_tracker = DrawdownTracker(keep_history=self.keep_drawdown_history)
         win_count = 0
         lose_count = 0
         temp_capital = self.initial_capital
-        start_index = self.reference_window * self.sub_window_multiplier
+        start_index = self.start_index
         for i in range(start_index, len(self.df)):
             current_datetime = self.df.loc[i, 'date_time']
             now_close = self.df.loc[i, "close"]
@@ -145,9 +192,7 @@ class Backtest:
             else:
                 equity_value = temp_capital + (now_close - open_price) * num_of_lot
             equity_value_list.append(equity_value)
-            temp_max_equity = max(equity_value_list)
-            dd_pct = (temp_max_equity - equity_value) / temp_max_equity
-            dd_pct_list.append(dd_pct)
+            self.drawdown_tracker.update(equity_value)
             if pos_opened:
                 close_long_signal, close_short_signal = \
                     self.check_stop_loss(close_long_signal=close_long_signal, close_short_signal=close_short_signal,
@@ -177,42 +222,121 @@ class Backtest:
                     pos_opened = True
                     holding_position = 'LONG'
                     open_price = now_close
-                    num_of_lot = equity_value * para_dict["invest_percentage"] / 100 / now_close
+                    num_of_lot = equity_value * self.invest_percentage / 100 / now_close
                     temp_capital = temp_capital - num_of_lot * open_price * self.taker_fee
 
                 elif open_short_signal:
                     pos_opened = True
                     holding_position = 'SHORT'
                     open_price = now_close
-                    num_of_lot = equity_value * para_dict["invest_percentage"] / 100 / now_close
+                    num_of_lot = equity_value * self.invest_percentage / 100 / now_close
                     temp_capital = temp_capital - num_of_lot * open_price * self.taker_fee
+            position_list.append(1 if holding_position == 'LONG' else -1 if holding_position == 'SHORT' else 0)
 
         date_list = self.df.loc[start_index:len(self.df) - 1, 'date_time'].to_list()
-        for i in range(1, len(equity_value_list) - 1):
-            if date_list[i].date() != date_list[i - 1].date():
-                daily_equity_value_list.append(equity_value_list[i - 1])
-        equity_value_series = pd.Series(daily_equity_value_list)
-        strategy_return_series = equity_value_series.pct_change()
-        return_mean_pct = 100 * strategy_return_series.mean()
-        return_sd_pct = 100 * strategy_return_series.std()
-        sharpe_ratio = return_mean_pct / return_sd_pct * math.sqrt(256)
-        neg_strategy_return_series = pd.Series(filter(lambda x: x < 0, strategy_return_series))
-        neg_return_sd_pct = 100 * neg_strategy_return_series.std()
-        sortino_ratio = return_mean_pct / neg_return_sd_pct * math.sqrt(256)
-        net_profit = (equity_value_list[-1] - equity_value_list[0]) / equity_value_list[0] * 100
-        mdd_pct = 100 * max(dd_pct_list)
-        calmar_ratio = net_profit / mdd_pct
-        win_rate = win_count / (win_count + lose_count)
-        num_of_trade = win_count + lose_count
-        pprint(
-            f"{sharpe_ratio = }, {mdd_pct = } , {sortino_ratio = } , {calmar_ratio = } , {net_profit = }, {win_rate = }, {num_of_trade = }")
-        res_df = pd.DataFrame({'datetime': date_list, "equity": equity_value_list})
+        return self._report(date_list=date_list, equity_value_list=equity_value_list,
+                            mdd_pct=self.drawdown_tracker.max_drawdown, position_list=position_list,
+                            win_count=win_count, lose_count=lose_count)
+
+    def vectorized_signal_generator(self, date_time: pd.Series, close: np.ndarray, indicator_dict) -> tuple:
+        """
+        Signals of run for every bar at once, close and the indicators are either one column or a
+        (time x symbol) matrix
+        :param date_time: date_time of every bar
+        :param close:
+        :param indicator_dict: indicator name to values, the kline DataFrame or the dict of AlphaMatrix
+        :return: open long, open short, close long, close short, bars which keep the signals of the previous bar
+        """
+        date_time = date_time.dt
+        weekday = ~date_time.weekday.isin((5, 6)).to_numpy()
+        is_start_trade = ((date_time.hour == 7) & (date_time.minute == 45)).to_numpy() & weekday
+        in_trading_hours = ((date_time.hour >= self.start_time) & (date_time.hour <= (self.end_time - 1))).to_numpy() \
+            & weekday & ~is_start_trade
+        if np.ndim(close) == 2:
+            in_trading_hours = in_trading_hours[:, None]
+        williamsR = np.asarray(indicator_dict[self.strategy_name.lower().split('_')[0]])
+        ma = np.asarray(indicator_dict[self.strategy_name.lower().split('_')[1]])
+        open_long = in_trading_hours & (williamsR < self.first_window) & (close > ma)
+        open_short = in_trading_hours & (williamsR > self.second_window) & (close < ma)
+        close_long = ~in_trading_hours | (williamsR > self.second_window)
+        close_short = ~in_trading_hours | (williamsR < self.first_window)
+        return open_long, open_short, close_long, close_short, is_start_trade
+
+    def run_vectorized(self, start_index: int = None, end_index: int = None):
+        """
+        Same backtest as run, with the signals, the trading hours mask, drawdown and daily equity computed on
+        whole arrays and only the position state machine walking the bars
+        :param start_index: first row of self.df to trade, the indicators are still computed on every row before it
+        :param end_index: row after the last one to trade, None for the end of self.df
+        :return:
+        """
+        df = self.df.iloc[max(self.start_index, start_index or 0):end_index]
+        close = df["close"].to_numpy(dtype=np.float64)
+        open_long, open_short, close_long, close_short, hold_previous = self.vectorized_signal_generator(
+            date_time=df['date_time'], close=close, indicator_dict=df)
+        equity_value_array, position_array, win_count, lose_count = run_position_state_machine(
+            close=close, open_long=open_long, open_short=open_short, close_long=close_long,
+            close_short=close_short, hold_previous=hold_previous, initial_capital=self.initial_capital,
+            stop_loss=self.stop_loss, invest_percentage=self.invest_percentage, taker_fee=self.taker_fee,
+            exit_fee_on_close=self.exit_fee_on_close,
+            execution=self.execution_model.kline_arrays(
+                df, order_notional=self.initial_capital * self.invest_percentage / 100, utc_offset=60 * 60 * 8,
+                symbol=self.symbol))
+        date_list = df['date_time'].to_list()
+        return self._report(date_list=date_list, equity_value_list=equity_value_array,
+                            mdd_pct=np.max(drawdown_pct(equity_value_array)),
+                            position_list=position_array, win_count=win_count,
+                            lose_count=lose_count)
+
+    def _report(self, date_list: list, equity_value_list, mdd_pct: float, position_list, win_count: int,
+                lose_count: int):
+        """
+
+        :param date_list:
+        :param equity_value_list:
+        :param mdd_pct: max drawdown as a fraction
+        :param position_list: position held after every bar
+        :param win_count:
+        :param lose_count:
+        :return:
+        """
+        equity_value_list = np.asarray(equity_value_list, dtype=np.float64)
+        date_array = pd.DatetimeIndex(date_list).to_numpy()
+        self.metrics, self.daily_equity_value_list, self.rolling_sharpe_list = split_tear_sheet(tear_sheet(
+            date_time=date_array, equity_value_array=equity_value_list,
+            initial_capital=self.initial_capital, mdd=mdd_pct, position_array=position_list, win_count=win_count,
+            lose_count=lose_count))
+        res_df = pd.DataFrame({'datetime': date_array, "equity": equity_value_list})
+        curve_dict = {"equity": (date_array, equity_value_list / self.initial_capital)}
+        if self.report_dir:
+            get_writer(self.report_dir).submit(self.report_name, res_df, curve_dict, metrics=self.metrics)
+        if not self.verbose or self.report_dir:
+            return res_df
+        pprint(self.metrics)
         plt.figure(figsize=(40, 20))
-        plt.plot(date_list, [i / self.initial_capital for i in equity_value_list])
+        plt.plot(*decimate(*curve_dict["equity"]))
         plt.show()
         return res_df
 
 
+def compare_run_mode(para_dict: dict, csv_path: str):
+    """
+    Assert that run_vectorized reproduces the bar loop of run bar for bar
+    :param para_dict:
+    :param csv_path:
+    :return:
+    """
+    loop_backtest = Backtest(para_dict)
+    loop_backtest.get_csv_kline(csv_path=csv_path)
+    loop_res_df = loop_backtest.run()
+    vectorized_backtest = Backtest(para_dict)
+    vectorized_backtest.get_csv_kline(csv_path=csv_path)
+    vectorized_res_df = vectorized_backtest.run_vectorized()
+    pd.testing.assert_frame_equal(loop_res_df, vectorized_res_df, check_exact=True)
+    assert loop_backtest.metrics == vectorized_backtest.metrics, (loop_backtest.metrics, vectorized_backtest.metrics)
+    return loop_res_df
+
+
 if __name__ == "__main__":
     symbol = "SOLUSDT"
     para_dict = {"strategy_name": "williamsR_MA", "first_window": -85, "second_window": -15,
@@ -222,3 +346,5 @@ if __name__ == "__main__":
     backtest = Backtest(para_dict)
     backtest.get_mongo_kline(interval=interval)
     save_csv = backtest.run()
+    # save_csv = backtest.run_vectorized()
+    # compare_run_mode(para_dict=para_dict, csv_path="../bybit/bybit_SANDUSDT_30_kline.csv")
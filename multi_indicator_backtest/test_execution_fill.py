@@ -0,0 +1,60 @@
+import numpy as np
+import pandas as pd
+import pytest
+from multi_indicator_backtest.backtest import Backtest
+from execution_model import ExecutionModel
+
+para_dict = {"strategy_name": "williamsR_MA", "first_window": -85, "second_window": -15, "reference_window": 16,
+             "sub_window_multiplier": 7, "stop_loss": 1, "backtest_year": 1, "invest_percentage": 100,
+             "symbol": "SANDUSDT", "start_time": 8, "end_time": 17, "verbose": False}
+
+
+class SignalBacktest(Backtest):
+    """
+    Long on the first bar and never closed on a signal
+    """
+    def vectorized_signal_generator(self, date_time: pd.Series, close: np.ndarray, indicator_dict) -> tuple:
+        n = len(close)
+        no_signal = np.zeros(n, dtype=bool)
+        return np.arange(n) == 0, no_signal, no_signal, no_signal, no_signal
+
+
+def make_backtest(execution_model: ExecutionModel) -> SignalBacktest:
+    backtest = SignalBacktest(para_dict | {"execution_model": execution_model})
+    # hourly bars from 06:00 UTC, the funding of 08:00 UTC is paid on the third bar
+    backtest.df = pd.DataFrame({
+        "date_time": pd.date_range("2022-01-03 14:00", periods=5, freq="h"),
+        "open": [100.0, 100.0, 101.0, 101.5, 100.0], "high": [100.5, 101.5, 102.5, 102.0, 100.5],
+        "low": [99.5, 100.5, 101.5, 98.5, 99.5], "close": [100.0, 101.0, 102.0, 100.0, 100.0]})
+    backtest.start_index = 0
+    return backtest
+
+
+def test_maker_entry_funding_and_intrabar_stop():
+    backtest = make_backtest(ExecutionModel(taker_fee=0.001, maker_fee=0.0002, entry_order="maker",
+                                            funding_rate=0.0001, intrabar_stop=True))
+    res_df = backtest.run_vectorized()
+    # maker entry of 100 lots at 100: 10000 - 100 * 100 * 0.0002
+    capital = 9998.0
+    expected = [10000.0, capital + (101 - 100) * 100]
+    # funding on the open price of the funding bar, paid by the long
+    capital -= 100 * 101.0 * 0.0001
+    expected += [capital + (102 - 100) * 100, capital]
+    # the low of the fourth bar crosses the stop at 99, filled at the stop price paying the taker fee on the
+    # open price of the trade
+    capital += (99 - 100) * 100 - 100 * 100 * 0.001
+    expected.append(capital)
+    np.testing.assert_allclose(res_df["equity"], expected)
+    assert backtest.metrics["num_of_trade"] == 1
+
+
+def test_close_fills_without_an_execution_model():
+    backtest = make_backtest(None)
+    res_df = backtest.run_vectorized()
+    # the default model fills at the close paying taker_fee, the stop is checked on the close only
+    np.testing.assert_allclose(res_df["equity"], [10000.0, 10100.0, 10200.0, 10000.0, 10000.0])
+
+
+def test_run_refuses_an_execution_model():
+    with pytest.raises(ValueError, match="use run_vectorized"):
+        make_backtest(ExecutionModel(funding_rate=0.0001)).run()
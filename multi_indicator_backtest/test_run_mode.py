@@ -0,0 +1,15 @@
+import os
+import pytest
+from multi_indicator_backtest.backtest import compare_run_mode
+
+csv_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "bybit", "bybit_SANDUSDT_30_kline.csv")
+
+
+@pytest.mark.parametrize("stop_loss, start_time, end_time", [(1, 8, 17), (0.05, 0, 24), (0.02, 2, 20)])
+def test_run_vectorized_matches_run(stop_loss, start_time, end_time):
+    para_dict = {"strategy_name": "williamsR_MA", "first_window": -85, "second_window": -15,
+                 "reference_window": 16, "sub_window_multiplier": 7, "stop_loss": stop_loss, "backtest_year": 1,
+                 "invest_percentage": 100, "symbol": "SANDUSDT", "start_time": start_time, "end_time": end_time,
+                 "verbose": False}
+    res_df = compare_run_mode(para_dict=para_dict, csv_path=csv_path)
+    assert len(res_df) > 0
@@ -1,8 +1,15 @@
 from pybit import usdt_perpetual
+from collections import deque
+import asyncio
 import os
+import time
+import numpy as np
 import pybit.exceptions
 import logging
 import inspect
+from indicator import StreamingWilliamsRMA
+from live_runtime import LiveRuntime, AsyncBybitExchange, TopOfBook, LatencyHistogram, bracket_price
+from position_manager import PositionManager
 
 logging.getLogger("urllib3").setLevel(logging.ERROR)
 logging.getLogger("pybit").setLevel(logging.ERROR)
@@ -23,6 +30,10 @@ take_profit = trading_config['take_profit']
 stop_loss = trading_config['stop_loss']
 reference_window = trading_config['reference_window']
 sub_window_multiplier = trading_config["sub_window_multiplier"]
+# seconds after the last orderbook message before the take profit and stop loss prices are refused
+orderbook_max_age = trading_config.get("orderbook_max_age", 2)
+# seconds between two REST position queries while the private stream and the local position agree
+position_reconcile_interval = trading_config.get("position_reconcile_interval", 300)
 
 strategy_name = setting_config['strategy_name']
 
@@ -40,75 +51,87 @@ class Alpha:
             endpoint="https://api.bybit.com",
             api_key=api_key,
             api_secret=api_secret)
+        self.session_ws = usdt_perpetual.WebSocket(test=False, api_key=api_key, api_secret=api_secret)
         self.api_key = api_key
         self.api_secret = api_secret
         self.invest_amount = invest_amount
         self.position_opened = False
         self.holding_type = None
-        self.data_list = self.get_past_kline_data(reference_window=reference_window)
-        self.ma_list = self.get_past_kline_data(reference_window=sub_window_multiplier * reference_window)
+        self.indicator_state = StreamingWilliamsRMA(reference_window=reference_window,
+                                                    ma_window=sub_window_multiplier * reference_window)
+        for kline in self.get_past_kline_data(reference_window=sub_window_multiplier * reference_window):
+            self.indicator_state.update(high=float(kline['high']), low=float(kline['low']),
+                                        close=float(kline['close']))
+        self.update_latency_list = deque(maxlen=1000)
+        # best bid/ask of the streaming orderbook feed, read by the take profit and stop loss pricing
+        self.top_of_book = TopOfBook(max_age=orderbook_max_age)
+        self.signal_time = time.perf_counter()
+        self.order_latency_histogram = LatencyHistogram()
+        # position kept from the private order, execution and position messages, read on every kline
+        self.position_manager = PositionManager(symbol, reconcile_interval=position_reconcile_interval)
         self.group_name = f'williamsR'
         self.qty = int((float(invest_amount) / self.get_current_price()) * 1000) / 1000
 
     def percentage_r_calculator(self):
         """
-        Calculate the william R number
+        The william R number of the latest kline, kept up to date by self.indicator_state
         :return:
         """
-        percentage_r = -50
-        try:
-            lowest_price = min([data['low'] for data in self.data_list])
-            highest_price = max([data['high'] for data in self.data_list])
-            percentage_r = (highest_price - self.data_list[-1]['close']) / (highest_price - lowest_price) * -100
-        except BaseException as err:
-            print(f"In function {inspect.stack()[0][3]}, Unexpected {err=}, {type(err)=}")
-        else:
-            return percentage_r
+        percentage_r = self.indicator_state.williams_r
+        return -50 if np.isnan(percentage_r) else percentage_r
 
     def ma_calculator(self):
-        ma = "UP"
-        current_close = self.data_list[-1]['close']
-        current_ma = sum([data['high'] for data in self.data_list]) / len([data['high'] for data in self.data_list])
-        if current_close > current_ma:
+        """
+        Whether the latest close is above the moving average of the close, as in the backtest
+        :return:
+        """
+        if self.indicator_state.close > self.indicator_state.ma:
             ma = "UP"
         else:
             ma = "DOWN"
         return ma
 
+    def report_update_latency(self):
+        """
+        Print the indicator update latency over the last klines
+        """
+        latency_array = np.array(self.update_latency_list) / 1000
+        print(f"Indicator update latency over {len(latency_array)} klines, mean: {latency_array.mean():.2f}us, "
+              f"p50: {np.percentile(latency_array, 50):.2f}us, p99: {np.percentile(latency_array, 99):.2f}us")
+
+    @staticmethod
+    def get_orderbook_generator():
+        """
+        One orderbook generator for the whole session, its messages keep self.top_of_book up to date
+        """
+        return client_consumer.get_orderbook_history(exchange=exchange, asset_type=asset_type, symbol=symbol)
+
     def get_take_profit_price(self, order_side):
         """
-        This method generate the take profit and stop loss price base on the orderBook bid/ask and the custom parameters
-        """
-        orderbook_generator = client_consumer.get_orderbook_history(exchange=exchange, asset_type=asset_type,
-                                                                    symbol=symbol)
-        message = next(orderbook_generator)
-        data = message[0]
-        if message:
-            best_ask = data['ask'][0][0]
-            best_bid = data['bid'][0][0]
-        if order_side == "Buy":
-            take_profit_price = int(best_ask * (1 + take_profit / 100))
-        elif order_side == "Sell":
-            take_profit_price = int(best_bid * (1 - take_profit / 100))
-        return take_profit_price
+        This method generate the take profit price base on the cached orderBook bid/ask and the custom parameters
+        """
+        return bracket_price(self.top_of_book, order_side, take_profit=take_profit, stop_loss=0)[0]
 
     def get_stop_loss_price(self, order_side):
         """
-        This method generate the stop loss price base on the orderBook bid/ask and the custom parameters
+        This method generate the stop loss price base on the cached orderBook bid/ask and the custom parameters
         """
-        orderbook_generator = client_consumer.get_orderbook_history(exchange=exchange, asset_type=asset_type,
-                                                                    symbol=symbol)
+        return bracket_price(self.top_of_book, order_side, take_profit=0, stop_loss=stop_loss)[1]
 
-        message = next(orderbook_generator)
-        data = message[0]
-        if message:
-            best_ask = data['ask'][0][0]
-            best_bid = data['bid'][0][0]
-        if order_side == "Buy":
-            stop_loss_price = int(best_ask * (1 - stop_loss / 100))
-        elif order_side == "Sell":
-            stop_loss_price = int(best_bid * (1 + stop_loss / 100))
-        return stop_loss_price
+    def get_bracket_price(self, order_side):
+        """
+        Take profit and stop loss prices of an opening order from one read of the cached bid/ask,
+        None when the parameter is 0, ValueError when the orderbook is stale
+        """
+        return bracket_price(self.top_of_book, order_side, take_profit=take_profit, stop_loss=stop_loss)
+
+    def record_order_latency(self):
+        """
+        Record the time from the signal to the order request, and print the histogram every 100 orders
+        """
+        self.order_latency_histogram.record(time.perf_counter() - self.signal_time)
+        if self.order_latency_histogram.count % 100 == 0:
+            self.order_latency_histogram.report("Signal to order request latency")
 
     def get_past_kline_data(self, reference_window: int):
         """
@@ -137,6 +160,28 @@ class Alpha:
         close_short_signal = percentage_r < -85
         return open_long_signal, close_long_signal, open_short_signal, close_short_signal
 
+    def on_kline(self, message: dict):
+        """
+        Update the William_R and MA state with a new kline and generate the trading signals
+        :param message: kline message with high, low and close
+        :return: open_long, close_long, open_short, close_short signals, None until the indicators are ready
+        """
+        self.signal_time = time.perf_counter()
+        # Extract essential key value to
+        ohl_dict = {key: value for key, value in message.items() if key in ('high', 'close', 'low')}
+        # Update the William_R and MA state with the new kline in constant time
+        update_start = time.perf_counter_ns()
+        self.indicator_state.update(high=float(ohl_dict['high']), low=float(ohl_dict['low']),
+                                    close=float(ohl_dict['close']))
+        self.update_latency_list.append(time.perf_counter_ns() - update_start)
+        if self.indicator_state.count % self.update_latency_list.maxlen == 0:
+            self.report_update_latency()
+        if not self.indicator_state.ready:
+            return None
+        percentage_r = self.percentage_r_calculator()
+        ma = self.ma_calculator()
+        return Alpha.trading_signal_generator(percentage_r, ma)
+
     def query_current_position(self):
         """
         This method check current position
@@ -156,14 +201,37 @@ class Alpha:
             print(f"In function {inspect.stack()[0][3]}, Unexpected {err=}, {type(err)=}")
         return no_position
 
+    def subscribe_private_stream(self):
+        """
+        Feed the order, execution and position messages of the private websocket to self.position_manager,
+        the callbacks run in the websocket thread
+        """
+        self.session_ws.order_stream(self.position_manager.on_message)
+        self.session_ws.execution_stream(self.position_manager.on_message)
+        self.session_ws.position_stream(self.position_manager.on_message)
+
+    def reconcile_position(self):
+        """
+        Replace the cached position with the REST one, only when self.position_manager asks for it
+        """
+        try:
+            self.position_manager.apply_rest_position(self.session_auth.my_position(symbol=symbol))
+        except pybit.exceptions.InvalidRequestError as e:
+            print(f"Invalid request ERROR when querying position, {e}")
+        except pybit.exceptions.FailedRequestError as e:
+            print(f"Fail request ERROR when querying position, {e}")
+        except BaseException as err:
+            print(f"In function {inspect.stack()[0][3]}, Unexpected {err=}, {type(err)=}")
+
     def open_long_position(self):
         """
         This method execute the market buy order wtih stop loss and take profit
         """
         order_side = "Buy"
-        take_profit_price = self.get_take_profit_price(order_side=order_side) if take_profit != 0 else None
-        stop_loss_price = self.get_stop_loss_price(order_side=order_side) if stop_loss != 0 else None
+        take_profit_price = stop_loss_price = None
         try:
+            take_profit_price, stop_loss_price = self.get_bracket_price(order_side=order_side)
+            self.record_order_latency()
             response = self.session_auth.place_active_order(symbol=symbol, side=order_side,
                                                             order_type="Market",
                                                             qty=self.qty, time_in_force="GoodTillCancel",
@@ -183,6 +251,7 @@ class Alpha:
         else:
             if response['ret_msg'] == "OK":
                 print(f"Successfully place buy order {response}")
+                self.position_manager.on_order_response(order_side, self.qty, response)
                 return True
             else:
                 print(f"An ERROR occurred in function {inspect.stack()[0][3]}, bybit ret_msg not OK, unknown error")
@@ -193,9 +262,10 @@ class Alpha:
         This method execute the market sell order wtih stop loss and take profit
         """
         order_side = "Sell"
-        take_profit_price = self.get_take_profit_price(order_side=order_side) if take_profit != 0 else None
-        stop_loss_price = self.get_stop_loss_price(order_side=order_side) if stop_loss != 0 else None
+        take_profit_price = stop_loss_price = None
         try:
+            take_profit_price, stop_loss_price = self.get_bracket_price(order_side=order_side)
+            self.record_order_latency()
             response = self.session_auth.place_active_order(symbol=symbol, side=order_side,
                                                             order_type="Market",
                                                             qty=self.qty, time_in_force="GoodTillCancel",
@@ -217,6 +287,7 @@ class Alpha:
         else:
             if response['ret_msg'] == "OK":
                 print(f"Successfully place sell order {response}")
+                self.position_manager.on_order_response(order_side, self.qty, response)
                 return True
             else:
                 print(f"An ERROR occurred in function {inspect.stack()[0][3]}, bybit ret_msg not OK, unknow error")
@@ -227,6 +298,7 @@ class Alpha:
         This method close long position
         """
         try:
+            self.record_order_latency()
             response = self.session_auth.place_active_order(symbol=symbol, side="Sell",
                                                             order_type="Market",
                                                             qty=self.qty, time_in_force="GoodTillCancel",
@@ -246,6 +318,7 @@ class Alpha:
         else:
             if response['ret_msg'] == "OK":
                 print(f"Successfully place close long position {response}")
+                self.position_manager.on_order_response("Sell", self.qty, response)
                 return True
             else:
                 print(f"bybit ret_msg not OK, unknow ERROR occurred")
@@ -256,6 +329,7 @@ class Alpha:
         This method close short position
         """
         try:
+            self.record_order_latency()
             response = self.session_auth.place_active_order(symbol=symbol, side="Buy",
                                                             order_type="Market",
                                                             qty=self.qty, time_in_force="GoodTillCancel",
@@ -272,6 +346,7 @@ class Alpha:
         else:
             if response['ret_msg'] == "OK":
                 print(f"Successfully place close short position {response}")
+                self.position_manager.on_order_response("Buy", self.qty, response)
                 return True
             else:
                 print(f"bybit ret_msg not OK, unknow ERROR occurred")
@@ -282,22 +357,14 @@ class Alpha:
         Start the trading program
         :return:
         """
+        self.top_of_book.follow(self.get_orderbook_generator())
+        self.subscribe_private_stream()
         # Get data through the redis
         # TODO : For loop your data source
             try:
-                # Extract essential key value to
-                ohl_dict = {key: value for key, value in message.items() if key in ('high', 'close', 'low')}
-                # Append the new kline data into self.data_list for calculate the William_R
-                self.data_list.append(ohl_dict)
-                self.ma_list.append(ohl_dict)
-                if len(self.data_list) > reference_window:
-                    self.data_list = self.data_list[1:]
-                if len(self.ma_list) > reference_window * sub_window_multiplier:
-                    self.ma_list = self.ma_list[1:]
-                    percentage_r = self.percentage_r_calculator()
-                    ma = self.ma_calculator()
-                    open_long_signal, close_long_signal, open_short_signal, close_short_signal \
-                        = Alpha.trading_signal_generator(percentage_r, ma)
+                signal = self.on_kline(message)
+                if signal is not None:
+                    open_long_signal, close_long_signal, open_short_signal, close_short_signal = signal
                     # If self.position_opened == True, check if it has close long or close signal,
                     # if yes, follow the signal to close current position
                     if self.position_opened:
@@ -306,15 +373,21 @@ class Alpha:
                             if self.close_short_position():
                                 self.position_opened = False
                                 self.holding_type = None
+                            else:
+                                self.position_manager.mark_discrepancy()
                         elif (close_long_signal is True) and (self.holding_type == 'LONG'):
                             # Close longing position
                             if self.close_long_position():
                                 self.position_opened = False
                                 self.holding_type = None
-                    # Checkout position size, if self.query_current_position() return True,
-                    # it means no position currently has
-                    if self.query_current_position():
-                        self.position_opened = False
+                            else:
+                                self.position_manager.mark_discrepancy()
+                    # Checkout position from the private stream, take profits and stop losses close it without
+                    # any signal. REST is only queried on a discrepancy or every position_reconcile_interval
+                    if self.position_manager.needs_reconcile():
+                        self.reconcile_position()
+                    self.holding_type = self.position_manager.holding_type
+                    self.position_opened = self.holding_type is not None
                     # If self.position_opened == False, check if it has open long or short signal,
                     # if yes, follow the signal to execute trade
                     if not self.position_opened:
@@ -323,10 +396,32 @@ class Alpha:
                             if self.open_long_position():
                                 self.holding_type = 'LONG'
                                 self.position_opened = True
+                            else:
+                                self.position_manager.mark_discrepancy()
                         elif open_short_signal:
                             # Open short position
                             if self.open_short_position():
                                 self.holding_type = 'SHORT'
                                 self.position_opened = True
+                            else:
+                                self.position_manager.mark_discrepancy()
             except Exception as err:
-                print(f"In function {inspect.stack()[0][3]}, Super Unexpected {err=}, {type(err)=}")
\ No newline at end of file
+                print(f"In function {inspect.stack()[0][3]}, Super Unexpected {err=}, {type(err)=}")
+
+    def run_async(self, kline_iterator):
+        """
+        Start the trading program on the asyncio runtime, where the kline ingestion, the signals, the orders and
+        the position queries are separate tasks, so a slow exchange response no longer delays the next kline
+        :param kline_iterator: blocking iterator of the kline messages of your data source
+        :return: runtime statistics
+        """
+        runtime = LiveRuntime(exchange=AsyncBybitExchange(session_auth=self.session_auth,
+                                                          kline_iterator=kline_iterator,
+                                                          orderbook_iterator=self.get_orderbook_generator()),
+                              strategy=self, symbol=symbol, qty=self.qty,
+                              bracket_price_function=self.get_bracket_price,
+                              order_link_id_function=lambda: generate_uid(strategy_name=strategy_name,
+                                                                          client_api=self.api_key),
+                              top_of_book=self.top_of_book, position_manager=self.position_manager)
+        self.subscribe_private_stream()
+        return asyncio.run(runtime.run())
@@ -0,0 +1,217 @@
+import itertools
+import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+import pandas as pd
+from indicator_cache import indicator_cache
+
+kline_column_list = ["timestamp", "open", "high", "low", "close"]
+# shared as well when present, the execution model derives the slippage from the turnover
+optional_kline_column_list = ["volume", "turnover"]
+metric_column_list = ["sharpe_ratio", "sortino_ratio", "calmar_ratio", "mdd_pct", "net_profit", "exposure",
+                      "turnover", "win_rate", "num_of_trade", "avg_holding_bar"]
+# metrics where the smallest value ranks first, mdd_pct is a positive drawdown
+ascending_metric_set = {"mdd_pct"}
+
+# Set once per worker process by _init_worker
+_worker_kline_df = None
+_worker_backtest_class = None
+
+
+def _to_shared_memory(kline_df: pd.DataFrame):
+    """
+    Copy the kline columns into shared memory blocks, so every worker maps the same buffers instead of
+    receiving a pickled DataFrame
+    :param kline_df: kline with timestamp in seconds, open, high, low and close columns, optionally volume and turnover
+    :return: shared memory blocks, layout of (column, block name, dtype, length)
+    """
+    shm_list = []
+    layout = []
+    for column in kline_column_list + [column for column in optional_kline_column_list if column in kline_df]:
+        array = kline_df[column].to_numpy(dtype=np.int64 if column == "timestamp" else np.float64)
+        shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[:] = array
+        shm_list.append(shm)
+        layout.append((column, shm.name, array.dtype.str, len(array)))
+    return shm_list, layout
+
+
+def _init_worker(backtest_class, layout: list):
+    """
+    Build the worker's kline DataFrame once from the shared memory blocks
+    :param backtest_class:
+    :param layout:
+    """
+    global _worker_kline_df, _worker_backtest_class
+    data_dict = {}
+    for column, name, dtype, length in layout:
+        shm = shared_memory.SharedMemory(name=name)
+        data_dict[column] = np.ndarray((length,), dtype=np.dtype(dtype), buffer=shm.buf).copy()
+        shm.close()
+    _worker_kline_df = pd.DataFrame(data_dict)
+    _worker_backtest_class = backtest_class
+
+
+def metric_ascending(metric: str) -> bool:
+    """
+    Whether the smallest value of the metric is the best, the ratio and profit metrics rank descending
+    """
+    return metric in ascending_metric_set
+
+
+def _run_one(para_dict: dict) -> dict:
+    """
+
+    :param para_dict:
+    :return: the swept parameters together with the backtest metrics, and the error of a failed backtest
+    """
+    backtest = _worker_backtest_class(para_dict | {"verbose": False})
+    cache_stats = indicator_cache.stats()
+    try:
+        backtest.set_kline(_worker_kline_df.copy())
+        backtest.run_vectorized()
+        metrics = backtest.metrics | {"error": None}
+    except (ValueError, IndexError, ZeroDivisionError) as err:
+        print(f"Fail to backtest {para_dict}, {err=}")
+        metrics = {metric: np.nan for metric in metric_column_list} | {"error": repr(err)}
+    cache_delta = {f"_cache_{key}": indicator_cache.stats()[key] - cache_stats[key]
+                   for key in ("hit", "disk_hit", "miss")}
+    return para_dict | metrics | cache_delta
+
+
+def grid_combinations(param_grid: dict) -> list:
+    """
+
+    :param param_grid: parameter name to the list of values to sweep
+    :return: every combination of the parameter values
+    """
+    keys = list(param_grid.keys())
+    return [dict(zip(keys, values)) for values in itertools.product(*param_grid.values())]
+
+
+def random_combinations(param_grid: dict, n_iter: int, seed: int = None) -> list:
+    """
+
+    :param param_grid: parameter name to the list of values to sample from
+    :param n_iter: number of distinct combinations to draw
+    :param seed:
+    :return:
+    """
+    keys = list(param_grid.keys())
+    value_list = list(param_grid.values())
+    total = int(np.prod([len(values) for values in value_list]))
+    rng = random.Random(seed)
+    res_list = []
+    for flat_index in rng.sample(range(total), min(n_iter, total)):
+        combination = {}
+        for key, values in zip(reversed(keys), reversed(value_list)):
+            flat_index, value_index = divmod(flat_index, len(values))
+            combination[key] = values[value_index]
+        res_list.append({key: combination[key] for key in keys})
+    return res_list
+
+
+def run_sweep(backtest_class, base_para_dict: dict, combination_list: list, kline_df: pd.DataFrame,
+              max_workers: int = None, rank_by: str = "sharpe_ratio", chunksize: int = None) -> pd.DataFrame:
+    """
+    Backtest every parameter combination across a process pool
+    :param backtest_class: Backtest class of single_indicator_backtest or multi_indicator_backtest
+    :param base_para_dict: para_dict shared by all the combinations
+    :param combination_list: parameter overrides, one dict per backtest
+    :param kline_df: kline with timestamp in seconds, open, high, low and close columns
+    :param max_workers:
+    :param rank_by: metric to sort the result table by, ascending for mdd_pct and descending for the others
+    :param chunksize: combinations sent to a worker per round trip, default splits the sweep in 4 chunks per worker
+    :return: ranked result table, the failed combinations last with NaN metrics and their error in the error column,
+    also listed in res_df.attrs["failed"]
+    """
+    para_dict_list = [base_para_dict | combination for combination in combination_list]
+    shm_list, layout = _to_shared_memory(kline_df)
+    max_workers = max_workers or os.cpu_count()
+    if chunksize is None:
+        chunksize = max(1, len(para_dict_list) // (max_workers * 4))
+    start = time.time()
+    try:
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker,
+                                 initargs=(backtest_class, layout)) as executor:
+            res_list = list(executor.map(_run_one, para_dict_list, chunksize=chunksize))
+    finally:
+        for shm in shm_list:
+            shm.close()
+            shm.unlink()
+    res_df = pd.DataFrame(res_list)
+    cache_column_list = [column for column in res_df.columns if column.startswith("_cache_")]
+    res_df.attrs["indicator_cache"] = {column[len("_cache_"):]: int(res_df[column].sum())
+                                       for column in cache_column_list}
+    res_df.drop(columns=cache_column_list, inplace=True)
+    res_df.attrs["failed"] = res_df.loc[res_df["error"].notna(), list(combination_list[0]) + ["error"]].to_dict(
+        "records") if combination_list else []
+    print(f"Swept {len(para_dict_list)} combinations in {time.time() - start:.2f}s, "
+          f"{len(res_df.attrs['failed'])} failed, indicator cache {res_df.attrs['indicator_cache']}")
+    res_df.sort_values(by=rank_by, ascending=metric_ascending(rank_by), inplace=True, na_position="last")
+    res_df.reset_index(drop=True, inplace=True)
+    return res_df
+
+
+def grid_search(backtest_class, base_para_dict: dict, param_grid: dict, kline_df: pd.DataFrame,
+                max_workers: int = None, rank_by: str = "sharpe_ratio") -> pd.DataFrame:
+    """
+
+    :param backtest_class:
+    :param base_para_dict:
+    :param param_grid: parameter name to the list of values to sweep
+    :param kline_df:
+    :param max_workers:
+    :param rank_by:
+    :return: ranked result table
+    """
+    return run_sweep(backtest_class=backtest_class, base_para_dict=base_para_dict,
+                     combination_list=grid_combinations(param_grid), kline_df=kline_df, max_workers=max_workers,
+                     rank_by=rank_by)
+
+
+def random_search(backtest_class, base_para_dict: dict, param_grid: dict, kline_df: pd.DataFrame, n_iter: int,
+                  seed: int = None, max_workers: int = None, rank_by: str = "sharpe_ratio") -> pd.DataFrame:
+    """
+
+    :param backtest_class:
+    :param base_para_dict:
+    :param param_grid: parameter name to the list of values to sample from
+    :param kline_df:
+    :param n_iter:
+    :param seed:
+    :param max_workers:
+    :param rank_by:
+    :return: ranked result table
+    """
+    return run_sweep(backtest_class=backtest_class, base_para_dict=base_para_dict,
+                     combination_list=random_combinations(param_grid, n_iter=n_iter, seed=seed), kline_df=kline_df,
+                     max_workers=max_workers, rank_by=rank_by)
+
+
+def load_csv_kline(csv_path: str) -> pd.DataFrame:
+    """
+    Load the kline csv written by bybit/historical_kline_downloader.py in the layout the sweep expects
+    :param csv_path:
+    :return:
+    """
+    df = pd.read_csv(csv_path, index_col=0)
+    df = df.drop_duplicates(subset=['open_time']).sort_values('open_time').reset_index(drop=True)
+    df['timestamp'] = df['open_time']
+    return df[kline_column_list + [column for column in optional_kline_column_list if column in df]]
+
+
+if __name__ == "__main__":
+    from multi_indicator_backtest.backtest import Backtest
+
+    para_dict = {"strategy_name": "williamsR_MA", "first_window": -85, "second_window": -15,
+                 "reference_window": 16, "sub_window_multiplier": 7, "stop_loss": 1, "backtest_year": 1,
+                 "invest_percentage": 100, "symbol": "SANDUSDT", "start_time": 8, "end_time": 17}
+    param_grid = {"first_window": [-95, -90, -85, -80], "second_window": [-20, -15, -10, -5],
+                  "reference_window": [8, 12, 16, 24], "sub_window_multiplier": [3, 5, 7], "stop_loss": [0.5, 1, 2]}
+    kline_df = load_csv_kline("bybit/bybit_SANDUSDT_30_kline.csv")
+    print(grid_search(Backtest, para_dict, param_grid, kline_df).head(20))
+    print(random_search(Backtest, para_dict, param_grid, kline_df, n_iter=50, seed=0).head(20))
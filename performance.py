@@ -0,0 +1,209 @@
+"""
+Performance statistics of the backtests: a running drawdown tracker updated bar by bar inside the loops,
+and the tear sheet computed once on the whole equity curve.
+Every ratio is annualized with annualization_days, crypto markets trade every day of the year.
+"""
+import math
+import time
+import numpy as np
+from vectorized_engine import daily_equity_value
+
+annualization_days = 365
+
+
+class DrawdownTracker:
+    def __init__(self, keep_history: bool = False):
+        """
+        Running peak, drawdown and drawdown duration of an equity curve, updated in O(1) per bar
+        :param keep_history: keep the per bar drawdown in self.underwater_list
+        """
+        self.keep_history = keep_history
+        self.peak = None
+        self.drawdown = 0.0
+        self.max_drawdown = 0.0
+        self.drawdown_duration = 0
+        self.max_drawdown_duration = 0
+        self.bar_count = 0
+        self.underwater_list = []
+
+    def update(self, equity: float) -> float:
+        """
+
+        :param equity:
+        :return: drawdown of this bar as a fraction of the running peak
+        """
+        self.bar_count += 1
+        if self.peak is None or equity > self.peak:
+            self.peak = equity
+        self.drawdown = (self.peak - equity) / self.peak
+        if self.drawdown > 0:
+            self.drawdown_duration += 1
+            if self.drawdown_duration > self.max_drawdown_duration:
+                self.max_drawdown_duration = self.drawdown_duration
+            if self.drawdown > self.max_drawdown:
+                self.max_drawdown = self.drawdown
+        else:
+            self.drawdown_duration = 0
+        if self.keep_history:
+            self.underwater_list.append(self.drawdown)
+        return self.drawdown
+
+    def summary(self) -> dict:
+        return {"peak": self.peak, "drawdown": self.drawdown, "max_drawdown": self.max_drawdown,
+                "drawdown_duration": self.drawdown_duration, "max_drawdown_duration": self.max_drawdown_duration}
+
+
+def daily_return_metrics(daily_equity_matrix) -> dict:
+    """
+    Sharpe, Sortino, max drawdown, Calmar and net profit of many daily equity curves at once
+    :param daily_equity_matrix: one daily equity curve per row, or a single curve
+    :return: metric name to an array with one value per curve
+    """
+    daily_equity_matrix = np.atleast_2d(np.asarray(daily_equity_matrix, dtype=np.float64))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return_matrix = daily_equity_matrix[:, 1:] / daily_equity_matrix[:, :-1] - 1
+        return_mean = return_matrix.mean(axis=1)
+        sharpe_ratio = return_mean / return_matrix.std(axis=1, ddof=1) * math.sqrt(annualization_days)
+        # downside deviation is the sample standard deviation of the negative returns only
+        is_negative = return_matrix < 0
+        negative_count = is_negative.sum(axis=1)
+        negative_mean = np.where(is_negative, return_matrix, 0).sum(axis=1) / negative_count
+        negative_sd = np.sqrt((np.where(is_negative, return_matrix - negative_mean[:, None], 0) ** 2).sum(axis=1)
+                              / (negative_count - 1))
+        sortino_ratio = return_mean / negative_sd * math.sqrt(annualization_days)
+        running_max = np.maximum.accumulate(daily_equity_matrix, axis=1)
+        mdd_pct = 100 * ((running_max - daily_equity_matrix) / running_max).max(axis=1)
+        net_profit = (daily_equity_matrix[:, -1] - daily_equity_matrix[:, 0]) / daily_equity_matrix[:, 0] * 100
+        calmar_ratio = np.where(mdd_pct > 0, net_profit / mdd_pct, np.nan)
+    return {"sharpe_ratio": sharpe_ratio, "sortino_ratio": sortino_ratio, "mdd_pct": mdd_pct,
+            "calmar_ratio": calmar_ratio, "net_profit": net_profit}
+
+
+def rolling_sharpe(daily_equity, window: int = 30) -> np.ndarray:
+    """
+    Annualized Sharpe ratio of every trailing window of daily returns, from running sums
+    :param daily_equity:
+    :param window: number of daily returns in each window
+    :return: one value per daily return, NaN until the window is full
+    """
+    daily_equity = np.asarray(daily_equity, dtype=np.float64)
+    return_array = daily_equity[1:] / daily_equity[:-1] - 1
+    res = np.full(len(return_array), np.nan)
+    if window < 2 or window > len(return_array):
+        return res
+    running_sum = np.cumsum(np.append(0, return_array))
+    running_square = np.cumsum(np.append(0, return_array ** 2))
+    window_sum = running_sum[window:] - running_sum[:-window]
+    window_square = running_square[window:] - running_square[:-window]
+    window_sd = np.sqrt(np.maximum(window_square - window_sum ** 2 / window, 0) / (window - 1))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        res[window - 1:] = window_sum / window / window_sd * math.sqrt(annualization_days)
+    return res
+
+
+def tear_sheet(date_time, equity_value_array, initial_capital: float, mdd: float = None, position_array=None,
+               win_count: int = None, lose_count: int = None, rolling_window: int = 30) -> dict:
+    """
+    Every metric of one backtest from its bar equity curve, resampled to daily equity without a python loop
+    :param date_time: datetime64 array aligned with equity_value_array
+    :param equity_value_array:
+    :param initial_capital:
+    :param mdd: max drawdown of the bars as a fraction, computed from equity_value_array when None
+    :param position_array: position held after every bar (1 long, -1 short, 0 flat), adds exposure and turnover,
+    a (time x symbol) matrix for a portfolio
+    :param win_count: with lose_count, adds the trade statistics
+    :param lose_count:
+    :param rolling_window: number of days of the rolling Sharpe ratio
+    :return: metric name to value, with the daily equity and the rolling Sharpe arrays
+    """
+    equity_value_array = np.asarray(equity_value_array, dtype=np.float64)
+    daily_equity = daily_equity_value(date_time=np.asarray(date_time, dtype="datetime64[ns]"),
+                                      equity_value_array=equity_value_array, initial_capital=initial_capital)
+    sheet = {metric: values[0] for metric, values in daily_return_metrics(daily_equity).items()}
+    if mdd is None:
+        running_max = np.maximum.accumulate(equity_value_array)
+        mdd = np.max((running_max - equity_value_array) / running_max)
+    sheet["mdd_pct"] = 100 * mdd
+    sheet["net_profit"] = (equity_value_array[-1] - equity_value_array[0]) / equity_value_array[0] * 100
+    sheet["calmar_ratio"] = sheet["net_profit"] / sheet["mdd_pct"] if sheet["mdd_pct"] else math.nan
+    if position_array is not None:
+        # one column per symbol, a single symbol backtest is the one column case
+        position_array = np.asarray(position_array, dtype=np.float64).reshape(len(equity_value_array), -1)
+        sheet["exposure"] = np.count_nonzero(position_array) / position_array.size
+        # position units entered or exited per day and symbol, a long to short flip counts twice
+        sheet["turnover"] = np.abs(np.diff(position_array, axis=0, prepend=0)).sum() / position_array.shape[1] / \
+            max(len(daily_equity) - 1, 1)
+    if win_count is not None and lose_count is not None:
+        num_of_trade = win_count + lose_count
+        sheet["win_rate"] = win_count / num_of_trade if num_of_trade else math.nan
+        sheet["num_of_trade"] = num_of_trade
+        if position_array is not None:
+            sheet["avg_holding_bar"] = np.count_nonzero(position_array) / num_of_trade if num_of_trade else math.nan
+    sheet["daily_equity"] = daily_equity
+    sheet["rolling_sharpe"] = rolling_sharpe(daily_equity, window=rolling_window)
+    return sheet
+
+
+def split_tear_sheet(sheet: dict):
+    """
+
+    :param sheet: from tear_sheet
+    :return: scalar metrics, daily equity array, rolling Sharpe array
+    """
+    metrics = {metric: value for metric, value in sheet.items() if metric not in ("daily_equity", "rolling_sharpe")}
+    return metrics, sheet["daily_equity"], sheet["rolling_sharpe"]
+
+
+def benchmark_metrics(result_count: int = 10000, days: int = 365):
+    """
+    Time the metrics of a whole sweep of daily equity curves at once, against tear_sheet called per result
+    :param result_count:
+    :param days:
+    """
+    rng = np.random.default_rng(0)
+    daily_equity_matrix = 10000 * np.cumprod(1 + rng.normal(0.0005, 0.02, (result_count, days)), axis=1)
+    start = time.perf_counter()
+    metrics_dict = daily_return_metrics(daily_equity_matrix)
+    matrix_time = time.perf_counter() - start
+    # one bar per day, the last bar of a day closes it so the bar curve resamples back to the daily curve
+    date_time = np.datetime64("2022-01-01T00:00") + np.arange(days + 1).astype("timedelta64[D]")
+    start = time.perf_counter()
+    for row, daily_equity in enumerate(daily_equity_matrix):
+        sheet = tear_sheet(date_time, np.concatenate((daily_equity[1:], daily_equity[-1:], daily_equity[-1:])),
+                           initial_capital=daily_equity[0])
+        assert np.isclose(sheet["sharpe_ratio"], metrics_dict["sharpe_ratio"][row])
+    loop_time = time.perf_counter() - start
+    print(f"metrics of {result_count} results x {days} days, matrix: {matrix_time:.3f}s  "
+          f"tear_sheet per result: {loop_time:.3f}s")
+
+
+def benchmark(bar_count_list: tuple = (2000, 4000, 8000, 16000, 32000)):
+    """
+    Compare the former max(equity_value_list) per bar against DrawdownTracker, run time should double with the
+    bar count for the tracker and quadruple for the list scan
+    :param bar_count_list:
+    """
+    rng = np.random.default_rng(0)
+    for bar_count in bar_count_list:
+        equity_list = (10000 * np.exp(np.cumsum(rng.normal(0, 0.001, bar_count)))).tolist()
+        start = time.perf_counter()
+        equity_value_list = []
+        dd_pct_list = []
+        for equity_value in equity_list:
+            equity_value_list.append(equity_value)
+            temp_max_equity = max(equity_value_list)
+            dd_pct_list.append((temp_max_equity - equity_value) / temp_max_equity)
+        list_scan_time = time.perf_counter() - start
+        start = time.perf_counter()
+        tracker = DrawdownTracker()
+        for equity_value in equity_list:
+            tracker.update(equity_value)
+        tracker_time = time.perf_counter() - start
+        assert tracker.max_drawdown == max(dd_pct_list)
+        print(f"{bar_count:>7} bars, max(list) per bar: {list_scan_time * 1000:9.2f}ms  "
+              f"DrawdownTracker: {tracker_time * 1000:7.2f}ms")
+
+
+if __name__ == "__main__":
+    benchmark()
+    benchmark_metrics()
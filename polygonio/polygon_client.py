@@ -1,47 +1,181 @@
 """
 This is about polygon.io API code
 """
-import json
+import random
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+import numpy as np
 import requests
 import pandas as pd
-from datetime import datetime, timedelta
+from requests.adapters import HTTPAdapter
+from kline_store import KlineStore, default_store_dir
+from rate_limiter import TokenBucket
 
 pd.set_option('display.max_columns', 500)
 
+# shortest length of every Polygon timespan in milliseconds, a chunk of row_limit of them never holds more bars
+timespan_ms_dict = {'minute': 60000, 'hour': 3600000, 'day': 86400000, 'week': 7 * 86400000,
+                    'month': 28 * 86400000, 'quarter': 89 * 86400000, 'year': 365 * 86400000}
+
+# Polygon timespans to the interval names of the kline store
+timespan_interval_dict = {'minute': '1m', 'hour': '1h', 'day': '1d', 'week': '1w', 'month': '1M'}
+
 
 class PolygonClient:
-    def __init__(self):
-        # TODO : Please input your own Glassnode api key
+    def __init__(self, base_url: str = 'https://api.polygon.io', store_dir: str = default_store_dir,
+                 max_workers: int = 4, rate_limit: float = 5 / 60, max_retry: int = 5, backoff: float = 0.5,
+                 row_limit: int = 50000):
+        """
+
+        :param base_url: Polygon API url, point it to polygon_stub_server for testing
+        :param store_dir: root directory of the kline store stream_to_store writes to
+        :param max_workers: number of chunks fetched at the same time
+        :param rate_limit: requests per second, the free plan allows 5 per minute
+        :param max_retry: attempts per request on connection errors, 429 and 5xx responses
+        :param backoff: first retry delay in seconds, doubled after every failed attempt
+        :param row_limit: bars per request, 50000 at most
+        """
+        # TODO : Please input your own Polygon api key
         self.api_key = ""
+        self.base_url = base_url
+        self.kline_store = KlineStore(store_dir)
+        self.max_workers = max_workers
+        self.max_retry = max_retry
+        self.backoff = backoff
+        self.row_limit = row_limit
+        self.rate_limiter = TokenBucket(rate=rate_limit, capacity=max(1, int(rate_limit)))
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.failed_chunk_list = []
 
-    def _get_data(self, url: str):
-        try:
-            r = requests.get(url=url)
-            r.raise_for_status()
-        except requests.exceptions.HTTPError as errh:
-            print("Http Error:", errh)
-        except requests.exceptions.ConnectionError as errc:
-            print("Error Connecting:", errc)
-        except requests.exceptions.Timeout as errt:
-            print("Timeout Error:", errt)
-        except requests.exceptions.RequestException as err:
-            print("OOps: Something Else", err)
-        print(r.text)
+    def _request_json(self, url: str, params: dict = None) -> dict:
+        """
+        One request over the pooled session under the rate limit, retrying with exponential backoff
+        :param url: without the api key, a next_url is requested as it is
+        :param params: query parameters added to the url
+        :return: the response JSON
+        """
+        params = (params or {}) | {'apiKey': self.api_key}
+        for attempt in range(self.max_retry):
+            self.rate_limiter.acquire()
+            try:
+                r = self.session.get(url=url, params=params, timeout=30)
+            except requests.exceptions.RequestException as err:
+                print(f"Error Connecting: {err}, retrying")
+            else:
+                if r.status_code == 429 or r.status_code >= 500:
+                    print(f"Http Error: {r.status_code}, retrying")
+                elif r.status_code != 200:
+                    raise ValueError(f"Http Error: {r.status_code} on {url}")
+                else:
+                    res = r.json()
+                    if res.get('status') == 'ERROR':
+                        raise ValueError(f"Polygon error on {url}: {res.get('error')}")
+                    return res
+            if attempt < self.max_retry - 1:
+                time.sleep(self.backoff * 2 ** attempt * random.uniform(1, 1.5))
+        raise ValueError(f'Fail to request {url} after {self.max_retry} attempts')
 
+    def _get_data(self, url: str):
         if "open-close" in url:
-            res_dict = json.loads(r.text)['openTrades']
+            res_dict = self._request_json(url)['openTrades']
         else:
-            res_dict = json.loads(r.text)['results']
+            res_dict = self._request_json(url)['results']
         res_df = pd.DataFrame(res_dict)
         return res_df
 
+    @staticmethod
+    def to_ms(time_value: str, end: bool = False) -> int:
+        """
+        Millisecond timestamp of a YYYY-MM-DD date or a millisecond timestamp
+        :param time_value:
+        :param end: the last millisecond of the date, the to date of Polygon includes the whole day
+        :return:
+        """
+        if str(time_value).isdigit():
+            return int(time_value)
+        day_ms = int(datetime.strptime(time_value, "%Y-%m-%d").replace(tzinfo=timezone.utc).timestamp()) * 1000
+        return day_ms + 86400000 - 1 if end else day_ms
+
+    def chunk_range_list(self, timeframe: str, from_ms: int, to_ms: int) -> list:
+        """
+        Split a range in chunks of at most row_limit bars
+        :param timeframe:
+        :param from_ms:
+        :param to_ms: included
+        :return: [start, end] millisecond ranges, both ends included
+        """
+        if timeframe not in timespan_ms_dict:
+            raise ValueError(f"timeframe should be one of {list(timespan_ms_dict)}")
+        chunk_ms = self.row_limit * timespan_ms_dict[timeframe]
+        return [[start, min(start + chunk_ms - 1, to_ms)] for start in range(from_ms, to_ms + 1, chunk_ms)]
+
+    def fetch_chunk(self, symbol: str, timeframe: str, from_ms: int, to_ms: int, adjusted: str = "true") -> list:
+        """
+        Bars of one chunk in ascending order, following next_url until the chunk is complete
+        :return: list of Polygon bar dicts
+        """
+        url = f'{self.base_url}/v2/aggs/ticker/X:{symbol}/range/1/{timeframe}/{from_ms}/{to_ms}'
+        params = {'adjusted': adjusted, 'sort': 'asc', 'limit': self.row_limit}
+        bar_list = []
+        while url:
+            res = self._request_json(url, params)
+            bar_list += res.get('results') or []
+            # next_url already holds the query of the first request
+            url, params = res.get('next_url'), None
+        return bar_list
+
+    def aggregate_chunk_generator(self, symbol: str, timeframe: str, from_ms: int, to_ms: int,
+                                  adjusted: str = "true"):
+        """
+        Yield the bars of every chunk in time order as they arrive, with at most max_workers chunks in flight,
+        failed chunks are kept in self.failed_chunk_list, emptied at every call, and yield an empty list
+        """
+        self.failed_chunk_list = []
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            in_flight_deque = deque()
+            for start, end in self.chunk_range_list(timeframe=timeframe, from_ms=from_ms, to_ms=to_ms):
+                in_flight_deque.append((executor.submit(self.fetch_chunk, symbol, timeframe, start, end, adjusted),
+                                        (symbol, timeframe, start, end)))
+                if len(in_flight_deque) >= self.max_workers:
+                    yield self._chunk_result(*in_flight_deque.popleft())
+            while in_flight_deque:
+                yield self._chunk_result(*in_flight_deque.popleft())
+
+    def _chunk_result(self, future, chunk: tuple) -> list:
+        try:
+            return future.result()
+        except ValueError as e:
+            print(e)
+            self.failed_chunk_list.append(chunk)
+            return []
+
+    def _check_failed_chunk(self, allow_partial: bool):
+        if self.failed_chunk_list and not allow_partial:
+            range_list = [f"{pd.to_datetime(start, unit='ms')} - {pd.to_datetime(end, unit='ms')}"
+                          for _, _, start, end in self.failed_chunk_list]
+            raise ValueError(f"{len(self.failed_chunk_list)} chunks failed, missing ranges: {', '.join(range_list)}")
+
+    @staticmethod
+    def check_free_plan(to_ms: int):
+        one_month_before = datetime.now(tz=timezone.utc).timestamp() - 3 * 86400
+        if to_ms > one_month_before * 1000:
+            one_month_before_string = datetime.fromtimestamp(one_month_before, tz=timezone.utc).strftime("%Y-%m-%d")
+            raise ValueError(
+                f"This is free version, you can't get the latest data, please set to_date before {one_month_before_string}")
+
     def get_aggregates_bars(self, symbol: str, timeframe: str, from_time: str, to_time: str, adjusted: bool = True,
-                            asc: bool = True):
+                            asc: bool = True, allow_partial: bool = False):
         """
         /v2/aggs/ticker/{cryptoTicker}/range/{multiplier}/{timespan}/{from}/{to}
         Get aggregate bars for a cryptocurrency pair over a given date range in custom time window sizes.
         For example, if timespan = ‘minute’ and multiplier = ‘5’ then 5-minute bars will be returned.
         url: https://polygon.io/docs/crypto/get_v2_aggs_ticker__cryptoticker__range__multiplier___timespan___from___to
+        Long ranges are split in chunks of row_limit bars fetched concurrently, nothing is cut at the limit.
         :param symbol: The ticker symbol of the currency pair.
         :param timeframe: The size of the time window.
         :param from_time: The start of the aggregate time window.
@@ -53,29 +187,68 @@ class PolygonClient:
         :param asc: Sort the results by timestamp.
         True will return results in ascending order (oldest at the top),
         False will return results in descending order (newest at the top).
+        :param allow_partial: return the bars of the other chunks when a chunk keeps failing, the failed ranges
+        are left in self.failed_chunk_list. By default a failed chunk raises ValueError
         :return: Requested aggregates bars dataframe
         """
-        date_string_format = "%Y-%m-%d"
-        to_datetime = datetime.strptime(to_time, date_string_format)
-        one_month_before = datetime.now() - timedelta(3)
-        one_month_before_string = one_month_before.strftime(date_string_format)
-        if to_datetime > one_month_before:
-            raise ValueError(
-                f"This is free version, you can't get the latest data, please set to_date before {one_month_before_string}")
+        from_ms, to_ms = PolygonClient.to_ms(from_time), PolygonClient.to_ms(to_time, end=True)
+        PolygonClient.check_free_plan(to_ms)
         adjusted = "false" if adjusted is False else "true"
-        asc = "asc" if asc is True else "desc"
-        url = f'https://api.polygon.io/v2/aggs/ticker/X:{symbol}/range/1/{timeframe}/{from_time}/{to_time}?' \
-              f'adjusted={adjusted}&sort={asc}&limit=50000&apiKey={self.api_key}'
-        df = self._get_data(url=url)
+        bar_list = [bar for chunk_bar_list in self.aggregate_chunk_generator(symbol=symbol, timeframe=timeframe,
+                                                                             from_ms=from_ms, to_ms=to_ms,
+                                                                             adjusted=adjusted)
+                    for bar in chunk_bar_list]
+        self._check_failed_chunk(allow_partial)
+        df = pd.DataFrame(bar_list, columns=['t', 'o', 'h', 'l', 'c', 'v', 'vw', 'n'])
         df.rename(columns={'t': 'timestamp', 'o': 'open', 'h': 'high', 'l': 'low', 'c': 'close', 'v': 'volume',
                            'vw': 'weighted_volume', 'n': 'number_of_transaction'}, inplace=True)
         df['datetime'] = pd.to_datetime(df['timestamp'], unit='ms')
         df = df[['datetime', 'timestamp', 'open', 'high', 'low', 'close', 'volume', 'weighted_volume',
                  'number_of_transaction']]
         df.dropna(inplace=True)
+        df = df.drop_duplicates(subset='timestamp').sort_values('timestamp', ascending=asc)
         df.reset_index(inplace=True, drop=True)
         return df
 
+    def stream_to_store(self, symbol: str, timeframe: str, from_time: str, to_time: str,
+                        adjusted: bool = True, allow_partial: bool = False) -> int:
+        """
+        Download the aggregate bars chunk by chunk and append every chunk to the kline store as it arrives,
+        peak memory is bounded by the chunks in flight whatever the date range
+        :param symbol: The ticker symbol of the currency pair, stored under the same name.
+        :param timeframe: minute, hour, day, week or month
+        :param from_time: Either a date with the format YYYY-MM-DD or a millisecond timestamp.
+        :param to_time: Either a date with the format YYYY-MM-DD or a millisecond timestamp.
+        :param adjusted:
+        :param allow_partial: do not raise when a chunk keeps failing, the failed ranges are left in
+        self.failed_chunk_list. Either way the chunks that arrived stay in the store
+        :return: number of bars stored
+        """
+        if timeframe not in timespan_interval_dict:
+            raise ValueError(f"timeframe should be one of {list(timespan_interval_dict)} to be stored")
+        from_ms, to_ms = PolygonClient.to_ms(from_time), PolygonClient.to_ms(to_time, end=True)
+        PolygonClient.check_free_plan(to_ms)
+        kline_count = 0
+        for bar_list in self.aggregate_chunk_generator(symbol=symbol, timeframe=timeframe, from_ms=from_ms,
+                                                       to_ms=to_ms, adjusted="false" if adjusted is False else "true"):
+            if bar_list:
+                kline_count += self.kline_store.append(symbol=symbol.upper(), interval=timespan_interval_dict[timeframe],
+                                                       data=PolygonClient.bar_column_dict(bar_list))
+        self._check_failed_chunk(allow_partial)
+        return kline_count
+
+    @staticmethod
+    def bar_column_dict(bar_list: list) -> dict:
+        """
+        Kline store columns of Polygon bars, open_time in seconds and the turnover from the volume weighted price
+        """
+        column_dict = {column: np.array([bar.get(key, np.nan) for bar in bar_list], dtype=np.float64)
+                       for column, key in (('open', 'o'), ('high', 'h'), ('low', 'l'), ('close', 'c'),
+                                           ('volume', 'v'), ('turnover', 'vw'))}
+        column_dict['open_time'] = np.array([bar['t'] for bar in bar_list], dtype=np.int64) // 1000
+        column_dict['turnover'] *= column_dict['volume']
+        return column_dict
+
     def grouped_daily_bars(self, from_time: str, symbol_list: list = [], adjusted: bool = True):
         """
         /v2/aggs/grouped/locale/global/market/crypto/{date}
@@ -87,8 +260,7 @@ class PolygonClient:
         :return:
         """
         adjusted = "false" if adjusted == False else "true"
-        url = f"https://api.polygon.io/v2/aggs/grouped/locale/global/market/crypto/{from_time}?" \
-              f"adjusted={adjusted}&apiKey={self.api_key}"
+        url = f"{self.base_url}/v2/aggs/grouped/locale/global/market/crypto/{from_time}?adjusted={adjusted}"
         df = self._get_data(url=url)
         df.rename(columns={'T': 'symbol', 't': 'timestamp', 'o': 'open', 'h': 'high', 'l': 'low', 'c':
             'close', 'v': 'volume', 'vw': 'weighted_volume', 'n': 'number_of_transaction'}, inplace=True)
@@ -112,8 +284,7 @@ class PolygonClient:
         :return:
         """
         adjusted = "false" if adjusted is False else "true"
-        url = f"https://api.polygon.io/v1/open-close/crypto/{symbol[:3]}/{symbol[-3:]}/{from_time}?" \
-              f"adjusted={adjusted}&apiKey={self.api_key}"
+        url = f"{self.base_url}/v1/open-close/crypto/{symbol[:3]}/{symbol[-3:]}/{from_time}?adjusted={adjusted}"
         df = self._get_data(url=url)
         df = df[['t', 'p', 's', 'x']]
         df.rename(
@@ -133,7 +304,7 @@ class PolygonClient:
         :return:
         """
         adjusted = "false" if adjusted is False else "true"
-        url = f"https://api.polygon.io/v2/aggs/ticker/X:{symbol}/prev?adjusted={adjusted}&apiKey={self.api_key}"
+        url = f"{self.base_url}/v2/aggs/ticker/X:{symbol}/prev?adjusted={adjusted}"
         df = self._get_data(url=url)
         df.rename(columns={'T': 'symbol', 't': 'timestamp', 'o': 'open', 'h': 'high', 'l': 'low', 'c':
             'close', 'v': 'volume', 'vw': 'weighted_volume', 'n': 'number_of_transaction'}, inplace=True)
@@ -143,6 +314,54 @@ class PolygonClient:
         return df
 
 
+def benchmark_aggregates(days: int = 365, latency: float = 1.0, rate_limit: float = 50,
+                         worker_list: tuple = (1, 2, 4, 8)):
+    """
+    A year of minute bars from polygon_stub_server, which cuts every response at 50000 bars:
+    one request at the limit as before against the chunked client with more and more workers,
+    then the same range streamed into a scratch kline store. The stub serves from the same process,
+    its JSON encoding competes with the client for the GIL and keeps the speedup below the worker count
+    :param days:
+    :param latency: seconds every stub response takes
+    :param rate_limit: requests per second
+    :param worker_list:
+    """
+    import shutil
+    import tempfile
+    from polygon_stub_server import start_stub_server
+
+    server, base_url = start_stub_server(latency=latency)
+    from_ms = PolygonClient.to_ms("2021-01-01")
+    to_ms = from_ms + days * 86400000 - 1
+    expected = days * 1440
+    client = PolygonClient(base_url=base_url, rate_limit=rate_limit)
+    single_request = client._request_json(f"{base_url}/v2/aggs/ticker/X:BTCUSD/range/1/minute/{from_ms}/{to_ms}",
+                                          {'adjusted': 'true', 'sort': 'asc', 'limit': 50000})
+    print(f"single request: {single_request['resultsCount']} of {expected} bars")
+    single_worker_time = None
+    for max_workers in worker_list:
+        client = PolygonClient(base_url=base_url, max_workers=max_workers, rate_limit=rate_limit)
+        start = time.perf_counter()
+        df = client.get_aggregates_bars(symbol="BTCUSD", timeframe="minute", from_time=str(from_ms),
+                                        to_time=str(to_ms))
+        elapsed = time.perf_counter() - start
+        single_worker_time = single_worker_time or elapsed
+        print(f"{max_workers} workers: {len(df)} of {expected} bars in {elapsed:.2f}s, "
+              f"speedup {single_worker_time / elapsed:.1f}x")
+    store_dir = tempfile.mkdtemp()
+    try:
+        client = PolygonClient(base_url=base_url, store_dir=store_dir, max_workers=worker_list[-1],
+                               rate_limit=rate_limit)
+        start = time.perf_counter()
+        client.stream_to_store(symbol="BTCUSD", timeframe="minute", from_time=str(from_ms), to_time=str(to_ms))
+        stored = len(client.kline_store.read("BTCUSD", "1m")["open_time"])
+        print(f"streamed {stored} of {expected} bars to the kline store in {time.perf_counter() - start:.2f}s")
+    finally:
+        shutil.rmtree(store_dir, ignore_errors=True)
+    print(f"stub server: {server.stats['request']} requests, {server.stats['cut']} cut at the limit")
+    server.shutdown()
+
+
 if __name__ == "__main__":
     polygon = PolygonClient()
     polygon.get_aggregates_bars(symbol="BTCUSD", timeframe="day", from_time="2022-06-01", to_time="2022-06-10")
@@ -0,0 +1,102 @@
+"""
+Local stand-in of the Polygon aggregates endpoint for testing and benchmarking PolygonClient:
+/v2/aggs/ticker/{ticker}/range/{multiplier}/{timespan}/{from}/{to} answers synthetic bars of the range
+after a configurable latency, at most max_row_count bars per response as the real API, with a next_url
+to the rest of the range when a response is cut
+"""
+import json
+import math
+import threading
+import time
+import zlib
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs, urlencode
+
+
+# milliseconds of every Polygon timespan
+timespan_ms_dict = {'minute': 60000, 'hour': 3600000, 'day': 86400000, 'week': 7 * 86400000}
+
+
+def to_ms(value: str, end: bool = False) -> int:
+    """
+    Millisecond timestamp of a YYYY-MM-DD date or a millisecond timestamp, the end of the day when end is True
+    """
+    if value.isdigit():
+        return int(value)
+    day_ms = int(datetime.strptime(value, "%Y-%m-%d").replace(tzinfo=timezone.utc).timestamp()) * 1000
+    return day_ms + 86400000 - 1 if end else day_ms
+
+
+def synthetic_bar(ticker: str, t: int) -> dict:
+    seed = zlib.crc32(ticker.encode()) % 1000
+    close = 100 + seed / 10 + 10 * math.sin(t / 86400000 / 30 + seed)
+    return {"v": 1 + t % 7, "vw": close * 1.0005, "o": close * 1.001, "c": close, "h": close * 1.01,
+            "l": close * 0.99, "t": t, "n": 10 + t % 13}
+
+
+class PolygonStubHandler(BaseHTTPRequestHandler):
+    latency = 0.05
+    max_row_count = 50000
+    # a dict shared by the handlers of one server
+    stats = None
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        path_part_list = url.path.strip("/").split("/")
+        if len(path_part_list) != 9 or path_part_list[:3] != ["v2", "aggs", "ticker"] or \
+                path_part_list[6] not in timespan_ms_dict:
+            self.send_error(404)
+            return
+        query = {name: value_list[0] for name, value_list in parse_qs(url.query, keep_blank_values=True).items()}
+        if "apiKey" not in query:
+            self.send_error(401)
+            return
+        ticker, multiplier, timespan = path_part_list[3], int(path_part_list[5]), path_part_list[6]
+        step = multiplier * timespan_ms_dict[timespan]
+        start, end = to_ms(path_part_list[7]), to_ms(path_part_list[8], end=True)
+        limit = min(int(query.get("limit", 5000)), self.max_row_count)
+        first = -(-start // step) * step
+        t_list = list(range(first, end + 1, step))
+        time.sleep(self.latency)
+        res = {"ticker": ticker, "adjusted": query.get("adjusted", "true") == "true",
+               "queryCount": min(len(t_list), limit), "resultsCount": min(len(t_list), limit),
+               "status": "OK", "request_id": f"{zlib.crc32(self.path.encode()):x}",
+               "results": [synthetic_bar(ticker, t) for t in t_list[:limit]]}
+        if len(t_list) > limit:
+            next_path = "/".join(path_part_list[:7] + [str(t_list[limit]), path_part_list[8]])
+            next_query = {name: value for name, value in query.items() if name != "apiKey"}
+            res["next_url"] = f"http://{self.headers['Host']}/{next_path}?{urlencode(next_query)}"
+        with self.server.lock:
+            self.stats["request"] += 1
+            self.stats["row"] += res["resultsCount"]
+            self.stats["cut"] += "next_url" in res
+        body = json.dumps(res).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub_server(latency: float = 0.05, max_row_count: int = 50000, port: int = 0):
+    """
+    Serve in a daemon thread until server.shutdown()
+    :param latency: seconds every response is delayed by
+    :param max_row_count: bars per response before it is cut with a next_url
+    :param port: 0 picks a free port
+    :return: the server, with its request, row and cut counters in server.stats, and the base_url to give
+    PolygonClient
+    """
+    stats = {"request": 0, "row": 0, "cut": 0}
+    handler = type("PolygonStubHandler", (PolygonStubHandler,),
+                   {"latency": latency, "max_row_count": max_row_count, "stats": stats})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.stats = stats
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
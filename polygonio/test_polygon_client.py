@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+from polygon_client import PolygonClient
+from polygon_stub_server import start_stub_server
+
+
+@pytest.fixture
+def stub():
+    server, base_url = start_stub_server(latency=0.0, max_row_count=20000)
+    yield server, base_url
+    server.shutdown()
+
+
+def test_long_range_is_chunked_and_paginated(stub, tmp_path):
+    server, base_url = stub
+    client = PolygonClient(base_url=base_url, store_dir=str(tmp_path), rate_limit=1000)
+    df = client.get_aggregates_bars(symbol="BTCUSD", timeframe="minute", from_time="2021-01-01",
+                                    to_time="2021-03-31")
+    # 90 days of minute bars, above the 50000 bars of one request and cut at 20000 by the stub
+    assert len(df) == 90 * 1440 and df["timestamp"].is_unique
+    assert np.all(np.diff(df["timestamp"].to_numpy()) == 60000)
+    assert server.stats["cut"] > 0
+    assert client.stream_to_store(symbol="BTCUSD", timeframe="minute", from_time="2021-01-01",
+                                  to_time="2021-03-31") == 90 * 1440
+    assert len(client.kline_store.read("BTCUSD", "1m")["open_time"]) == 90 * 1440
+
+
+def test_failed_chunk_raises_unless_partial_is_allowed(stub, tmp_path):
+    server, base_url = stub
+    client = PolygonClient(base_url=base_url, store_dir=str(tmp_path), rate_limit=1000, max_retry=1)
+    fetch_chunk = client.fetch_chunk
+
+    def failing_fetch_chunk(symbol, timeframe, from_ms, to_ms, adjusted):
+        if from_ms == PolygonClient.to_ms("2021-01-01"):
+            raise ValueError("Http Error: 503")
+        return fetch_chunk(symbol, timeframe, from_ms, to_ms, adjusted)
+
+    client.fetch_chunk = failing_fetch_chunk
+    with pytest.raises(ValueError, match="1 chunks failed"):
+        client.get_aggregates_bars(symbol="BTCUSD", timeframe="minute", from_time="2021-01-01", to_time="2021-03-31")
+    df = client.get_aggregates_bars(symbol="BTCUSD", timeframe="minute", from_time="2021-01-01",
+                                    to_time="2021-03-31", allow_partial=True)
+    assert len(df) == 90 * 1440 - 50000 and len(client.failed_chunk_list) == 1
+    client.fetch_chunk = fetch_chunk
+    client.get_aggregates_bars(symbol="BTCUSD", timeframe="minute", from_time="2021-01-01", to_time="2021-03-31")
+    assert client.failed_chunk_list == []
@@ -0,0 +1,193 @@
+"""
+Portfolio mode of the indicator strategies: the Backtest of single_indicator_backtest or multi_indicator_backtest
+run over many symbols in one process, on (time x symbol) matrices aligned on open_time,
+with one shared capital and a combined equity curve
+"""
+import time
+import numpy as np
+import pandas as pd
+from pprint import pprint
+import matplotlib.pyplot as plt
+from alpha import AlphaMatrix
+from kline_store import KlineStore
+from performance import tear_sheet, split_tear_sheet
+from reporting import decimate, get_writer, report_name
+from vectorized_engine import run_portfolio_state_machine, drawdown_pct
+
+price_column_list = ["open", "high", "low", "close"]
+
+
+def align_kline(kline_dict: dict, dtype=np.float64):
+    """
+    Align the klines of many symbols on the union of their open times.
+    A missing kline repeats the previous one, and the first kline of a symbol fills the rows before it,
+    so the indicators and the marked equity never see a NaN; the tradable matrix tells the real klines apart
+    :param kline_dict: symbol to DataFrame or dict of arrays with open_time, open, high, low and close,
+    turnover is aligned as well when every symbol has it
+    :param dtype: dtype of the price matrices
+    :return: open_time array, dict of (time x symbol) price matrices, (time x symbol) tradable matrix
+    """
+    open_time_list = [np.asarray(kline["open_time"], dtype=np.int64) for kline in kline_dict.values()]
+    open_time = np.unique(np.concatenate(open_time_list))
+    n = len(open_time)
+    symbol_count = len(kline_dict)
+    column_list = price_column_list + ["turnover"] * all("turnover" in kline for kline in kline_dict.values())
+    matrix_dict = {column: np.full((n, symbol_count), np.nan, dtype=dtype) for column in column_list}
+    tradable = np.zeros((n, symbol_count), dtype=bool)
+    for j, kline in enumerate(kline_dict.values()):
+        row = np.searchsorted(open_time, open_time_list[j])
+        tradable[row, j] = True
+        for column, matrix in matrix_dict.items():
+            matrix[row, j] = np.asarray(kline[column], dtype=dtype)
+    row_index = np.arange(n)[:, None]
+    source_row = np.maximum(np.maximum.accumulate(np.where(tradable, row_index, 0), axis=0),
+                            tradable.argmax(axis=0)[None, :])
+    for column, matrix in matrix_dict.items():
+        matrix_dict[column] = np.take_along_axis(matrix, source_row, axis=0)
+    return open_time, matrix_dict, tradable
+
+
+class PortfolioBacktest:
+    def __init__(self, backtest_class, para_dict: dict):
+        """
+
+        :param backtest_class: Backtest class of single_indicator_backtest or multi_indicator_backtest,
+        its vectorized_signal_generator gives the signals of every symbol
+        :param para_dict: para_dict of that Backtest with symbol as a list of symbols,
+        "dtype" picks float32 or float64 price and indicator matrices
+        """
+        self.symbol_list = list(para_dict["symbol"])
+        self.strategy = backtest_class(para_dict | {"symbol": self.symbol_list[0]})
+        self.dtype = np.dtype(para_dict.get("dtype", "float64"))
+        self.initial_capital = self.strategy.initial_capital
+        self.verbose = self.strategy.verbose
+        self.report_dir = self.strategy.report_dir
+        self.report_name = f"{report_name(para_dict)}_{len(self.symbol_list)}_symbols"
+        self.date_time = pd.Series(dtype='datetime64[ns]')
+        self.open_time = np.empty(0, dtype=np.int64)
+        self.matrix_dict = {}
+        self.tradable = np.empty((0, len(self.symbol_list)), dtype=bool)
+        self.position_matrix = None
+        self.metrics = {}
+
+    def get_mongo_kline(self, interval: str):
+        """
+        :param interval:
+        """
+        current_timestamp = time.time()
+        start_from = time.time() - 60 * 60 * 24 * 365 * self.strategy.backtest_year
+        store = KlineStore(self.strategy.kline_store_dir)
+        self.set_kline({symbol: store.read(symbol=symbol, interval=interval, start=start_from, end=current_timestamp)
+                        for symbol in self.symbol_list})
+
+    def set_kline(self, kline_dict: dict):
+        """
+
+        :param kline_dict: symbol to kline with open_time in seconds, open, high, low, close and optionally turnover,
+        in the order of symbol
+        """
+        self.open_time, matrix_dict, self.tradable = align_kline(kline_dict, dtype=self.dtype)
+        # same local time shift as Backtest.set_kline
+        self.date_time = pd.Series(pd.to_datetime(self.open_time + 60 * 60 * 8, unit='s'))
+        self.matrix_dict = AlphaMatrix(matrix_dict, dtype=self.dtype).add_indicator(
+            strategy_name=self.strategy.strategy_name, reference_window=self.strategy.reference_window,
+            sub_window_multiplier=self.strategy.sub_window_multiplier)
+
+    def run_vectorized(self):
+        """
+        Signals of every symbol from the strategy, then one state machine walking the bars of all the symbols
+        :return:
+        """
+        start_index = self.strategy.start_index
+        date_time = self.date_time.iloc[start_index:].reset_index(drop=True)
+        indicator_dict = {name: matrix[start_index:] for name, matrix in self.matrix_dict.items()}
+        close = indicator_dict["close"]
+        execution = self.strategy.execution_model.bar_arrays(
+            self.open_time[start_index:], indicator_dict["open"], indicator_dict["high"], indicator_dict["low"], close,
+            turnover=indicator_dict.get("turnover"),
+            order_notional=self.initial_capital * self.strategy.invest_percentage / 100 / len(self.symbol_list),
+            symbol=self.symbol_list)
+        open_long, open_short, close_long, close_short, hold_previous = self.strategy.vectorized_signal_generator(
+            date_time=date_time, close=close, indicator_dict=indicator_dict)
+        equity_value_array, self.position_matrix, win_count, lose_count = run_portfolio_state_machine(
+            close=close, open_long=open_long, open_short=open_short, close_long=close_long,
+            close_short=close_short, hold_previous=hold_previous, tradable=self.tradable[start_index:],
+            initial_capital=self.initial_capital, stop_loss=self.strategy.stop_loss,
+            invest_percentage=self.strategy.invest_percentage, taker_fee=self.strategy.taker_fee,
+            exit_fee_on_close=self.strategy.exit_fee_on_close, execution=execution)
+        return self._report(date_list=date_time.to_list(), equity_value_list=equity_value_array,
+                            mdd_pct=np.max(drawdown_pct(equity_value_array)), win_count=win_count,
+                            lose_count=lose_count)
+
+    def _report(self, date_list: list, equity_value_list, mdd_pct: float, win_count: int, lose_count: int):
+        """
+
+        :param date_list:
+        :param equity_value_list: combined equity of every bar
+        :param mdd_pct: max drawdown as a fraction
+        :param win_count:
+        :param lose_count:
+        :return:
+        """
+        equity_value_list = np.asarray(equity_value_list, dtype=np.float64)
+        date_array = pd.DatetimeIndex(date_list).to_numpy()
+        self.metrics, self.daily_equity_value_list, self.rolling_sharpe_list = split_tear_sheet(tear_sheet(
+            date_time=date_array, equity_value_array=equity_value_list,
+            initial_capital=self.initial_capital, mdd=mdd_pct, position_array=self.position_matrix,
+            win_count=win_count, lose_count=lose_count))
+        res_df = pd.DataFrame({'datetime': date_array, "equity": equity_value_list})
+        curve_dict = {"equity": (date_array, equity_value_list / self.initial_capital),
+                      "symbols held": (date_array, np.count_nonzero(self.position_matrix, axis=1))}
+        if self.report_dir:
+            get_writer(self.report_dir).submit(self.report_name, res_df, curve_dict, metrics=self.metrics)
+        if not self.verbose or self.report_dir:
+            return res_df
+        pprint(self.metrics)
+        plt.figure(figsize=(40, 20))
+        plt.plot(*decimate(*curve_dict["equity"]))
+        plt.show()
+        return res_df
+
+
+def benchmark(backtest_class, para_dict: dict, symbol_count: int = 50, days: int = 365, interval_minute: int = 15):
+    """
+    Portfolio backtest of synthetic klines, 50 symbols of 1 year of 15m klines by default, in float64 and float32
+    :param backtest_class:
+    :param para_dict: para_dict of backtest_class, symbol is replaced
+    :param symbol_count:
+    :param days:
+    :param interval_minute:
+    """
+    rng = np.random.default_rng(0)
+    n = days * 24 * 60 // interval_minute
+    open_time = 1640995200 + 60 * interval_minute * np.arange(n, dtype=np.int64)
+    kline_dict = {}
+    for j in range(symbol_count):
+        close = 100 * np.exp(np.cumsum(rng.normal(0, 0.003, n)))
+        spread = close * rng.uniform(0, 0.004, n)
+        kline_dict[f"SYM{j}USDT"] = {"open_time": open_time, "open": np.append(close[0], close[:-1]),
+                                     "high": close + spread, "low": close - spread, "close": close}
+    for dtype in ("float64", "float32"):
+        portfolio = PortfolioBacktest(backtest_class, para_dict | {"symbol": list(kline_dict), "dtype": dtype,
+                                                                   "verbose": False})
+        start = time.perf_counter()
+        portfolio.set_kline(kline_dict)
+        indicator_time = time.perf_counter() - start
+        portfolio.run_vectorized()
+        matrix_mb = sum(matrix.nbytes for matrix in portfolio.matrix_dict.values()) / 1e6
+        print(f"{dtype}: {symbol_count} symbols x {n} klines, indicators {indicator_time:.2f}s, "
+              f"total {time.perf_counter() - start:.2f}s, price and indicator matrices {matrix_mb:.0f}MB, "
+              f"sharpe {portfolio.metrics['sharpe_ratio']:.3f}, trades {portfolio.metrics['num_of_trade']}")
+
+
+if __name__ == "__main__":
+    from multi_indicator_backtest.backtest import Backtest
+
+    para_dict = {"strategy_name": "williamsR_MA", "first_window": -85, "second_window": -15,
+                 "reference_window": 16, "sub_window_multiplier": 7, "stop_loss": 1, "backtest_year": 1,
+                 "invest_percentage": 100, "symbol": ["BTCUSDT", "ETHUSDT", "SOLUSDT"], "start_time": 8,
+                 "end_time": 17}
+    portfolio_backtest = PortfolioBacktest(Backtest, para_dict)
+    portfolio_backtest.get_mongo_kline(interval="15m")
+    save_csv = portfolio_backtest.run_vectorized()
+    # benchmark(Backtest, para_dict)
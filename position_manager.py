@@ -0,0 +1,175 @@
+"""
+Local position state of the live traders, kept up to date from the private order, execution and position
+events, so the signal loop reads it without any network call. The REST position is only queried periodically,
+or when the events and the local state disagree
+"""
+import math
+import threading
+import time
+
+
+class PositionManager:
+    def __init__(self, symbol: str, event_driven: bool = True, reconcile_interval: float = 300.0,
+                 pending_timeout: float = 10.0, mismatch_grace: float = 2.0):
+        """
+
+        :param symbol:
+        :param event_driven: fills come from execution events, otherwise an accepted market order is assumed
+        filled as soon as its response arrives
+        :param reconcile_interval: seconds between two REST queries when everything is consistent
+        :param pending_timeout: seconds an accepted order may wait for its fill before a REST query
+        :param mismatch_grace: seconds a position event may disagree with the local size before a REST query,
+        executions and position events of the same fill are not always pushed in order
+        """
+        self.symbol = symbol
+        self.event_driven = event_driven
+        self.reconcile_interval = reconcile_interval
+        self.pending_timeout = pending_timeout
+        self.mismatch_grace = mismatch_grace
+        # events are pushed from the websocket thread while the signal loop reads
+        self.lock = threading.Lock()
+        # signed size, positive for long and negative for short
+        self.size = 0.0
+        # order_id to (signed quantity still to fill, time the order was accepted)
+        self.pending_order_dict = {}
+        # signed quantity of executions received before the response of their order
+        self.early_fill_dict = {}
+        # orders pending or early filled at the last REST query, their fills are in its position
+        self.settled_order_set = set()
+        self.event_size = None
+        self.mismatch_since = None
+        self.discrepancy = False
+        self.last_reconcile_time = -math.inf
+        self.stats = {"event": 0, "reconcile": 0, "reconcile_change": 0, "discrepancy": 0}
+
+    @property
+    def expected_size(self) -> float:
+        with self.lock:
+            return self.size + sum(qty for qty, _ in self.pending_order_dict.values())
+
+    @property
+    def holding_type(self):
+        """
+        'LONG', 'SHORT' or None once the pending orders are filled, as Alpha.holding_type
+        """
+        expected_size = self.expected_size
+        return 'LONG' if expected_size > 0 else 'SHORT' if expected_size < 0 else None
+
+    @property
+    def order_pending(self) -> bool:
+        with self.lock:
+            return bool(self.pending_order_dict)
+
+    def on_message(self, message: dict):
+        """
+        Private stream message, dispatched on its topic
+        :param message: dict with topic and a data list, as the bybit private websocket pushes them
+        """
+        handler = {"execution": self.on_execution, "position": self.on_position, "order": self.on_order}.get(
+            message.get("topic"))
+        if handler is not None:
+            self.stats["event"] += 1
+            for data in message["data"]:
+                if data.get("symbol", self.symbol) == self.symbol:
+                    handler(data)
+
+    def on_execution(self, data: dict):
+        signed_qty = float(data["exec_qty"]) * (1 if data["side"] == "Buy" else -1)
+        with self.lock:
+            order_id = data.get("order_id")
+            if order_id in self.settled_order_set:
+                self._check_mismatch()
+                return
+            self.size += signed_qty
+            if order_id in self.pending_order_dict:
+                remaining, accepted_time = self.pending_order_dict[order_id]
+                remaining -= signed_qty
+                if abs(remaining) < 1e-12:
+                    del self.pending_order_dict[order_id]
+                else:
+                    self.pending_order_dict[order_id] = (remaining, accepted_time)
+            elif order_id is not None:
+                self.early_fill_dict[order_id] = self.early_fill_dict.get(order_id, 0.0) + signed_qty
+            self._check_mismatch()
+
+    def on_position(self, data: dict):
+        with self.lock:
+            self.event_size = float(data["size"]) * (-1 if data["side"] == "Sell" else 1)
+            self._check_mismatch()
+
+    def on_order(self, data: dict):
+        if data.get("order_status") in ("Cancelled", "Rejected", "PartiallyFilledCanceled"):
+            with self.lock:
+                # nothing more of it will be filled
+                self.pending_order_dict.pop(data.get("order_id"), None)
+
+    def _check_mismatch(self):
+        if self.event_size is None or abs(self.event_size - self.size) < 1e-12:
+            self.mismatch_since = None
+        elif self.mismatch_since is None:
+            self.mismatch_since = time.monotonic()
+
+    def on_order_response(self, side: str, qty: float, response: dict):
+        """
+        Register an order accepted by the exchange
+        :param side: Buy or Sell
+        :param qty:
+        :param response: place_active_order response with the order_id in its result
+        """
+        signed_qty = float(qty) * (1 if side == "Buy" else -1)
+        with self.lock:
+            if not self.event_driven:
+                self.size += signed_qty
+                return
+            order_id = (response.get("result") or {}).get("order_id")
+            if order_id in self.settled_order_set:
+                return
+            remaining = signed_qty - self.early_fill_dict.pop(order_id, 0.0)
+            if abs(remaining) >= 1e-12:
+                self.pending_order_dict[order_id] = (remaining, time.monotonic())
+
+    def mark_discrepancy(self):
+        """
+        The local state can not be trusted anymore, after a failed or timed out order
+        """
+        with self.lock:
+            self.discrepancy = True
+            self.stats["discrepancy"] += 1
+
+    def needs_reconcile(self) -> bool:
+        now = time.monotonic()
+        with self.lock:
+            if self.discrepancy:
+                return True
+            if self.mismatch_since is not None and now - self.mismatch_since > self.mismatch_grace:
+                return True
+            if any(now - accepted_time > self.pending_timeout for _, accepted_time in self.pending_order_dict.values()):
+                return True
+            return not self.pending_order_dict and now - self.last_reconcile_time >= self.reconcile_interval
+
+    def apply_rest_position(self, response: dict) -> bool:
+        """
+        Replace the local state with the REST position
+        :param response: my_position response
+        :return: whether the response was applied
+        """
+        if response is None or response.get("ret_msg") != "OK":
+            return False
+        size = 0.0
+        for position in response["result"]:
+            if float(position["size"]) != 0:
+                size = float(position["size"]) * (1 if position["side"] == "Buy" else -1)
+        with self.lock:
+            if size != self.size + sum(qty for qty, _ in self.pending_order_dict.values()):
+                self.stats["reconcile_change"] += 1
+            self.size = size
+            self.event_size = None
+            # a late execution of these orders would count their fill twice
+            self.settled_order_set = set(self.pending_order_dict) | set(self.early_fill_dict)
+            self.pending_order_dict.clear()
+            self.early_fill_dict.clear()
+            self.mismatch_since = None
+            self.discrepancy = False
+            self.last_reconcile_time = time.monotonic()
+            self.stats["reconcile"] += 1
+        return True
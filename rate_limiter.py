@@ -0,0 +1,31 @@
+"""
+Rate limiting shared by the REST clients, the Bybit kline downloader, the Glassnode and the Polygon clients
+"""
+import threading
+import time
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: int):
+        """
+        Thread safe token bucket, acquire blocks until a token is available
+        :param rate: tokens added per second
+        :param capacity: maximum burst of tokens
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_time = (1 - self.tokens) / self.rate
+            time.sleep(wait_time)
@@ -0,0 +1,211 @@
+"""
+Backtest result output without blocking: equity curves are decimated to a few thousand points before plotting,
+and the plots, metrics and res_df are written to files from a background thread
+"""
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import util
+import numpy as np
+import pandas as pd
+from matplotlib.figure import Figure
+
+
+def lttb(x, y, point_count: int):
+    """
+    Largest-Triangle-Three-Buckets downsampling, keeps the points that shape the curve the most
+    :param x: increasing x values, datetime64 are accepted
+    :param y:
+    :param point_count: number of points kept, including the first and the last
+    :return: indices of the kept points
+    """
+    x = np.asarray(x)
+    x = x.astype(np.int64).astype(np.float64) if np.issubdtype(x.dtype, np.datetime64) else x.astype(np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    n = len(y)
+    if point_count >= n or point_count < 3:
+        return np.arange(n)
+    # the first and last points are kept, the others are split into point_count - 2 buckets
+    edge_array = np.linspace(1, n - 1, point_count - 1).astype(np.int64)
+    index_array = np.empty(point_count, dtype=np.int64)
+    index_array[0] = 0
+    index_array[-1] = n - 1
+    previous = 0
+    for bucket in range(point_count - 2):
+        start, end = edge_array[bucket], edge_array[bucket + 1]
+        next_end = edge_array[bucket + 2] if bucket + 2 < len(edge_array) else n
+        next_x = x[end:next_end].mean()
+        next_y = y[end:next_end].mean()
+        area = np.abs((x[previous] - next_x) * (y[start:end] - y[previous]) -
+                      (x[previous] - x[start:end]) * (next_y - y[previous]))
+        previous = start + int(np.argmax(area))
+        index_array[bucket + 1] = previous
+    return index_array
+
+
+def min_max_decimate(y, pixel_count: int):
+    """
+    Keep the lowest and the highest point of every pixel column, the drawn envelope is unchanged
+    :param y:
+    :param pixel_count: horizontal resolution of the plot
+    :return: sorted indices of the kept points
+    """
+    y = np.asarray(y, dtype=np.float64)
+    n = len(y)
+    if 2 * pixel_count >= n or pixel_count < 1:
+        return np.arange(n)
+    bucket_size = -(-n // pixel_count)
+    bucket_matrix = np.concatenate((y, np.full(bucket_size * pixel_count - n, y[-1]))).reshape(-1, bucket_size)
+    offset_array = np.arange(len(bucket_matrix)) * bucket_size
+    index_array = np.concatenate((offset_array + bucket_matrix.argmin(axis=1),
+                                  offset_array + bucket_matrix.argmax(axis=1), [0, n - 1]))
+    return np.unique(np.minimum(index_array, n - 1))
+
+
+def decimate(x, y, point_count: int = 2000, method: str = "lttb"):
+    """
+
+    :param x:
+    :param y:
+    :param point_count: number of points kept, twice the pixel count for min_max
+    :param method: "lttb" or "min_max"
+    :return: decimated x, decimated y
+    """
+    x = np.asarray(x)
+    y = np.asarray(y)
+    if method == "lttb":
+        index_array = lttb(x, y, point_count)
+    elif method == "min_max":
+        index_array = min_max_decimate(y, point_count // 2)
+    else:
+        raise ValueError(f"Unknown decimation method {method}")
+    return x[index_array], y[index_array]
+
+
+def report_name(para_dict: dict) -> str:
+    """
+    File name prefix of a backtest, from its scalar parameters
+    :param para_dict:
+    :return:
+    """
+    name = "_".join(f"{key}={value}" for key, value in para_dict.items()
+                    if isinstance(value, (str, int, float)) and key not in ("verbose", "report_dir", "kline_store_dir"))
+    if len(name) > 200:
+        # keep file names under the file system limit, the hash of the full name keeps them unique
+        name = f"{name[:160]}_{hashlib.blake2b(name.encode(), digest_size=8).hexdigest()}"
+    return name
+
+
+class ResultWriter:
+    def __init__(self, output_dir: str, point_count: int = 2000, method: str = "lttb", max_workers: int = 1):
+        """
+        Write backtest results in background threads, so the backtest returns as soon as its metrics are known
+        :param output_dir:
+        :param point_count: number of points of each plotted curve
+        :param method: decimation method, "lttb" or "min_max"
+        :param max_workers: number of writer threads
+        """
+        self.output_dir = output_dir
+        self.point_count = point_count
+        self.method = method
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.future_list = []
+        os.makedirs(output_dir, exist_ok=True)
+
+    def submit(self, name: str, res_df: pd.DataFrame, curve_dict: dict, metrics: dict = None):
+        """
+
+        :param name: file name prefix
+        :param res_df: written as {name}.csv
+        :param curve_dict: subplot label to (x, y), every curve is plotted in its own subplot of {name}.png
+        :param metrics: written as {name}_metrics.json
+        :return: future of the write
+        """
+        # decimate now, the caller may reuse its arrays once submit returns
+        decimated_dict = {label: decimate(x, y, point_count=self.point_count, method=self.method)
+                          for label, (x, y) in curve_dict.items()}
+        self.future_list = [future for future in self.future_list if not future.done()]
+        future = self.executor.submit(self._write, name, res_df, decimated_dict, metrics)
+        self.future_list.append(future)
+        return future
+
+    def _write(self, name: str, res_df: pd.DataFrame, decimated_dict: dict, metrics: dict):
+        path = os.path.join(self.output_dir, name)
+        res_df.to_csv(f"{path}.csv")
+        if metrics is not None:
+            with open(f"{path}_metrics.json", "w") as f:
+                json.dump({key: float(value) for key, value in metrics.items()}, f, indent=1)
+        # Figure without pyplot is not registered with any GUI backend and is safe to draw from a thread
+        fig = Figure(figsize=(16, 4 * len(decimated_dict)))
+        axes_list = fig.subplots(len(decimated_dict), 1, sharex=True, squeeze=False)[:, 0]
+        for axes, (label, (x, y)) in zip(axes_list, decimated_dict.items()):
+            axes.plot(x, y, linewidth=0.8)
+            axes.set_title(label)
+        fig.tight_layout()
+        fig.savefig(f"{path}.png", dpi=100)
+
+    def wait(self):
+        """
+        Block until every submitted result is written, errors of the writes are raised here
+        """
+        for future in self.future_list:
+            future.result()
+        self.future_list = []
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown()
+
+
+_writer_dict = {}
+
+
+def get_writer(output_dir: str) -> ResultWriter:
+    """
+    One writer per output directory and process, flushed when the process exits, optimizer workers included
+    :param output_dir:
+    :return:
+    """
+    if output_dir not in _writer_dict:
+        writer = ResultWriter(output_dir)
+        _writer_dict[output_dir] = writer
+        # unlike atexit, multiprocessing finalizers also run when a pool worker exits
+        util.Finalize(writer, writer.close, exitpriority=10)
+    return _writer_dict[output_dir]
+
+
+def benchmark(n: int = 500_000, point_count: int = 2000):
+    """
+    Time the decimation of a long equity curve and the plot of all its points against the decimated ones
+    :param n:
+    :param point_count:
+    """
+    import tempfile
+
+    rng = np.random.default_rng(0)
+    x = np.datetime64("2022-01-01T00:00") + np.arange(n).astype("timedelta64[m]")
+    y = 10000 * np.cumprod(1 + rng.normal(0, 0.001, n))
+    with tempfile.TemporaryDirectory() as output_dir:
+        for method in ("lttb", "min_max"):
+            start = time.perf_counter()
+            decimated_x, decimated_y = decimate(x, y, point_count=point_count, method=method)
+            print(f"{method:<8} {n} -> {len(decimated_x)} points in {(time.perf_counter() - start) * 1000:.1f}ms")
+        for label, (plot_x, plot_y) in {"full": (x, y), "decimated": (decimated_x, decimated_y)}.items():
+            start = time.perf_counter()
+            fig = Figure(figsize=(40, 20))
+            fig.subplots().plot(plot_x, plot_y)
+            fig.savefig(os.path.join(output_dir, f"{label}.png"))
+            print(f"plot {label:<10} {len(plot_x)} points in {time.perf_counter() - start:.3f}s")
+        writer = ResultWriter(output_dir)
+        start = time.perf_counter()
+        writer.submit("equity", pd.DataFrame({"datetime": x, "equity": y}), {"equity": (x, y)})
+        submit_time = time.perf_counter() - start
+        writer.close()
+        print(f"ResultWriter.submit returned in {submit_time * 1000:.1f}ms, "
+              f"write finished after {time.perf_counter() - start:.3f}s")
+
+
+if __name__ == "__main__":
+    benchmark()
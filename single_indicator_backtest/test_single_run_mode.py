@@ -0,0 +1,32 @@
+import os
+import pytest
+from single_indicator_backtest.backtest import Backtest, compare_run_mode
+from execution_model import ExecutionModel
+
+csv_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "bybit", "bybit_SANDUSDT_30_kline.csv")
+
+
+@pytest.mark.parametrize("first_window, second_window, stop_loss, start_time, end_time",
+                         [(30, 70, 1, 8, 17), (40, 60, 0.05, 0, 24), (35, 65, 0.02, 2, 20)])
+def test_run_vectorized_matches_run(first_window, second_window, stop_loss, start_time, end_time):
+    para_dict = {"strategy_name": "RSI", "first_window": first_window, "second_window": second_window,
+                 "reference_window": 20, "sub_window_multiplier": 8, "stop_loss": stop_loss, "backtest_year": 1,
+                 "invest_percentage": 50, "symbol": "SANDUSDT", "start_time": start_time, "end_time": end_time,
+                 "verbose": False}
+    compare_run_mode(para_dict=para_dict, csv_path=csv_path)
+    backtest = Backtest(para_dict)
+    backtest.get_csv_kline(csv_path=csv_path)
+    backtest.run()
+    assert backtest.metrics["num_of_trade"] > 0
+
+
+def test_run_refuses_an_execution_model():
+    para_dict = {"strategy_name": "RSI", "first_window": 30, "second_window": 70, "reference_window": 20,
+                 "sub_window_multiplier": 8, "stop_loss": 1, "backtest_year": 1, "invest_percentage": 50,
+                 "symbol": "SANDUSDT", "start_time": 8, "end_time": 17, "verbose": False,
+                 "execution_model": ExecutionModel(entry_order="maker")}
+    backtest = Backtest(para_dict)
+    backtest.get_csv_kline(csv_path=csv_path)
+    with pytest.raises(ValueError, match="use run_vectorized"):
+        backtest.run()
+    assert backtest.run_vectorized()["equity"].iloc[-1] > 0
@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+from indicator import StreamingWilliamsRMA, stream_williams_r_ma, williams_r, sma
+
+
+def random_walk(n: int, flat_slice_list: tuple = ()):
+    """
+    Klines of a random walk, high == low == close over every flat slice
+    """
+    rng = np.random.default_rng(0)
+    close = 100 + np.cumsum(rng.normal(0, 0.1, n))
+    high = close + rng.uniform(0, 0.2, n)
+    low = close - rng.uniform(0, 0.2, n)
+    for flat_slice in flat_slice_list:
+        close[flat_slice] = high[flat_slice] = low[flat_slice] = 101.0
+    return high, low, close
+
+
+@pytest.mark.parametrize("reference_window, ma_window", [(16, 112), (1, 1), (5, 3), (30, 30)])
+def test_streaming_matches_batch(reference_window, ma_window):
+    high, low, close = random_walk(3000, flat_slice_list=(slice(500, 560), slice(2000, 2040)))
+    williams_r_array, ma_array = stream_williams_r_ma(high, low, close, reference_window=reference_window,
+                                                      ma_window=ma_window)
+    np.testing.assert_array_equal(williams_r_array, williams_r(high, low, close, reference_window))
+    np.testing.assert_array_equal(ma_array, sma(close, ma_window))
+
+
+def test_flat_window_is_nan():
+    high, low, close = random_walk(200, flat_slice_list=(slice(100, 140),))
+    williams_r_array, _ = stream_williams_r_ma(high, low, close, reference_window=16, ma_window=16)
+    # every window inside the flat klines has the highest high equal to the lowest low
+    assert np.isnan(williams_r_array[115:140]).all()
+    assert not np.isnan(williams_r_array[15:115]).any() and not np.isnan(williams_r_array[155:]).any()
+    np.testing.assert_array_equal(williams_r_array, williams_r(high, low, close, 16))
+
+
+def test_not_ready_before_the_windows_are_full():
+    state = StreamingWilliamsRMA(reference_window=3, ma_window=4)
+    res_list = [state.update(high, low, close) for high, low, close in
+                [(2.0, 1.0, 1.5), (3.0, 1.0, 2.0), (4.0, 2.0, 3.0), (5.0, 3.0, 5.0)]]
+    assert np.isnan(res_list[1][0]) and np.isnan(res_list[2][1]) and state.ready
+    assert res_list[2][0] == -100 * (4.0 - 3.0) / (4.0 - 1.0)
+    assert res_list[3] == (0.0, (1.5 + 2.0 + 3.0 + 5.0) / 4)
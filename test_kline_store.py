@@ -0,0 +1,68 @@
+import os
+import shutil
+import threading
+import numpy as np
+from kline_store import KlineStore
+
+
+def kline_dict(start: int, count: int, close: float = 1.0) -> dict:
+    open_time = start + 1800 * np.arange(count, dtype=np.int64)
+    return {"open_time": open_time, "open": np.full(count, close), "high": np.full(count, close),
+            "low": np.full(count, close), "close": np.full(count, close), "volume": np.ones(count),
+            "turnover": np.full(count, close)}
+
+
+def test_append_replaces_the_same_open_time(tmp_path):
+    store = KlineStore(str(tmp_path))
+    store.append("SANDUSDT", "30", kline_dict(1609459200, 48))
+    store.append("SANDUSDT", "30", kline_dict(1609459200 + 1800 * 24, 48, close=2.0))
+    res = store.read("SANDUSDT", "30")
+    assert len(res["open_time"]) == 72
+    assert np.all(np.diff(res["open_time"]) == 1800)
+    assert res["close"][23] == 1.0 and res["close"][24] == 2.0
+    assert store.month_list("SANDUSDT", "30") == ["2021-01"]
+
+
+def test_interrupted_write_leaves_the_previous_version(tmp_path):
+    store = KlineStore(str(tmp_path))
+    store.append("SANDUSDT", "30", kline_dict(1609459200, 48))
+    month_dir = os.path.join(store._interval_dir("SANDUSDT", "30"), "2021-01")
+    # a crash after writing the columns of the next version, before CURRENT names it
+    shutil.copytree(os.path.join(month_dir, "v1"), os.path.join(month_dir, "v2"))
+    np.save(os.path.join(month_dir, "v2", "close.npy"), np.full(48, 9.0))
+    assert store.read("SANDUSDT", "30")["close"].tolist() == [1.0] * 48
+    # a crash during the first write of a month leaves no CURRENT, the month does not exist yet
+    os.makedirs(os.path.join(store._interval_dir("SANDUSDT", "30"), "2021-02", "v1"))
+    assert store.month_list("SANDUSDT", "30") == ["2021-01"]
+    store.append("SANDUSDT", "30", kline_dict(1609459200 + 1800 * 48, 1))
+    assert len(store.read("SANDUSDT", "30")["open_time"]) == 49
+    assert sorted(os.listdir(month_dir)) == ["CURRENT", "v1", "v3"]
+    store.append("SANDUSDT", "30", kline_dict(1609459200 + 1800 * 49, 1))
+    assert sorted(os.listdir(month_dir)) == ["CURRENT", "v3", "v4"]
+
+
+def test_reader_sees_complete_partitions_during_writes(tmp_path):
+    store = KlineStore(str(tmp_path))
+    store.append("SANDUSDT", "30", kline_dict(1609459200, 48))
+    length_set = set()
+    error_list = []
+    stop = threading.Event()
+
+    def reader():
+        while not stop.is_set():
+            try:
+                res = store.read("SANDUSDT", "30")
+            except Exception as err:
+                error_list.append(err)
+                return
+            length_set.add((len(res["open_time"]), len(res["close"])))
+
+    thread = threading.Thread(target=reader)
+    thread.start()
+    for i in range(50):
+        store.append("SANDUSDT", "30", kline_dict(1609459200 + 1800 * (48 + i), 1))
+    stop.set()
+    thread.join()
+    assert not error_list
+    assert all(48 <= open_time_length == close_length <= 98 for open_time_length, close_length in length_set)
+    assert len(store.read("SANDUSDT", "30")["open_time"]) == 98
@@ -0,0 +1,148 @@
+import asyncio
+import math
+import time
+import pytest
+import live_runtime
+from fake_exchange import FakeExchange
+from live_runtime import LiveRuntime, TopOfBook, LatencyHistogram, bracket_price
+from position_manager import PositionManager
+
+
+class ScriptedStrategy:
+    """
+    Open long on every kline, and remember when each kline was handled
+    """
+    def __init__(self):
+        self.kline_list = []
+
+    def on_kline(self, kline: dict):
+        self.kline_list.append((time.perf_counter(), kline))
+        return True, False, False, False
+
+
+class SlowFirstOrderExchange(FakeExchange):
+    """
+    The first order never gets its response
+    """
+    async def place_active_order(self, **order_dict) -> dict:
+        if self.call_count_dict["place_active_order"] == 0:
+            self.call_count_dict["place_active_order"] += 1
+            self.slow_order_time = time.perf_counter()
+            await asyncio.sleep(60)
+        return await super().place_active_order(**order_dict)
+
+
+class BurstExchange(FakeExchange):
+    """
+    Every kline at once, the signal task can not take any of them before the stream ends
+    """
+    async def kline_stream(self):
+        for i in range(self.kline_count):
+            yield {"symbol": self.symbol, "open_time": 60 * i, "open": 1.0, "high": 1.0, "low": 1.0, "close": 1.0}
+
+
+def test_timed_out_order_is_reconciled_while_klines_keep_flowing():
+    async def scenario():
+        exchange = SlowFirstOrderExchange(kline_count=40, kline_interval=0.01, latency=0.001)
+        strategy = ScriptedStrategy()
+        runtime = LiveRuntime(exchange=exchange, strategy=strategy, symbol=exchange.symbol, qty=1.0,
+                              request_timeout=0.1)
+        stats = await asyncio.wait_for(runtime.run(), timeout=10)
+        return exchange, strategy, runtime, stats
+
+    exchange, strategy, runtime, stats = asyncio.run(scenario())
+    assert stats["kline"] == 40 and stats["timeout"] == 1 and stats["failed_order"] == 1
+    assert stats["discrepancy"] == 1 and stats["reconcile"] >= 1
+    # klines were handled while the first order was waiting for its response
+    waiting_kline_list = [kline for handled_time, kline in strategy.kline_list
+                          if exchange.slow_order_time < handled_time < exchange.slow_order_time + 0.1]
+    assert len(waiting_kline_list) >= 5
+    # the reconciliation found no position, so the next signal was sent and filled
+    assert stats["order"] == 2
+    assert exchange.position_size == 1.0 and runtime.position_manager.expected_size == 1.0
+
+
+def test_full_kline_queue_drops_the_oldest_kline():
+    async def scenario():
+        exchange = BurstExchange(kline_count=10, latency=0.001)
+        strategy = ScriptedStrategy()
+        runtime = LiveRuntime(exchange=exchange, strategy=strategy, symbol=exchange.symbol, qty=1.0,
+                              kline_queue_size=3)
+        stats = await asyncio.wait_for(runtime.run(), timeout=10)
+        return strategy, stats
+
+    strategy, stats = asyncio.run(scenario())
+    # the end of stream marker takes one place, the two latest klines are left
+    assert [kline["open_time"] for _, kline in strategy.kline_list] == [480, 540]
+    assert stats["kline"] == 2 and stats["dropped_kline"] == 8
+
+
+def test_runtime_shuts_down_when_the_kline_stream_ends():
+    async def scenario():
+        exchange = FakeExchange(kline_count=50, latency=0.001, event_latency=0.0)
+        position_manager = PositionManager(exchange.symbol, event_driven=True)
+        runtime = LiveRuntime(exchange=exchange, strategy=ScriptedStrategy(), symbol=exchange.symbol, qty=1.0,
+                              position_manager=position_manager)
+        stats = await asyncio.wait_for(runtime.run(), timeout=10)
+        # the feed tasks are cancelled, nothing is left running but this task
+        await asyncio.sleep(0)
+        return exchange, runtime, stats, asyncio.all_tasks()
+
+    exchange, runtime, stats, task_set = asyncio.run(scenario())
+    assert len(task_set) == 1
+    assert stats["kline"] == 50 and stats["order"] == 1
+    assert runtime.stop_event.is_set() and runtime.order_queue.empty() and runtime.kline_queue.empty()
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(live_runtime.time, "monotonic", lambda: clock[0])
+    return clock
+
+
+def test_top_of_book_refuses_a_missing_or_stale_quote(clock):
+    top_of_book = TopOfBook(max_age=2.0)
+    with pytest.raises(ValueError, match="No orderbook message"):
+        top_of_book.quote()
+    top_of_book.update_from_message([{"bid": [[99.5, 1.0]], "ask": [[100.5, 2.0]]}])
+    clock[0] += 2.0
+    assert top_of_book.quote() == (99.5, 100.5)
+    clock[0] += 0.01
+    with pytest.raises(ValueError, match="stale"):
+        top_of_book.quote()
+    top_of_book.update(best_bid=99.0, best_ask=100.0)
+    assert top_of_book.quote() == (99.0, 100.0) and top_of_book.update_count == 2
+
+
+def test_bracket_price_of_both_sides(clock):
+    top_of_book = TopOfBook()
+    top_of_book.update(best_bid=1000.5, best_ask=1001.5)
+    # a buy is priced from the ask, a sell from the bid
+    assert bracket_price(top_of_book, "Buy", take_profit=2, stop_loss=1) == (1021, 991)
+    assert bracket_price(top_of_book, "Sell", take_profit=2, stop_loss=1) == (980, 1010)
+    assert bracket_price(top_of_book, "Buy", take_profit=0, stop_loss=1) == (None, 991)
+    assert bracket_price(top_of_book, "Sell", take_profit=2, stop_loss=0) == (980, None)
+    clock[0] += 10
+    with pytest.raises(ValueError, match="stale"):
+        bracket_price(top_of_book, "Buy", take_profit=2, stop_loss=1)
+
+
+def test_latency_histogram_percentile_and_overflow_bucket():
+    histogram = LatencyHistogram(low=1e-3, high=1.0, bucket_per_decade=1)
+    assert math.isnan(histogram.percentile(50))
+    for latency in (0.0005, 0.005, 0.005, 0.05, 5.0):
+        histogram.record(latency)
+    assert histogram.count_list == [1, 2, 1, 0, 1]
+    assert histogram.percentile(20) == 1e-3
+    assert histogram.percentile(50) == pytest.approx(1e-2)
+    assert histogram.percentile(80) == pytest.approx(1e-1)
+    # the overflow bucket has no upper edge, the largest latency stands for it
+    assert histogram.percentile(100) == 5.0
+    assert histogram.max == 5.0 and histogram.total == pytest.approx(5.0605)
+
+
+def test_latency_histogram_percentile_is_capped_by_the_largest_latency():
+    histogram = LatencyHistogram(low=1e-3, high=1.0, bucket_per_decade=1)
+    histogram.record(0.002)
+    assert histogram.percentile(50) == 0.002
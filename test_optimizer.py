@@ -0,0 +1,37 @@
+import numpy as np
+import pandas as pd
+import optimizer
+
+
+class FakeBacktest:
+    """
+    Metrics read from the parameters, a backtest of quality 0 fails
+    """
+    def __init__(self, para_dict: dict):
+        self.para_dict = para_dict
+        self.metrics = {}
+
+    def set_kline(self, df: pd.DataFrame):
+        self.df = df
+
+    def run_vectorized(self):
+        quality = self.para_dict["quality"]
+        if quality == 0:
+            raise ValueError("no trade")
+        self.metrics = {metric: np.nan for metric in optimizer.metric_column_list} | {
+            "sharpe_ratio": quality, "mdd_pct": 1 / quality}
+
+
+kline_df = pd.DataFrame({"timestamp": np.arange(10, dtype=np.int64) * 60, "open": 1.0, "high": 1.0, "low": 1.0,
+                         "close": 1.0})
+
+
+def test_rank_direction_and_failed_combination():
+    combination_list = optimizer.grid_combinations({"quality": [1, 4, 0, 2]})
+    res_df = optimizer.run_sweep(FakeBacktest, {}, combination_list, kline_df, max_workers=2)
+    assert res_df["quality"].tolist() == [4, 2, 1, 0]
+    # the smallest drawdown ranks first
+    res_df = optimizer.run_sweep(FakeBacktest, {}, combination_list, kline_df, max_workers=2, rank_by="mdd_pct")
+    assert res_df["quality"].tolist() == [4, 2, 1, 0]
+    assert res_df.attrs["failed"] == [{"quality": 0, "error": "ValueError('no trade')"}]
+    assert res_df["error"].isna().tolist() == [True, True, True, False]
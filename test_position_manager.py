@@ -0,0 +1,97 @@
+import pytest
+import position_manager
+from position_manager import PositionManager
+
+
+def execution(order_id: str, side: str, qty: float) -> dict:
+    return {"topic": "execution", "data": [{"order_id": order_id, "symbol": "BTCUSDT", "side": side,
+                                            "exec_qty": qty, "price": 100.0}]}
+
+
+def position(side: str, size: float) -> dict:
+    return {"topic": "position", "data": [{"symbol": "BTCUSDT", "side": side, "size": size}]}
+
+
+def accepted(order_id: str) -> dict:
+    return {"ret_code": 0, "ret_msg": "OK", "result": {"order_id": order_id}}
+
+
+def rest_position(size: float) -> dict:
+    return {"ret_code": 0, "ret_msg": "OK", "result": [{"symbol": "BTCUSDT", "side": "Buy", "size": max(size, 0.0)},
+                                                       {"symbol": "BTCUSDT", "side": "Sell", "size": max(-size, 0.0)}]}
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(position_manager.time, "monotonic", lambda: clock[0])
+    return clock
+
+
+def test_execution_before_the_order_response(clock):
+    manager = PositionManager("BTCUSDT", mismatch_grace=2.0)
+    manager.on_message(execution("a", "Buy", 1.0))
+    assert manager.size == 1.0 and manager.early_fill_dict == {"a": 1.0}
+    manager.on_order_response("Buy", 1.0, accepted("a"))
+    assert manager.expected_size == 1.0 and not manager.order_pending and manager.early_fill_dict == {}
+    manager.on_message(position("Buy", 1.0))
+    assert manager.mismatch_since is None
+
+
+def test_dropped_events(clock):
+    manager = PositionManager("BTCUSDT", reconcile_interval=300.0, mismatch_grace=2.0)
+    manager.apply_rest_position(rest_position(0.0))
+    # the position event of a fill is lost, the execution alone keeps the local state right
+    manager.on_order_response("Buy", 1.0, accepted("a"))
+    manager.on_message(execution("a", "Buy", 1.0))
+    clock[0] += 10
+    assert manager.expected_size == 1.0 and not manager.needs_reconcile()
+    # the execution of the next fill is lost, its position event disagrees until the REST query
+    manager.on_order_response("Sell", 1.0, accepted("b"))
+    manager.on_message(position("None", 0.0))
+    clock[0] += 2.0
+    assert not manager.needs_reconcile()
+    clock[0] += 0.1
+    assert manager.needs_reconcile()
+    manager.apply_rest_position(rest_position(0.0))
+    assert manager.expected_size == 0.0 and not manager.needs_reconcile()
+    assert manager.stats["reconcile_change"] == 0
+
+
+def test_rest_position_before_a_late_execution(clock):
+    manager = PositionManager("BTCUSDT")
+    manager.on_order_response("Buy", 1.0, accepted("a"))
+    assert manager.order_pending and manager.expected_size == 1.0
+    # the REST position has the fill its execution has not delivered yet
+    assert manager.apply_rest_position(rest_position(1.0))
+    manager.on_message(execution("a", "Buy", 1.0))
+    assert manager.size == 1.0 and manager.expected_size == 1.0
+    assert manager.early_fill_dict == {} and not manager.order_pending
+    # the executions of the next orders count again
+    manager.on_order_response("Sell", 1.0, accepted("b"))
+    manager.on_message(execution("b", "Sell", 1.0))
+    assert manager.size == 0.0 and not manager.order_pending
+
+
+def test_rest_position_before_a_late_response(clock):
+    manager = PositionManager("BTCUSDT")
+    manager.on_message(execution("a", "Sell", 2.0))
+    manager.apply_rest_position(rest_position(-2.0))
+    manager.on_order_response("Sell", 2.0, accepted("a"))
+    assert manager.expected_size == -2.0 and not manager.order_pending
+
+
+def test_cancelled_order(clock):
+    manager = PositionManager("BTCUSDT")
+    manager.on_order_response("Buy", 1.0, accepted("a"))
+    manager.on_message({"topic": "order", "data": [{"order_id": "a", "symbol": "BTCUSDT",
+                                                     "order_status": "Cancelled"}]})
+    assert manager.expected_size == 0.0 and not manager.order_pending and manager.holding_type is None
+    # partially filled before the rest was cancelled
+    manager.on_order_response("Sell", 1.0, accepted("b"))
+    manager.on_message(execution("b", "Sell", 0.4))
+    assert manager.expected_size == pytest.approx(-1.0)
+    manager.on_message({"topic": "order", "data": [{"order_id": "b", "symbol": "BTCUSDT",
+                                                     "order_status": "PartiallyFilledCanceled"}]})
+    assert manager.expected_size == pytest.approx(-0.4) and manager.holding_type == "SHORT"
+    assert not manager.order_pending
@@ -0,0 +1,36 @@
+import numpy as np
+from vectorized_engine import run_portfolio_state_machine
+
+
+def run_two_symbols(close, tradable, open_long, close_long):
+    """
+    Symbol 0 with the given bars, symbol 1 always tradable and never trading
+    """
+    n = len(close)
+    matrix = lambda column, other: np.column_stack((np.asarray(column), np.full(n, other)))
+    no_signal = np.zeros(n, dtype=bool)
+    return run_portfolio_state_machine(
+        close=matrix(close, 100.0), open_long=matrix(open_long, False), open_short=matrix(no_signal, False),
+        close_long=matrix(close_long, False), close_short=matrix(no_signal, False),
+        hold_previous=np.zeros(n, dtype=bool), tradable=matrix(tradable, True), initial_capital=10000.0,
+        stop_loss=10, invest_percentage=100, taker_fee=0.0)
+
+
+def test_close_signal_without_kline_waits_for_the_next_kline():
+    equity_value_array, position_matrix, win_count, lose_count = run_two_symbols(
+        close=[100, 100, 105, 105, 105, 120, 130], tradable=[1, 1, 1, 0, 0, 1, 1],
+        open_long=[0, 1, 0, 0, 0, 0, 0], close_long=[0, 0, 0, 1, 0, 0, 0])
+    np.testing.assert_array_equal(position_matrix[:, 0], [0, 1, 1, 1, 1, 0, 0])
+    assert (win_count, lose_count) == (1, 0)
+    # filled at the close of the next kline, 120, half of the equity invested at 100
+    assert equity_value_array[-1] == 10000.0 + 5000.0 * 0.2
+
+
+def test_no_stop_loss_on_forward_filled_bars():
+    equity_value_array, position_matrix, win_count, lose_count = run_two_symbols(
+        close=[100, 100, 95, 95, 80, 80, 80], tradable=[1, 1, 1, 0, 0, 0, 0],
+        open_long=[0, 1, 0, 0, 0, 0, 0], close_long=[0, 0, 0, 0, 1, 1, 1])
+    # delisted after the third bar, the position stays open and marked at its prices
+    np.testing.assert_array_equal(position_matrix[:, 0], [0, 1, 1, 1, 1, 1, 1])
+    assert (win_count, lose_count) == (0, 0)
+    assert equity_value_array[-1] == 10000.0 - 5000.0 * 0.2
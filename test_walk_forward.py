@@ -0,0 +1,54 @@
+import numpy as np
+import pandas as pd
+import pytest
+from walk_forward import walk_forward, walk_forward_folds, local_time
+
+
+class FakeBacktest:
+    """
+    Equity growing by the growth parameter every bar, the metrics are read from the parameters
+    """
+    def __init__(self, para_dict: dict):
+        self.para_dict = para_dict
+        self.metrics = {}
+
+    def set_kline(self, df: pd.DataFrame):
+        self.df = df
+
+    def run_vectorized(self, start_index: int, end_index: int):
+        growth = self.para_dict["growth"]
+        self.metrics = {"sharpe_ratio": growth, "mdd_pct": growth - 1}
+        timestamp = self.df["timestamp"].to_numpy()[start_index:end_index]
+        return pd.DataFrame({"datetime": pd.to_datetime(timestamp + 60 * 60 * 8, unit="s"),
+                             "equity": 10000 * growth ** np.arange(end_index - start_index)})
+
+
+hour = 3600
+kline_df = pd.DataFrame({"timestamp": 1640995200 + np.arange(240, dtype=np.int64) * hour, "open": 1.0, "high": 1.0,
+                         "low": 1.0, "close": 1.0})
+
+
+def test_rolling_and_anchored_fold_bounds():
+    timestamp = kline_df["timestamp"]
+    assert walk_forward_folds(timestamp, train_days=3, test_days=2) == [
+        (0, 72, 72, 120), (48, 120, 120, 168), (96, 168, 168, 216)]
+    assert walk_forward_folds(timestamp, train_days=3, test_days=2, anchored=True) == [
+        (0, 72, 72, 120), (0, 120, 120, 168), (0, 168, 168, 216)]
+    # a fold is only kept when its out-of-sample window ends within the klines
+    assert walk_forward_folds(timestamp, train_days=6, test_days=3.95) == [(0, 144, 144, 239)]
+    assert walk_forward_folds(timestamp, train_days=6, test_days=4) == []
+
+
+@pytest.mark.parametrize("rank_by, best_growth", [("sharpe_ratio", 1.002), ("mdd_pct", 1.001)])
+def test_folds_compound_and_pick_by_rank_direction(rank_by, best_growth):
+    oos_df, fold_df = walk_forward(FakeBacktest, {}, {"growth": [1.001, 1.002]}, kline_df, train_days=3,
+                                   test_days=2, max_workers=2, rank_by=rank_by)
+    assert fold_df["growth"].tolist() == [best_growth] * 3
+    # every fold starts at the equity the previous one ended with, its first bar repeats that value
+    row = np.arange(len(oos_df))
+    np.testing.assert_allclose(oos_df["equity"], 10000 * best_growth ** (row - oos_df["fold"].to_numpy()))
+    # the fold table and the stitched curve share the local time base
+    for fold, fold_oos_df in oos_df.groupby("fold"):
+        assert fold_df["test_start"][fold] == fold_oos_df["datetime"].iloc[0]
+        assert fold_df["test_end"][fold] == fold_oos_df["datetime"].iloc[-1]
+    assert fold_df["train_start"].tolist() == [local_time(kline_df["timestamp"][row]) for row in (0, 48, 96)]
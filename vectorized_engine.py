@@ -0,0 +1,384 @@
+import numpy as np
+from execution_model import close_fill_arrays
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+
+def _position_state_machine(close, open_long, open_short, close_long, close_short, hold_previous,
+                            initial_capital, stop_loss, invest_percentage, exit_fee_on_close, bar_open, high, low,
+                            slippage, funding_rate, entry_fee, exit_fee, stop_fee, intrabar_stop,
+                            entry_slippage_scale, exit_slippage_scale):
+    """
+    Walk the single-position state machine over contiguous arrays, the same way Backtest.run does bar by bar
+    :param close: close price of every bar
+    :param open_long: open long signal of every bar
+    :param open_short: open short signal of every bar
+    :param close_long: close long signal of every bar
+    :param close_short: close short signal of every bar
+    :param hold_previous: bars which reuse the signals of the previous bar instead of their own
+    :param initial_capital:
+    :param stop_loss: stop loss in percentage of the open price
+    :param invest_percentage: percentage of the equity invested in each trade
+    :param exit_fee_on_close: charge the exit fee on the close price instead of the open price
+    :param bar_open: open price of every bar, price of the funding payments and of stops gapped through
+    :param high: high price of every bar, for the intrabar stop of a short
+    :param low: low price of every bar, for the intrabar stop of a long
+    :param slippage: fraction of the price lost on a taker fill of every bar
+    :param funding_rate: funding rate paid by longs to shorts on every bar, 0 on the bars without funding
+    :param entry_fee:
+    :param exit_fee: fee of an exit on a signal
+    :param stop_fee: fee of an exit on the stop loss
+    :param intrabar_stop: fill the stop loss at the stop price as soon as the low/high crosses it
+    :param entry_slippage_scale: share of the slippage paid by an entry, 0 for maker entries
+    :param exit_slippage_scale: share of the slippage paid by an exit on a signal, 0 for maker exits
+    :return: equity value of every bar, position held after every bar (1 long, -1 short, 0 flat), win count,
+    lose count
+    """
+    n = len(close)
+    equity_value_array = np.empty(n)
+    position_array = np.zeros(n, dtype=np.int8)
+    open_price = 0.0
+    num_of_lot = 0.0
+    holding_position = 0
+    temp_capital = initial_capital
+    win_count = 0
+    lose_count = 0
+    open_long_signal = open_short_signal = False
+    close_long_signal = close_short_signal = True
+    for i in range(n):
+        now_close = close[i]
+        if not hold_previous[i]:
+            open_long_signal = open_long[i]
+            open_short_signal = open_short[i]
+            close_long_signal = close_long[i]
+            close_short_signal = close_short[i]
+        if holding_position != 0 and funding_rate[i] != 0.0:
+            temp_capital -= holding_position * num_of_lot * bar_open[i] * funding_rate[i]
+        if holding_position == -1:
+            equity_value = temp_capital + (open_price - now_close) * num_of_lot
+        else:
+            equity_value = temp_capital + (now_close - open_price) * num_of_lot
+        equity_value_array[i] = equity_value
+        if holding_position != 0:
+            stop_hit = False
+            fill_price = now_close
+            fee = exit_fee
+            fill_slippage = slippage[i] * exit_slippage_scale
+            if holding_position == 1:
+                if intrabar_stop:
+                    stop_price = open_price * (1 - stop_loss / 100)
+                    if low[i] < stop_price:
+                        stop_hit = True
+                        fill_price = min(stop_price, bar_open[i])
+                elif (now_close - open_price) < (-stop_loss / 100 * open_price):
+                    stop_hit = True
+                if stop_hit:
+                    close_long_signal = True
+                    fee = stop_fee
+                    fill_slippage = slippage[i]
+                if close_long_signal:
+                    fill_price = fill_price * (1 - fill_slippage)
+                    exit_price = fill_price if exit_fee_on_close else open_price
+                    holding_position = 0
+                    temp_capital += (fill_price - open_price) * num_of_lot - num_of_lot * exit_price * fee
+                    if fill_price - open_price > 0:
+                        win_count += 1
+                    else:
+                        lose_count += 1
+                    open_price = 0.0
+                    num_of_lot = 0.0
+            else:
+                if intrabar_stop:
+                    stop_price = open_price * (1 + stop_loss / 100)
+                    if high[i] > stop_price:
+                        stop_hit = True
+                        fill_price = max(stop_price, bar_open[i])
+                elif (now_close - open_price) > (stop_loss / 100 * open_price):
+                    stop_hit = True
+                if stop_hit:
+                    close_short_signal = True
+                    fee = stop_fee
+                    fill_slippage = slippage[i]
+                if close_short_signal:
+                    fill_price = fill_price * (1 + fill_slippage)
+                    exit_price = fill_price if exit_fee_on_close else open_price
+                    holding_position = 0
+                    temp_capital += (open_price - fill_price) * num_of_lot - num_of_lot * exit_price * fee
+                    if open_price - fill_price > 0:
+                        win_count += 1
+                    else:
+                        lose_count += 1
+                    open_price = 0.0
+                    num_of_lot = 0.0
+        else:
+            if open_long_signal:
+                holding_position = 1
+            elif open_short_signal:
+                holding_position = -1
+            if holding_position != 0:
+                open_price = now_close * (1 + holding_position * slippage[i] * entry_slippage_scale)
+                num_of_lot = equity_value * invest_percentage / 100 / open_price
+                temp_capital = temp_capital - num_of_lot * open_price * entry_fee
+        position_array[i] = holding_position
+    return equity_value_array, position_array, win_count, lose_count
+
+
+_compiled_position_state_machine = njit(cache=True)(_position_state_machine) if njit is not None else None
+
+execution_array_list = ["bar_open", "high", "low", "slippage", "funding_rate"]
+execution_scalar_list = ["entry_fee", "exit_fee", "stop_fee", "intrabar_stop", "entry_slippage_scale",
+                         "exit_slippage_scale"]
+
+
+def _execution_arguments(close: np.ndarray, taker_fee: float, execution: dict, compiled: bool) -> list:
+    """
+    Fill model arguments of the state machines
+    :param close:
+    :param taker_fee: flat fee of every fill when execution is None
+    :param execution: from ExecutionModel.bar_arrays, None fills everything at the close
+    :param compiled: contiguous arrays for numba instead of lists
+    :return:
+    """
+    if execution is None:
+        execution = close_fill_arrays(close, taker_fee)
+    if compiled:
+        array_list = [np.ascontiguousarray(execution[key], dtype=np.float64) for key in execution_array_list]
+    else:
+        shape = np.shape(close)
+        # tolist dominates the uncompiled run time, arrays the state machine never reads or that are all zero
+        # share one row of zeros instead
+        zero_list = [[0.0] * shape[1]] * shape[0] if len(shape) == 2 else [0.0] * shape[0]
+        funding_rate = np.asarray(execution["funding_rate"], dtype=np.float64)
+        is_read_dict = {"bar_open": execution["intrabar_stop"] or funding_rate.any(),
+                        "high": execution["intrabar_stop"], "low": execution["intrabar_stop"]}
+        array_list = []
+        for key in execution_array_list:
+            array = np.asarray(execution[key], dtype=np.float64)
+            array_list.append(array.tolist() if is_read_dict.get(key, True) and array.any() else zero_list)
+    return array_list + [float(execution["entry_fee"]), float(execution["exit_fee"]), float(execution["stop_fee"]),
+                         bool(execution["intrabar_stop"]), float(execution["entry_slippage_scale"]),
+                         float(execution["exit_slippage_scale"])]
+
+
+def run_position_state_machine(close: np.ndarray, open_long: np.ndarray, open_short: np.ndarray,
+                               close_long: np.ndarray, close_short: np.ndarray, hold_previous: np.ndarray,
+                               initial_capital: float, stop_loss: float, invest_percentage: float,
+                               taker_fee: float, exit_fee_on_close: bool = False, execution: dict = None):
+    """
+    Run the position state machine, compiled with numba when it is installed,
+    otherwise over plain python lists which is still far cheaper than scalar DataFrame lookups
+    :param execution: bar arrays of an ExecutionModel, None fills every order at the close paying taker_fee
+    :return: equity value array, position array, win count, lose count
+    """
+    if _compiled_position_state_machine is not None:
+        return _compiled_position_state_machine(
+            np.ascontiguousarray(close, dtype=np.float64), np.ascontiguousarray(open_long, dtype=np.bool_),
+            np.ascontiguousarray(open_short, dtype=np.bool_), np.ascontiguousarray(close_long, dtype=np.bool_),
+            np.ascontiguousarray(close_short, dtype=np.bool_), np.ascontiguousarray(hold_previous, dtype=np.bool_),
+            float(initial_capital), float(stop_loss), float(invest_percentage), bool(exit_fee_on_close),
+            *_execution_arguments(close, taker_fee, execution, compiled=True))
+    return _position_state_machine(
+        np.asarray(close, dtype=np.float64).tolist(), np.asarray(open_long, dtype=bool).tolist(),
+        np.asarray(open_short, dtype=bool).tolist(), np.asarray(close_long, dtype=bool).tolist(),
+        np.asarray(close_short, dtype=bool).tolist(), np.asarray(hold_previous, dtype=bool).tolist(),
+        initial_capital, stop_loss, invest_percentage, exit_fee_on_close,
+        *_execution_arguments(close, taker_fee, execution, compiled=False))
+
+
+def _portfolio_state_machine(close, open_long, open_short, close_long, close_short, hold_previous, tradable,
+                             initial_capital, stop_loss, invest_percentage, exit_fee_on_close, bar_open, high, low,
+                             slippage, funding_rate, entry_fee, exit_fee, stop_fee, intrabar_stop,
+                             entry_slippage_scale, exit_slippage_scale):
+    """
+    Position state machine of every symbol over one shared capital: each symbol holds at most one position,
+    sized from the combined equity split evenly across the symbols
+    :param close: (time x symbol) close price, forward filled after a symbol's first kline
+    :param open_long: (time x symbol) open long signal
+    :param open_short: (time x symbol) open short signal
+    :param close_long: (time x symbol) close long signal
+    :param close_short: (time x symbol) close short signal
+    :param hold_previous: bars which reuse the signals of the previous bar instead of their own
+    :param tradable: (time x symbol) bars where the symbol has its own kline, positions are only opened and closed
+    there. On the other bars the forward filled prices never traded: no stop loss is checked and a close signal
+    waits for the next kline of the symbol, a position still held when the symbol is delisted stays marked at its
+    last close
+    :param initial_capital:
+    :param stop_loss: stop loss in percentage of the open price
+    :param invest_percentage: percentage of each symbol's share of the equity invested in a trade
+    :param exit_fee_on_close: charge the exit fee on the close price instead of the open price
+    :param bar_open: (time x symbol) open price
+    :param high: (time x symbol) high price
+    :param low: (time x symbol) low price
+    :param slippage: (time x symbol) fraction of the price lost on a taker fill
+    :param funding_rate: (time x symbol) funding rate paid by longs to shorts, 0 on the bars without funding
+    :param entry_fee:
+    :param exit_fee: fee of an exit on a signal
+    :param stop_fee: fee of an exit on the stop loss
+    :param intrabar_stop: fill the stop loss at the stop price as soon as the low/high crosses it
+    :param entry_slippage_scale: share of the slippage paid by an entry, 0 for maker entries
+    :param exit_slippage_scale: share of the slippage paid by an exit on a signal, 0 for maker exits
+    :return: combined equity value of every bar, (time x symbol) position held after every bar, win count,
+    lose count
+    """
+    n = len(close)
+    symbol_count = len(close[0])
+    equity_value_array = np.empty(n)
+    position_matrix = np.zeros((n, symbol_count), dtype=np.int8)
+    # plain lists keep the per symbol state cheap to index in the uncompiled fallback
+    open_price = [0.0] * symbol_count
+    num_of_lot = [0.0] * symbol_count
+    holding_position = [0] * symbol_count
+    open_long_signal = [False] * symbol_count
+    open_short_signal = [False] * symbol_count
+    close_long_signal = [True] * symbol_count
+    close_short_signal = [True] * symbol_count
+    # a close signal of a bar without kline, executed on the next kline of the symbol
+    pending_close = [False] * symbol_count
+    temp_capital = initial_capital
+    win_count = 0
+    lose_count = 0
+    for i in range(n):
+        now_close_row = close[i]
+        if not hold_previous[i]:
+            for j in range(symbol_count):
+                open_long_signal[j] = open_long[i][j]
+                open_short_signal[j] = open_short[i][j]
+                close_long_signal[j] = close_long[i][j]
+                close_short_signal[j] = close_short[i][j]
+        unrealized = 0.0
+        for j in range(symbol_count):
+            if holding_position[j] != 0 and funding_rate[i][j] != 0.0:
+                temp_capital -= holding_position[j] * num_of_lot[j] * bar_open[i][j] * funding_rate[i][j]
+            if holding_position[j] == -1:
+                unrealized += (open_price[j] - now_close_row[j]) * num_of_lot[j]
+            elif holding_position[j] == 1:
+                unrealized += (now_close_row[j] - open_price[j]) * num_of_lot[j]
+        equity_value = temp_capital + unrealized
+        equity_value_array[i] = equity_value
+        for j in range(symbol_count):
+            now_close = now_close_row[j]
+            if holding_position[j] != 0 and not tradable[i][j]:
+                if (holding_position[j] == 1 and close_long_signal[j]) or \
+                        (holding_position[j] == -1 and close_short_signal[j]):
+                    pending_close[j] = True
+            elif holding_position[j] != 0:
+                stop_hit = False
+                fill_price = now_close
+                fee = exit_fee
+                fill_slippage = slippage[i][j] * exit_slippage_scale
+                if holding_position[j] == 1:
+                    if intrabar_stop:
+                        stop_price = open_price[j] * (1 - stop_loss / 100)
+                        if low[i][j] < stop_price:
+                            stop_hit = True
+                            fill_price = min(stop_price, bar_open[i][j])
+                    elif (now_close - open_price[j]) < (-stop_loss / 100 * open_price[j]):
+                        stop_hit = True
+                    if stop_hit:
+                        close_long_signal[j] = True
+                        fee = stop_fee
+                        fill_slippage = slippage[i][j]
+                    if close_long_signal[j] or pending_close[j]:
+                        pending_close[j] = False
+                        fill_price = fill_price * (1 - fill_slippage)
+                        exit_price = fill_price if exit_fee_on_close else open_price[j]
+                        holding_position[j] = 0
+                        temp_capital += (fill_price - open_price[j]) * num_of_lot[j] - \
+                            num_of_lot[j] * exit_price * fee
+                        if fill_price - open_price[j] > 0:
+                            win_count += 1
+                        else:
+                            lose_count += 1
+                        open_price[j] = 0.0
+                        num_of_lot[j] = 0.0
+                else:
+                    if intrabar_stop:
+                        stop_price = open_price[j] * (1 + stop_loss / 100)
+                        if high[i][j] > stop_price:
+                            stop_hit = True
+                            fill_price = max(stop_price, bar_open[i][j])
+                    elif (now_close - open_price[j]) > (stop_loss / 100 * open_price[j]):
+                        stop_hit = True
+                    if stop_hit:
+                        close_short_signal[j] = True
+                        fee = stop_fee
+                        fill_slippage = slippage[i][j]
+                    if close_short_signal[j] or pending_close[j]:
+                        pending_close[j] = False
+                        fill_price = fill_price * (1 + fill_slippage)
+                        exit_price = fill_price if exit_fee_on_close else open_price[j]
+                        holding_position[j] = 0
+                        temp_capital += (open_price[j] - fill_price) * num_of_lot[j] - \
+                            num_of_lot[j] * exit_price * fee
+                        if open_price[j] - fill_price > 0:
+                            win_count += 1
+                        else:
+                            lose_count += 1
+                        open_price[j] = 0.0
+                        num_of_lot[j] = 0.0
+            elif tradable[i][j]:
+                if open_long_signal[j]:
+                    holding_position[j] = 1
+                elif open_short_signal[j]:
+                    holding_position[j] = -1
+                if holding_position[j] != 0:
+                    open_price[j] = now_close * (1 + holding_position[j] * slippage[i][j] * entry_slippage_scale)
+                    num_of_lot[j] = equity_value * invest_percentage / 100 / symbol_count / open_price[j]
+                    temp_capital = temp_capital - num_of_lot[j] * open_price[j] * entry_fee
+            position_matrix[i, j] = holding_position[j]
+    return equity_value_array, position_matrix, win_count, lose_count
+
+
+_compiled_portfolio_state_machine = njit(cache=True)(_portfolio_state_machine) if njit is not None else None
+
+
+def run_portfolio_state_machine(close: np.ndarray, open_long: np.ndarray, open_short: np.ndarray,
+                                close_long: np.ndarray, close_short: np.ndarray, hold_previous: np.ndarray,
+                                tradable: np.ndarray, initial_capital: float, stop_loss: float,
+                                invest_percentage: float, taker_fee: float, exit_fee_on_close: bool = False,
+                                execution: dict = None):
+    """
+    Run the portfolio state machine, compiled with numba when it is installed, otherwise over nested lists
+    :param execution: (time x symbol) bar arrays of an ExecutionModel, None fills every order at the close paying
+    taker_fee
+    :return: combined equity value array, position matrix, win count, lose count
+    """
+    array_list = [np.ascontiguousarray(close, dtype=np.float64)] + \
+        [np.ascontiguousarray(signal, dtype=np.bool_) for signal in (open_long, open_short, close_long, close_short)]
+    hold_previous = np.ascontiguousarray(hold_previous, dtype=np.bool_)
+    tradable = np.ascontiguousarray(tradable, dtype=np.bool_)
+    if _compiled_portfolio_state_machine is not None:
+        return _compiled_portfolio_state_machine(*array_list, hold_previous, tradable, float(initial_capital),
+                                                 float(stop_loss), float(invest_percentage), bool(exit_fee_on_close),
+                                                 *_execution_arguments(close, taker_fee, execution, compiled=True))
+    return _portfolio_state_machine(*[array.tolist() for array in array_list], hold_previous.tolist(),
+                                    tradable.tolist(), initial_capital, stop_loss, invest_percentage,
+                                    exit_fee_on_close, *_execution_arguments(close, taker_fee, execution,
+                                                                             compiled=False))
+
+
+def drawdown_pct(equity_value_array: np.ndarray) -> np.ndarray:
+    """
+    Drawdown of every bar against the running peak of the equity curve
+    :param equity_value_array:
+    :return:
+    """
+    running_max = np.maximum.accumulate(equity_value_array)
+    return (running_max - equity_value_array) / running_max
+
+
+def daily_equity_value(date_time: np.ndarray, equity_value_array: np.ndarray, initial_capital: float) -> np.ndarray:
+    """
+    Equity value at the last bar of every day, starting from the initial capital
+    :param date_time: datetime64 array aligned with equity_value_array
+    :param equity_value_array:
+    :param initial_capital:
+    :return:
+    """
+    dates = np.asarray(date_time).astype('datetime64[D]')
+    # same boundaries as comparing date_list[i].date() != date_list[i - 1].date() for i in 1..n-2
+    day_change_index = np.flatnonzero(dates[1:-1] != dates[:-2])
+    return np.concatenate(([initial_capital], np.asarray(equity_value_array)[day_change_index]))
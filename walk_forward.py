@@ -0,0 +1,165 @@
+"""
+Walk-forward evaluation: re-optimize the parameters on a rolling in-sample window, trade the best ones on the
+following out-of-sample window, and stitch the out-of-sample equity of every fold into one curve
+"""
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import optimizer
+from indicator_cache import indicator_cache
+from performance import tear_sheet, split_tear_sheet
+
+
+def walk_forward_folds(timestamp, train_days: float, test_days: float, anchored: bool = False) -> list:
+    """
+    Row ranges of the folds, each out-of-sample window starts where its in-sample window ends
+    and the next fold moves forward by one out-of-sample window
+    :param timestamp: kline open time in seconds
+    :param train_days: length of the in-sample window
+    :param test_days: length of the out-of-sample window
+    :param anchored: keep every in-sample window starting at the first kline instead of rolling it
+    :return: list of (train_start, train_end, test_start, test_end) row indices, ends excluded
+    """
+    timestamp = np.asarray(timestamp, dtype=np.int64)
+    fold_list = []
+    train_start_time = int(timestamp[0])
+    while True:
+        train_end_time = train_start_time + int(train_days * 86400)
+        test_end_time = train_end_time + int(test_days * 86400)
+        if test_end_time > int(timestamp[-1]) + 1:
+            break
+        train_start, train_end, test_end = np.searchsorted(timestamp, [train_start_time, train_end_time,
+                                                                       test_end_time])
+        fold_list.append((int(train_start), int(train_end), int(train_end), int(test_end)))
+        if not anchored:
+            train_start_time += int(test_days * 86400)
+        else:
+            train_days += test_days
+    return fold_list
+
+
+def local_time(timestamp) -> pd.Timestamp:
+    """
+    Datetime of a kline open time in the local time the backtests report their res_df in
+    """
+    return pd.to_datetime(int(timestamp) + 60 * 60 * 8, unit="s")
+
+
+def _backtest_range(para_dict: dict, start_index: int, end_index: int):
+    """
+    Backtest the worker's klines between two rows. The indicators are computed on the whole klines,
+    so every fold and every overlapping window of the same parameters reuse the worker's cached columns
+    :return: backtest, res_df
+    """
+    backtest = optimizer._worker_backtest_class(para_dict | {"verbose": False})
+    backtest.set_kline(optimizer._worker_kline_df.copy())
+    res_df = backtest.run_vectorized(start_index=start_index, end_index=end_index)
+    return backtest, res_df
+
+
+def _run_fold(fold_dict: dict) -> dict:
+    """
+    Optimize on the in-sample rows of the fold, then trade the best parameters on its out-of-sample rows
+    :param fold_dict: fold number, row ranges, para_dict_list and rank_by
+    :return: best parameters, their in-sample and out-of-sample metrics, out-of-sample equity
+    """
+    cache_stats = indicator_cache.stats()
+    train_metric_list = []
+    for para_dict in fold_dict["para_dict_list"]:
+        try:
+            backtest, _ = _backtest_range(para_dict, fold_dict["train_start"], fold_dict["train_end"])
+            train_metric_list.append(backtest.metrics[fold_dict["rank_by"]])
+        except (ValueError, IndexError, ZeroDivisionError) as err:
+            print(f"Fail to backtest {para_dict} on fold {fold_dict['fold']}, {err=}")
+            train_metric_list.append(np.nan)
+    train_metric_array = np.asarray(train_metric_list, dtype=np.float64)
+    if np.isnan(train_metric_array).all():
+        raise ValueError(f"No parameters could be backtested on fold {fold_dict['fold']}")
+    best_index = int(np.nanargmin(train_metric_array) if optimizer.metric_ascending(fold_dict["rank_by"]) else
+                     np.nanargmax(train_metric_array))
+    best_para_dict = fold_dict["para_dict_list"][best_index]
+    backtest, res_df = _backtest_range(best_para_dict, fold_dict["test_start"], fold_dict["test_end"])
+    return {"fold": fold_dict["fold"], "para_dict": best_para_dict,
+            f"train_{fold_dict['rank_by']}": train_metric_array[best_index], "test_metrics": backtest.metrics,
+            "res_df": res_df, "cache_hit": indicator_cache.stats()["hit"] - cache_stats["hit"]}
+
+
+def walk_forward(backtest_class, base_para_dict: dict, param_grid: dict, kline_df: pd.DataFrame,
+                 train_days: float, test_days: float, anchored: bool = False, max_workers: int = None,
+                 rank_by: str = "sharpe_ratio"):
+    """
+    Walk-forward grid search, the folds run in parallel across a process pool
+    :param backtest_class: Backtest class of single_indicator_backtest or multi_indicator_backtest
+    :param base_para_dict: para_dict shared by all the combinations
+    :param param_grid: parameter name to the list of values to sweep in every in-sample window
+    :param kline_df: kline with timestamp in seconds, open, high, low and close columns
+    :param train_days: length of the in-sample window
+    :param test_days: length of the out-of-sample window
+    :param anchored: grow the in-sample window from the first kline instead of rolling it
+    :param max_workers:
+    :param rank_by: in-sample metric picking the parameters of a fold, the smallest mdd_pct and the largest of
+    the other metrics as optimizer.run_sweep ranks them
+    :return: stitched out-of-sample equity DataFrame, per fold parameter table
+    """
+    kline_df = kline_df.reset_index(drop=True)
+    fold_list = walk_forward_folds(kline_df["timestamp"], train_days=train_days, test_days=test_days,
+                                   anchored=anchored)
+    if not fold_list:
+        raise ValueError(f"The klines are shorter than {train_days} + {test_days} days")
+    para_dict_list = [base_para_dict | combination for combination in optimizer.grid_combinations(param_grid)]
+    fold_dict_list = [{"fold": fold, "train_start": train_start, "train_end": train_end, "test_start": test_start,
+                       "test_end": test_end, "para_dict_list": para_dict_list, "rank_by": rank_by}
+                      for fold, (train_start, train_end, test_start, test_end) in enumerate(fold_list)]
+    shm_list, layout = optimizer._to_shared_memory(kline_df)
+    max_workers = min(max_workers or os.cpu_count(), len(fold_dict_list))
+    start = time.time()
+    try:
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=optimizer._init_worker,
+                                 initargs=(backtest_class, layout)) as executor:
+            fold_res_list = list(executor.map(_run_fold, fold_dict_list))
+    finally:
+        for shm in shm_list:
+            shm.close()
+            shm.unlink()
+    oos_df_list = []
+    fold_row_list = []
+    capital = None
+    for fold_res, (train_start, train_end, test_start, test_end) in zip(fold_res_list, fold_list):
+        res_df = fold_res["res_df"]
+        # every fold starts from the initial capital, chain them so the stitched curve compounds
+        initial_capital = res_df["equity"].iloc[0] if capital is None else capital
+        scale = initial_capital / res_df["equity"].iloc[0]
+        oos_df_list.append(pd.DataFrame({"datetime": res_df["datetime"], "equity": res_df["equity"] * scale,
+                                         "fold": fold_res["fold"]}))
+        capital = oos_df_list[-1]["equity"].iloc[-1]
+        swept_para_dict = {key: fold_res["para_dict"][key] for key in param_grid}
+        fold_row_list.append({"fold": fold_res["fold"],
+                              "train_start": local_time(kline_df["timestamp"].iloc[train_start]),
+                              "test_start": local_time(kline_df["timestamp"].iloc[test_start]),
+                              "test_end": local_time(kline_df["timestamp"].iloc[test_end - 1])}
+                             | swept_para_dict | {f"train_{rank_by}": fold_res[f"train_{rank_by}"]}
+                             | {f"test_{metric}": value for metric, value in fold_res["test_metrics"].items()})
+    oos_df = pd.concat(oos_df_list, ignore_index=True)
+    fold_df = pd.DataFrame(fold_row_list)
+    oos_df.attrs["metrics"], _, _ = split_tear_sheet(tear_sheet(
+        date_time=oos_df["datetime"].to_numpy(dtype="datetime64[ns]"), equity_value_array=oos_df["equity"].to_numpy(),
+        initial_capital=oos_df["equity"].iloc[0]))
+    print(f"Walk-forward of {len(fold_list)} folds x {len(para_dict_list)} combinations in {time.time() - start:.2f}s, "
+          f"indicator cache hit {sum(fold_res['cache_hit'] for fold_res in fold_res_list)}, "
+          f"out-of-sample {oos_df.attrs['metrics']}")
+    return oos_df, fold_df
+
+
+if __name__ == "__main__":
+    from multi_indicator_backtest.backtest import Backtest
+
+    para_dict = {"strategy_name": "williamsR_MA", "first_window": -85, "second_window": -15,
+                 "reference_window": 16, "sub_window_multiplier": 7, "stop_loss": 1, "backtest_year": 1,
+                 "invest_percentage": 100, "symbol": "SANDUSDT", "start_time": 8, "end_time": 17}
+    param_grid = {"first_window": [-90, -85, -80], "second_window": [-20, -15, -10],
+                  "reference_window": [8, 16, 24], "stop_loss": [0.5, 1, 2]}
+    kline_df = optimizer.load_csv_kline("bybit/bybit_SANDUSDT_30_kline.csv")
+    oos_df, fold_df = walk_forward(Backtest, para_dict, param_grid, kline_df, train_days=90, test_days=30)
+    print(fold_df)